@@ -0,0 +1,144 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+class CameraCoverage:
+    """
+    Spatial index of the fields of view of cameras (the polygons of camera_data) over the field of detection. The
+    field is split into cells of cell_size, a (rows x columns x cameras) array marks cameras whose field of view
+    touches each cell, so a point is looked up in one cell and tested only against the few polygons that can contain
+    it. Points outside the field of detection are tested against all cameras. The index is rebuilt when a camera was
+    added or its camera_data entry was replaced (by /cameras/update)
+    """
+    def __init__(self,
+                 camera_data: Dict[int, Tuple],
+                 field_size: Tuple[int, int],
+                 cell_size: int = 20,
+                 margin: float = 1.0):
+        """
+        @param margin: distance in field units by which points outside of a polygon still count as covered, polygons
+            are rounded to whole units
+        """
+        self.camera_data = camera_data
+        self.known_camera_data: Dict[int, Tuple] = {}
+        self.field_size = field_size
+        self.cell_size = cell_size
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.rows = -(-field_size[1] // cell_size)
+        self.columns = -(-field_size[0] // cell_size)
+        self.camera_indexes: List[int] = []
+        self.camera_rows: Dict[int, int] = {}
+        # corners of each polygon (cameras x 4 x 2), edge vectors and their lengths
+        self.corners = np.zeros((0, 4, 2))
+        self.edges = np.zeros((0, 4, 2))
+        self.lengths = np.ones((0, 4))
+        self.cells = np.zeros((self.rows, self.columns, 0), bool)
+
+    def refresh(self):
+        with self.lock:
+            if len(self.camera_data) == len(self.known_camera_data) and all(
+                    self.known_camera_data.get(index) is data for index, data in self.camera_data.items()):
+                return
+            camera_data = dict(self.camera_data)
+            polygons = {index: data[4] for index, data in camera_data.items() if data[4] is not None}
+            camera_indexes = list(polygons.keys())
+            corners = np.array([np.reshape(polygon, (4, 2)) for polygon in polygons.values()], float).reshape(-1, 4, 2)
+            edges = np.roll(corners, -1, axis=1) - corners
+            cells = np.zeros((self.rows, self.columns, len(camera_indexes)), bool)
+            mask = np.zeros((self.rows, self.columns), np.uint8)
+            for row in range(len(camera_indexes)):
+                mask[:] = 0
+                cv2.fillPoly(mask, [np.round(corners[row] / self.cell_size - 0.5).astype(np.int32)], 1)
+                # cells only partly covered by the polygon are marked by the neighbours of cells it was drawn in
+                cells[:, :, row] = cv2.dilate(mask, np.ones((3, 3), np.uint8)) > 0
+            self.camera_indexes = camera_indexes
+            self.camera_rows = {camera_index: row for row, camera_index in enumerate(camera_indexes)}
+            self.corners = corners
+            self.edges = edges
+            self.lengths = np.maximum(np.hypot(edges[..., 0], edges[..., 1]), 1e-9)
+            self.cells = cells
+            self.known_camera_data = camera_data
+
+    def candidates(self, points: np.ndarray) -> np.ndarray:
+        """
+        @param points: (points x 2) array of x, y in the field
+        @return: (points x cameras) array of cameras whose cell of the point they touch
+        """
+        column = np.floor(points[:, 0] / self.cell_size)
+        row = np.floor(points[:, 1] / self.cell_size)
+        inside = (column >= 0) & (column < self.columns) & (row >= 0) & (row < self.rows)
+        result = np.ones((len(points), len(self.camera_indexes)), bool)
+        result[inside] = self.cells[row[inside].astype(np.intp), column[inside].astype(np.intp)]
+        return result
+
+    def contains(self, rows: np.ndarray, points: np.ndarray) -> np.ndarray:
+        """
+        @param rows: (n) cameras, by row of the index
+        @param points: (n x 2) points
+        @return: (n) True where the point is in the polygon of the camera, polygons are convex so a point is inside
+            when it's on the same side of all edges
+        """
+        offsets = points[:, None, :] - self.corners[rows]
+        edges = self.edges[rows]
+        sides = (edges[..., 0] * offsets[..., 1] - edges[..., 1] * offsets[..., 0]) / self.lengths[rows]
+        return np.all(sides >= -self.margin, axis=1) | np.all(sides <= self.margin, axis=1)
+
+    def covers(self, points: np.ndarray, camera_indexes: Optional[List[int]] = None,
+               unknown: bool = False) -> np.ndarray:
+        """
+        @param points: (points x 2) array of x, y in the field, NaN points aren't covered
+        @param camera_indexes: cameras of the result, all cameras of the index when None
+        @param unknown: result for cameras without a field of view in the index
+        @return: (cameras x points) array, True where the camera sees the point
+        """
+        self.refresh()
+        with self.lock:
+            return self.cover_points(points, camera_indexes, unknown)
+
+    def cover_points(self, points: np.ndarray, camera_indexes: Optional[List[int]], unknown: bool) -> np.ndarray:
+        points = np.asarray(points, float).reshape(-1, 2)
+        if camera_indexes is None:
+            camera_indexes = self.camera_indexes
+        known = np.array([index in self.camera_rows for index in camera_indexes], bool)
+        result = np.zeros((len(camera_indexes), len(points)), bool)
+        result[~known] = unknown
+        if not known.any() or not len(points):
+            return result
+        valid = ~np.isnan(points).any(axis=1)
+        rows = np.array([self.camera_rows.get(index, 0) for index in camera_indexes], np.intp)
+        candidates = np.zeros((len(points), len(self.camera_indexes)), bool)
+        candidates[valid] = self.candidates(points[valid])
+        candidates = candidates[:, rows].T & known[:, None]
+        camera_positions, point_positions = np.nonzero(candidates)
+        result[camera_positions, point_positions] = self.contains(rows[camera_positions], points[point_positions])
+        return result
+
+    def get_cameras(self, x: float, y: float) -> List[int]:
+        """
+        @return: indexes of cameras that see the point
+        """
+        self.refresh()
+        camera_indexes = self.camera_indexes
+        covered = self.covers(np.array([[x, y]]), camera_indexes)[:, 0]
+        return [camera_index for camera_index, seen in zip(camera_indexes, covered) if seen]
+
+    def get_report(self) -> Dict:
+        """
+        @return: number of cells of the field covered by each camera and number of cells by how many cameras cover
+            them, cells are counted as covered when their center is
+        """
+        self.refresh()
+        camera_indexes = self.camera_indexes
+        row, column = np.mgrid[0:self.rows, 0:self.columns]
+        centers = np.stack([(column.ravel() + 0.5) * self.cell_size, (row.ravel() + 0.5) * self.cell_size], axis=1)
+        covered = self.covers(centers, camera_indexes)
+        counts = np.bincount(covered.sum(axis=0), minlength=1)
+        return {"cell_size": self.cell_size,
+                "cells": int(len(centers)),
+                "cameras": {int(camera_index): int(cells) for camera_index, cells in
+                            zip(camera_indexes, covered.sum(axis=1))},
+                "covered_by": {int(cameras): int(cells) for cameras, cells in enumerate(counts) if cells}}
@@ -1,153 +1,561 @@
-from copy import deepcopy
-from queue import Queue
-from typing import Optional, List, Dict, Tuple
+import glob
+import itertools
+import os
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from queue import Queue, Empty, Full
+from typing import Optional, List, Dict, Tuple, Iterator, Collection, Callable
 
 import apriltag
 import cv2
 import numpy as np
 
 import src.image_transforms.imageTransforms as imageTransforms
+from src.camera_coverage.cameraCoverage import CameraCoverage
 import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
 from src.data_model.dataModel import Config
 from src.data_model.dataModel import FrameObject
+from src.data_model.dataModel import FrameRing
 from src.data_model.dataModel import FrameObjectWithDetectedObjects
+from src.data_model.dataModel import FusedObjects
+from src.view_streaming.viewStreaming import FrameBroadcaster
 
 
 class CameraReader(mtl.GetParent):
-    def __init__(self, camera_number: int):
+    """
+    Reads frames straight into slots of a FrameRing, created for the shape of the first frame. When all slots are
+    still referenced by frames in the pipeline, the frame is read into a newly allocated array instead.
+
+    With grayscale=True (when nothing renders colour frames) frames are converted to grayscale while capturing, and
+    downscaled to the scale of decimation, so only a third (or less) of the bytes of a colour frame is queued. The
+    colour frame is read into one reused buffer. Each scale has its own ring, rings are retired when the reader stops
+    and created again by the next read
+    """
+    def __init__(self, camera_number: int, ring_slots: int = 16, grayscale: bool = False,
+                 decimation: Optional[imageTransforms.AdaptiveDecimation] = None):
         super(CameraReader, self).__init__()
         self.cap = cv2.VideoCapture(camera_number)
         if not self.cap.isOpened():
             raise Exception("Couldn't open camera {}".format(camera_number))
         self.index: int = camera_number
+        self.ring_slots = ring_slots
+        self.ring: Optional[FrameRing] = None
+        self.grayscale = grayscale
+        self.decimation = decimation
+        self.rings: Dict[Tuple[int, ...], FrameRing] = {}
+        self.buffer: Optional[np.ndarray] = None
+        self.gray: Optional[np.ndarray] = None
 
     def get_data(self) -> Optional[FrameObject]:
-        ret, frame = self.cap.read()
+        if self.grayscale:
+            return self.get_gray_data()
+        if self.ring is None:
+            ret, frame = self.cap.read()
+            if not ret:
+                return None
+            self.ring = FrameRing(frame.shape, frame.dtype.str, self.ring_slots)
+            return self.ring.share(FrameObject(frame, self.index))
+        slot = self.ring.acquire()
+        if slot is None:
+            ret, frame = self.cap.read()
+            return FrameObject(frame, self.index) if ret else None
+        ret, frame = self.cap.read(slot.get_array())
+        if not ret:
+            slot.release()
+            return None
+        if frame is not slot.get_array():
+            # the backend changed the frame size, keep its own array
+            slot.release()
+            return FrameObject(frame, self.index)
+        frame_object = FrameObject(frame, self.index, slot)
+        slot.release()
+        return frame_object
+
+    def get_gray_data(self) -> Optional[FrameObject]:
+        ret, frame = self.cap.read(self.buffer)
         if not ret:
             return None
-        return FrameObject(deepcopy(frame), self.index)
+        self.buffer = frame
+        scale = self.decimation.get_scale(self.index) if self.decimation is not None else 1.0
+        height, width = frame.shape[:2]
+        if scale != 1.0:
+            width, height = imageTransforms.get_scaled_size(width, height, scale)
+            if self.gray is None or self.gray.shape != frame.shape[:2]:
+                self.gray = np.empty(frame.shape[:2], np.uint8)
+        ring = self.rings.get((height, width))
+        if ring is None:
+            ring = FrameRing((height, width), "|u1", self.ring_slots)
+            self.rings[(height, width)] = ring
+        slot = ring.acquire()
+        out = slot.get_array() if slot is not None else None
+        gray = imageTransforms.downscale_gray(frame, scale, self.gray, out)
+        if slot is None:
+            return FrameObject(gray, self.index, scale=scale)
+        frame_object = FrameObject(gray, self.index, slot, scale=scale)
+        slot.release()
+        return frame_object
 
     def get_resolution(self) -> Tuple[int, int]:
         return int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
+    # shared memory of the rings is freed once the pipeline released their frames
+    def stop(self):
+        rings = list(self.rings.values())
+        if self.ring is not None:
+            rings.append(self.ring)
+        self.ring = None
+        self.rings = {}
+        for ring in rings:
+            ring.retire()
 
-class CameraDisplay(mtl.SinkParent):
-    def __init__(self, window_name: str, camera_data: Dict[int, Tuple[int, int, float, Tuple[int, int], Tuple]]):
-        super(CameraDisplay, self).__init__()
+
+IMAGE_EXTENSIONS = (".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff")
+
+# marks the end of a replay in the prefetch queue
+_END_OF_REPLAY: Tuple[Optional[FrameObject], float] = (None, float("inf"))
+
+
+class ReplayClock:
+    """
+    Maps recorded capture times to time.monotonic(). The offset is set by the first frame taken from any replay of the
+    clock, replays of cameras recorded together share a clock so their frames keep the recorded time differences
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.offset: Optional[float] = None
+
+    def get_offset(self, capture_time: float, now: Optional[float] = None) -> float:
+        """
+        @param now: time the frame with capture_time is taken, time.monotonic() when None
+        """
+        with self.lock:
+            if self.offset is None:
+                self.offset = (now if now is not None else time.monotonic()) - capture_time
+            return self.offset
+
+
+class ReplayReader(mtl.GetParent):
+    """
+    Replays a video file or an image sequence (a directory or a glob pattern of images) as a camera. Original capture
+    times (a capture log, one time in seconds per line) are read from <video>.timestamps or from timestamps.txt next to
+    the images, without a log frames are fps of the video (or fps) apart. With realtime=True get_data() returns the
+    latest frame that is due according to its capture time, skipping older ones like a live camera; with
+    realtime=False it returns every frame in order, as fast as it's called, which makes replays deterministic.
+    Capture times of frames are the recorded ones moved to time.monotonic() by clock, in both modes.
+    Frames are decoded ahead into FrameRing slots by a prefetch thread, images by a pool of decode_threads
+    """
+    def __init__(self,
+                 camera_index: int,
+                 source: str,
+                 realtime: bool = True,
+                 fps: float = 30.0,
+                 loop: bool = False,
+                 prefetch: int = 8,
+                 decode_threads: int = 2,
+                 ring_slots: int = 16,
+                 clock: Optional[ReplayClock] = None):
+        super(ReplayReader, self).__init__()
+        self.index = camera_index
+        self.source = source
+        self.realtime = realtime
+        self.loop = loop
+        self.prefetch = prefetch
+        self.decode_threads = decode_threads
+        self.ring_slots = ring_slots
+        self.ring: Optional[FrameRing] = None
+        self.video_reader: Optional[CameraReader] = None
+        self.paths: List[str] = []
+        if os.path.isdir(source):
+            self.paths = sorted(path for path in glob.glob(os.path.join(source, "*"))
+                                if path.lower().endswith(IMAGE_EXTENSIONS))
+            log_path = os.path.join(source, "timestamps.txt")
+        elif glob.has_magic(source):
+            self.paths = sorted(glob.glob(source))
+            log_path = os.path.join(os.path.dirname(source), "timestamps.txt")
+        else:
+            self.video_reader = CameraReader(source, ring_slots)
+            self.video_reader.index = camera_index
+            video_fps = self.video_reader.cap.get(cv2.CAP_PROP_FPS)
+            fps = video_fps if video_fps > 0 else fps
+            log_path = source + ".timestamps"
+        if self.video_reader is None:
+            first = cv2.imread(self.paths[0]) if self.paths else None
+            if first is None:
+                raise Exception("Couldn't read images of {}".format(source))
+            self.resolution = first.shape[1], first.shape[0]
+        else:
+            self.resolution = self.video_reader.get_resolution()
+        self.frame_period = 1 / fps
+        self.log: List[float] = []
+        if os.path.isfile(log_path):
+            with open(log_path) as log:
+                self.log = [float(line) for line in log if line.strip()]
+        self.frames: Queue = Queue(prefetch)
+        self.decoder = self.decode()
+        self.decoded: Optional[Tuple[Optional[FrameObject], float]] = None
+        self.next_frame: Optional[Tuple[Optional[FrameObject], float]] = None
+        self.clock = clock if clock is not None else ReplayClock()
+        self.finished = False
+        self.skipped = 0
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def get_resolution(self) -> Tuple[int, int]:
+        return self.resolution
+
+    def frame_time(self, position: int) -> float:
+        if position < len(self.log):
+            return self.log[position]
+        if self.log:
+            return self.log[-1] + (position - len(self.log) + 1) * self.frame_period
+        return position * self.frame_period
+
+    def decode_video(self) -> Iterator[FrameObject]:
+        self.video_reader.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return iter(self.video_reader.get_data, None)
+
+    def decode_images(self) -> Iterator[FrameObject]:
+        with ThreadPoolExecutor(self.decode_threads) as pool:
+            paths = iter(self.paths)
+            futures = deque((path, pool.submit(cv2.imread, path)) for path in itertools.islice(paths, self.prefetch))
+            while futures:
+                path, future = futures.popleft()
+                for next_path in itertools.islice(paths, 1):
+                    futures.append((next_path, pool.submit(cv2.imread, next_path)))
+                image = future.result()
+                if image is None:
+                    print("Couldn't read {}".format(path))
+                    continue
+                if self.ring is None:
+                    self.ring = FrameRing(image.shape, image.dtype.str, self.ring_slots)
+                if image.shape != self.ring.shape:
+                    yield FrameObject(image, self.index)
+                else:
+                    yield self.ring.share(FrameObject(image, self.index))
+
+    def decode(self) -> Iterator[Tuple[FrameObject, float]]:
+        """
+        @return: decoded frames with their capture times, looped capture times continue after the last frame
+        """
+        offset = 0.0
+        while True:
+            count = 0
+            frames = self.decode_images() if self.video_reader is None else self.decode_video()
+            for position, frame_object in enumerate(frames):
+                yield frame_object, offset + self.frame_time(position)
+                count = position + 1
+            if not self.loop or count == 0:
+                return
+            offset += self.frame_time(count - 1) - self.frame_time(0) + self.frame_period
+
+    def prefetch_frames(self):
+        while not self.stop_event.is_set():
+            if self.decoded is None:
+                self.decoded = next(self.decoder, _END_OF_REPLAY)
+            try:
+                self.frames.put(self.decoded, timeout=0.1)
+            except Full:
+                continue
+            if self.decoded is _END_OF_REPLAY:
+                return
+            self.decoded = None
+
+    def start_prefetch(self):
+        self.stop_event.clear()
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.prefetch_frames, args=(), daemon=True)
+            self.thread.start()
+
+    def take_frame(self, timeout: Optional[float]) -> Optional[Tuple[Optional[FrameObject], float]]:
+        if self.next_frame is None:
+            try:
+                self.next_frame = self.frames.get(timeout=timeout) if timeout else self.frames.get_nowait()
+            except Empty:
+                return None
+            if self.next_frame is _END_OF_REPLAY:
+                self.finished = True
+                self.next_frame = None
+        return self.next_frame
+
+    def get_data(self) -> Optional[FrameObject]:
+        if self.finished:
+            if not self.realtime:
+                # nothing more to replay, don't let a DataGetter spin
+                time.sleep(0.1)
+            return None
+        self.start_prefetch()
+        if not self.realtime:
+            if self.take_frame(0.1) is None:
+                return None
+            frame_object, capture_time = self.next_frame
+            self.next_frame = None
+        else:
+            frame_object, capture_time = None, None
+            now = time.monotonic()
+            while self.take_frame(None) is not None:
+                next_object, next_time = self.next_frame
+                if next_time + self.clock.get_offset(next_time, now) > now:
+                    break
+                if frame_object is not None:
+                    frame_object.release()
+                    self.skipped += 1
+                frame_object, capture_time = next_object, next_time
+                self.next_frame = None
+        if frame_object is not None:
+            frame_object.capture_time = capture_time + self.clock.get_offset(capture_time)
+        return frame_object
+
+    # stops prefetching, it's resumed by the next get_data()
+    def stop(self):
+        self.stop_event.set()
+
+
+class ViewRenderer:
+    """
+    Draws detections and fused objects on views: a copy of the latest frame of each camera and the field of
+    detection with all cameras. Views are preallocated uint8 canvases reused for every render, the field of detection
+    is copied from a background with camera outlines, redrawn only when camera_data changes. With a coverage index
+    fused objects are only drawn on views of cameras that see them
+    """
+    def __init__(self, window_name: str, camera_data: Dict[int, Tuple[int, int, float, Tuple[int, int], Tuple]],
+                 coverage: Optional[CameraCoverage] = None):
         self.window_name = window_name
+        self.coverage = coverage
         config = Config()
         self.window_size: Tuple[int, int] = config.get_window_size()
-        self.detected_objects_centers: Dict[int, Dict[int, Tuple[int, int]]] = {}
-        self.detected_objects_rots: Dict[int, Dict[int, float]] = {}
-        self.indexes = config.get_objects().keys()
         self.camera_data = camera_data
-        self.cameras = set()
-        self.first_frames = {}
-
-    def sink_data(self, input_object: List[FrameObjectWithDetectedObjects]):
-        frame_window = np.zeros((*self.window_size, 3))
-        for detected_frame in input_object:
-            if detected_frame.camera_index not in self.cameras:
-                self.cameras.add(detected_frame.camera_index)
-            self.first_frames[detected_frame.camera_index] = detected_frame.get_frame()
-            self.detected_objects_centers[detected_frame.camera_index] = detected_frame.centers
-            self.detected_objects_rots[detected_frame.camera_index] = detected_frame.rots
-            for object_index in self.indexes:
-                if object_index in self.detected_objects_centers[detected_frame.camera_index]:
-                    x_from_camera = self.camera_data.get(detected_frame.camera_index)[0]
-                    y_from_camera = self.camera_data.get(detected_frame.camera_index)[1]
-                    cosine = np.cos(self.camera_data.get(detected_frame.camera_index)[2])
-                    sine = np.sin(self.camera_data.get(detected_frame.camera_index)[2])
-                    x_detected = self.detected_objects_centers.get(detected_frame.camera_index).get(object_index)[0]
-                    y_detected = self.detected_objects_centers.get(detected_frame.camera_index).get(object_index)[1]
-                    self.detected_objects_centers.get(detected_frame.camera_index)[object_index] = \
-                        int(x_from_camera + x_detected * cosine - y_detected * sine), \
-                        int(y_from_camera + x_detected * sine + y_detected * cosine)
-        frames_to_display = deepcopy(self.first_frames)
-        for object_index in self.indexes:
-            i = 0
-            x = 0
-            y = 0
-            rot = 0
-            for camera_index in self.cameras:
-                if object_index in self.detected_objects_centers.get(camera_index):
-                    i += 1
-                    x_p = self.detected_objects_centers.get(camera_index).get(object_index)[0]
-                    x += x_p
-                    y_p = self.detected_objects_centers.get(camera_index).get(object_index)[1]
-                    y += y_p
-                    rot_p = self.detected_objects_rots.get(camera_index).get(object_index) \
-                            + self.camera_data.get(camera_index)[2]
-                    rot_p = rot_p - np.floor(rot_p / (2*np.pi))*2*np.pi
-                    if rot == 0:
-                        rot = rot_p
-                    elif np.abs(rot - rot_p) > np.pi:
-                        rot = (rot + np.pi + rot_p)/2
-                    else:
-                        rot = (rot + rot_p) / 2
-                    x_1 = x_p - self.camera_data.get(camera_index)[0]
-                    y_1 = y_p - self.camera_data.get(camera_index)[1]
-                    cosine = np.cos(self.camera_data.get(camera_index)[2])
-                    sine = np.sin(self.camera_data.get(camera_index)[2])
-                    frames_to_display[camera_index] = cv2.circle(frames_to_display[camera_index], (
-                        int(x_1*cosine + y_1*sine),
-                        int(y_1*cosine - x_1*sine)), 5,
-                                                                 (255, 0, 0), -1)
-                    frames_to_display[camera_index] = cv2.putText(frames_to_display[camera_index],
-                                                                  "object: {}: rot: {}".format(object_index,
-                                                                                               str(rot_p - self.camera_data.get(camera_index)[2])), (
-                                                                      int(x_1*cosine + y_1*sine),
-                                                                      int(y_1*cosine - x_1*sine + 15)),
-                                                                  cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
-            if i != 0:
-                x = x // i
-                y = y // i
-                # rot = rot / i
-                for camera_index in self.cameras:
-                    cosine = np.cos(self.camera_data.get(camera_index)[2])
-                    sine = np.sin(self.camera_data.get(camera_index)[2])
-                    x_1 = x - self.camera_data.get(camera_index)[0]
-                    y_1 = y - self.camera_data.get(camera_index)[1]
-                    frames_to_display[camera_index] = cv2.putText(frames_to_display[camera_index],
-                                                                  "object: {}: rot: {}".format(object_index, str(rot)),
-                                                                  (
-                                                                      int(x_1*cosine + y_1*sine),
-                                                                      int(y_1*cosine - x_1*sine)),
-                                                                  cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
-                    frames_to_display[camera_index] = cv2.circle(frames_to_display[camera_index], (
-                        int(x_1*cosine + y_1*sine), int(y_1*cosine - x_1*sine)), 5, (0, 0, 255), -1)
+        self.known_camera_data: Dict[int, Tuple] = {}
+        # latest frame of each camera, keeping its FrameRing slot referenced, and canvases the views are drawn on
+        self.first_frames: Dict[int, FrameObjectWithDetectedObjects] = {}
+        self.display_frames: Dict[int, np.ndarray] = {}
+        self.background = np.zeros((*self.window_size, 3), np.uint8)
+        self.frame_window = np.zeros((*self.window_size, 3), np.uint8)
+
+    def update_frames(self, input_object: List[FusedObjects]):
+        for fused_objects in input_object:
+            for camera_index, detected_frame in fused_objects.frames.items():
+                if not isinstance(detected_frame, FrameObject):
+                    # a DetectionBatch, sent without its frame
+                    continue
+                previous_frame = self.first_frames.get(camera_index)
+                if previous_frame is not None:
+                    previous_frame.release()
+                self.first_frames[camera_index] = detected_frame
+
+    def update_background(self):
+        if len(self.camera_data) == len(self.known_camera_data) and all(
+                self.known_camera_data.get(index) is data for index, data in self.camera_data.items()):
+            return
+        self.known_camera_data = dict(self.camera_data)
+        self.background.fill(0)
+        for camera_index, camera_data in self.known_camera_data.items():
+            if camera_data[4] is not None:
+                cv2.polylines(self.background, [camera_data[4]], True, (255, 0, 0), 1)
+            cv2.putText(self.background, "Camera {}".format(camera_index), (camera_data[0], camera_data[1] + 15),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
+
+    def get_display_frame(self, camera_index: int, frame: np.ndarray) -> np.ndarray:
+        shape = frame.shape[:2] + (3,)
+        display_frame = self.display_frames.get(camera_index)
+        if display_frame is None or display_frame.shape != shape:
+            display_frame = np.empty(shape, np.uint8)
+            self.display_frames[camera_index] = display_frame
+        if frame.ndim == 2:
+            cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR, dst=display_frame)
+        else:
+            np.copyto(display_frame, frame)
+        return display_frame
+
+    def render(self, input_object: List[FusedObjects]) -> Dict[str, np.ndarray]:
+        """
+        @param input_object: fused objects, the last of them is drawn
+        @return: views by window name, valid until the next render
+        """
+        self.update_frames(input_object)
+        self.update_background()
+        fused_objects = input_object[-1]
+        frame_window = self.frame_window
+        np.copyto(frame_window, self.background)
+        frames_to_display = {camera_index: self.get_display_frame(camera_index, detected_frame.get_frame())
+                             for camera_index, detected_frame in self.first_frames.items()}
+        fused_pixels = fused_objects.to_camera()
+        if self.coverage is not None:
+            covered = self.coverage.covers(fused_objects.positions, fused_objects.camera_indexes, unknown=True)
+        else:
+            covered = np.ones((len(fused_objects.camera_indexes), len(fused_objects.object_indexes)), bool)
+        for row, camera_index in enumerate(fused_objects.camera_indexes):
+            display_frame = frames_to_display.get(camera_index)
+            if display_frame is None:
+                continue
+            for column, object_index in enumerate(fused_objects.object_indexes):
+                x_p, y_p, rot_p = fused_objects.camera_pixels[row, column]
+                if not np.isnan(x_p):
+                    cv2.circle(display_frame, (int(x_p), int(y_p)), 5, (255, 0, 0), -1)
+                    cv2.putText(display_frame, "object: {}: rot: {}".format(object_index, str(rot_p)),
+                                (int(x_p), int(y_p + 15)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
+                if fused_objects.visible[column] and covered[row, column]:
+                    x_1, y_1 = fused_pixels[row, column]
+                    rot = fused_objects.rots[column]
+                    cv2.putText(display_frame, "object: {}: rot: {}".format(object_index, str(rot)),
+                                (int(x_1), int(y_1)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
+                    cv2.circle(display_frame, (int(x_1), int(y_1)), 5, (0, 0, 255), -1)
+        for column, object_index in enumerate(fused_objects.object_indexes):
+            if fused_objects.visible[column]:
+                x, y = int(fused_objects.positions[column, 0]), int(fused_objects.positions[column, 1])
+                rot = fused_objects.rots[column]
                 cv2.putText(frame_window, "object: {}: rot: {}".format(object_index, str(rot)), (x, y),
                             cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
                 cv2.putText(frame_window, "x: {}, y: {}".format(x, y), (x + 83, y + 18),
                             cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
                 cv2.circle(frame_window, (x, y), 5, (0, 0, 255), -1)
-        for camera_index in self.cameras:
-            cv2.imshow("Camera: {}".format(camera_index), frames_to_display[camera_index])
-            x_cam = self.camera_data.get(camera_index)[0]
-            y_cam = self.camera_data.get(camera_index)[1]
-            cv2.polylines(frame_window, [self.camera_data.get(camera_index)[4]], True, (255, 0, 0), 1)
-            cv2.putText(frame_window, "Camera {}".format(camera_index), (x_cam, y_cam + 15), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
-        cv2.imshow(self.window_name, frame_window)
-        cv2.waitKey(1)
+        views = {"Camera: {}".format(camera_index): display_frame
+                 for camera_index, display_frame in frames_to_display.items()}
+        views[self.window_name] = frame_window
+        return views
+
+
+class CameraDisplay(mtl.SinkParent):
+    """
+    Shows views of a ViewRenderer in OpenCV windows and publishes them to a FrameBroadcaster for streaming clients.
+    Windows can be turned off on headless machines. Run it in a PeriodicDataSink fed by a LatestValueQueue, so it
+    draws the latest fused objects at its own rate without slowing down fusion
+    """
+    def __init__(self, window_name: str, camera_data: Dict[int, Tuple[int, int, float, Tuple[int, int], Tuple]],
+                 show_windows: bool = True, broadcaster: Optional[FrameBroadcaster] = None,
+                 coverage: Optional[CameraCoverage] = None):
+        super(CameraDisplay, self).__init__()
+        self.window_name = window_name
+        self.renderer = ViewRenderer(window_name, camera_data, coverage)
+        self.show_windows = show_windows
+        self.broadcaster = broadcaster
+
+    def sink_data(self, input_object: List[FusedObjects]):
+        views = self.renderer.render(input_object)
+        if self.broadcaster is not None:
+            self.broadcaster.publish(views)
+        if self.show_windows:
+            for name, view in views.items():
+                cv2.imshow(name, view)
+            cv2.waitKey(1)
 
     def stop(self):
-        cv2.destroyWindow(self.window_name)
+        if self.show_windows:
+            cv2.destroyWindow(self.window_name)
 
     def __del__(self):
-        cv2.destroyWindow(self.window_name)
+        if self.show_windows:
+            cv2.destroyWindow(self.window_name)
 
 
 class Settings:
-    def __init__(self):
-        self.config = Config()
-        temp_objects = self.config.get_objects()
-        self.indexes: List[int] = list(temp_objects.keys())
-        self.options = apriltag.DetectorOptions(families=self.config.get_tag_family())
-        self.tags_index = {}
-        self.tags = []
-        for index in self.indexes:
-            self.tags_index[temp_objects.get(index).get("tag_id")] = index
-            self.tags.append(temp_objects.get(index).get("tag_id"))
+    """
+    Immutable snapshot of the detection settings of a Config version, shared by all cameras. tags is a set and
+    tags_index maps tag ids to object indexes, so each detection is looked up in constant time. Detectors compare
+    snapshots by identity and rebuild when a new one is set
+    """
+    def __init__(self, config: Optional[Config] = None):
+        config = config if config is not None else Config()
+        temp_objects = config.get_objects()
+        self.version: int = config.version
+        self.indexes: Tuple[int, ...] = tuple(temp_objects.keys())
+        self.options = apriltag.DetectorOptions(families=config.get_tag_family())
+        self.tags_index: Dict[int, int] = {temp_objects.get(index).get("tag_id"): index for index in self.indexes}
+        self.tags = frozenset(self.tags_index.keys())
+
+
+class SettingsStore:
+    """
+    Holds the current Settings snapshot. A new snapshot is built only when the Config version changes, by update()
+    or by reload_if_changed() noticing a change of the config file, and is swapped in with one assignment, so
+    get() takes no lock. Listeners are called with each new snapshot
+    """
+    def __init__(self, config: Optional[Config] = None):
+        self.config = config if config is not None else Config()
+        self.lock = threading.Lock()
+        self.settings = Settings(self.config)
+        self.listeners: List[Callable[[Settings], None]] = []
+
+    def get(self) -> Settings:
+        return self.settings
+
+    def add_listener(self, listener: Callable[[Settings], None]):
+        self.listeners.append(listener)
+
+    def refresh(self) -> bool:
+        """
+        @return: True if a new snapshot was swapped in
+        """
+        with self.lock:
+            if self.config.version == self.settings.version:
+                return False
+            self.settings = Settings(self.config)
+        for listener in self.listeners:
+            listener(self.settings)
+        return True
+
+    def reload_if_changed(self) -> bool:
+        try:
+            self.config.reload_if_changed()
+            return self.refresh()
+        except Exception as e:
+            print("Couldn't reload config: {}".format(e))
+            return False
+
+    def update(self, values: dict) -> Settings:
+        self.config.update(values)
+        self.refresh()
+        return self.settings
+
+
+def create_detect_transform(settings: Settings,
+                            config: Config,
+                            decimation: Optional[imageTransforms.AdaptiveDecimation] = None) \
+        -> imageTransforms.DetectObjectsTransform:
+    tracking = config.get_tracking()
+    pose = config.get_pose()
+    # frames are passed on after detection only when they are rendered or corners are refined in them
+    keep_frame = config.get_render().get("enabled") or (pose.get("enabled") and pose.get("refine_corners"))
+    return imageTransforms.DetectObjectsTransform(settings,
+                                                  tracking.get("enabled"),
+                                                  tracking.get("full_scan_interval"),
+                                                  tracking.get("roi_padding"),
+                                                  keep_frame=keep_frame,
+                                                  decimation=decimation)
+
+
+def create_detect_chain(detect_transform: imageTransforms.DetectObjectsTransform, config: Config) \
+        -> mtl.OperationChain:
+    operation_chain = mtl.OperationChain().add_operation(detect_transform)
+    pose = config.get_pose()
+    if pose.get("enabled"):
+        intrinsics = {int(index): (camera.get("camera_matrix"), camera.get("distortion"))
+                      for index, camera in pose.get("intrinsics").items()}
+        render = config.get_render().get("enabled")
+        operation_chain.add_operation(imageTransforms.EstimatePosesTransform(intrinsics,
+                                                                             pose.get("tag_size"),
+                                                                             pose.get("refine_corners"),
+                                                                             keep_frame=render))
+    return operation_chain
+
+
+def create_decimation(config: Config) -> Optional[imageTransforms.AdaptiveDecimation]:
+    decimation = config.get_capture().get("decimation")
+    if not decimation.get("enabled"):
+        return None
+    return imageTransforms.AdaptiveDecimation(decimation.get("target_tag_size"),
+                                              decimation.get("min_scale"),
+                                              decimation.get("budget"))
+
+
+"""
+Camera reads frames of the capture device index, or replays source (a video file or an image sequence, see
+ReplayReader) as a virtual camera with this index. A replay with realtime=False is read as fast as detection takes
+frames and no frame is dropped before detection. Replays sharing replay_clock keep their recorded capture times
+apart. Frames are detected by a DataWorker of the camera, or by the shared detection_pool when one is given (and
+detection doesn't run in processes)
+"""
 
 
 class Camera:
@@ -157,27 +565,68 @@ class Camera:
                  x: int,
                  y: int,
                  angle: float,
-                 data_output: List[Queue]):
+                 data_output: List[Queue],
+                 source: Optional[str] = None,
+                 realtime: bool = True,
+                 loop: bool = False,
+                 settings: Optional[Settings] = None,
+                 detection_pool: Optional[mtl.PooledDataWorker] = None,
+                 decimation: Optional[imageTransforms.AdaptiveDecimation] = None,
+                 replay_clock: Optional[ReplayClock] = None):
         self.index = index
         self.fps = fps
         self.x = x
         self.y = y
         self.angle = angle
+        self.source = source
         self.status = "INACTIVE"
-        data_from_input = [Queue()]
-        self.settings: Settings = Settings()
-        camera_reader = CameraReader(self.index)
-        self.resolution = camera_reader.get_resolution()
-        self.data_getter = mtl.PeriodicDataGetter(data_from_input,
-                                                  camera_reader,
-                                                  self.fps)
-        self.data_worker_detect = mtl.DataWorker(data_from_input,
-                                                 data_output,
-                                                 mtl.OperationChain()
-                                                 .add_operation(
-                                                     imageTransforms
-                                                         .DetectObjectsTransform(
-                                                         self.settings)))
+        config = Config()
+        data_from_input = [mtl.DataQueue(config.get_queue_size())]
+        self.data_from_input = data_from_input
+        self.settings: Settings = settings if settings is not None else Settings()
+        if source is None:
+            # colour frames are only needed when they are rendered
+            grayscale = config.get_capture().get("grayscale") and not config.get_render().get("enabled")
+            self.camera_reader = CameraReader(self.index, config.get_frame_buffer_slots(), grayscale, decimation)
+        else:
+            self.camera_reader = ReplayReader(self.index, source, realtime, fps, loop,
+                                              ring_slots=config.get_frame_buffer_slots(), clock=replay_clock)
+        self.resolution = self.camera_reader.get_resolution()
+        if realtime:
+            self.data_getter = mtl.PeriodicDataGetter(data_from_input,
+                                                      self.camera_reader,
+                                                      self.fps,
+                                                      config.get_overflow_policy(),
+                                                      name="camera {}".format(self.index))
+        else:
+            self.data_getter = mtl.DataGetter(data_from_input,
+                                              self.camera_reader,
+                                              mtl.BLOCK,
+                                              name="camera {}".format(self.index))
+        self.detection_pool = detection_pool
+        self.detect_route: Optional[mtl.PoolRoute] = None
+        self.data_worker_detect = None
+        processes = config.get_detection_processes()
+        if detection_pool is not None and processes == 0:
+            # frames are detected by threads shared with other cameras, settings are set on the pool's transform
+            self.detect_transform = None
+            self.detect_route = mtl.PoolRoute(data_from_input[0], data_output)
+            return
+        self.detect_transform = create_detect_transform(self.settings, config, decimation)
+        operation_chain = create_detect_chain(self.detect_transform, config)
+        if processes > 0:
+            self.data_worker_detect = mtl.ProcessDataWorker(data_from_input,
+                                                            data_output,
+                                                            operation_chain,
+                                                            processes,
+                                                            overflow_policy=config.get_overflow_policy(),
+                                                            name="detect {}".format(self.index))
+        else:
+            self.data_worker_detect = mtl.DataWorker(data_from_input,
+                                                     data_output,
+                                                     operation_chain,
+                                                     overflow_policy=config.get_overflow_policy(),
+                                                     name="detect {}".format(self.index))
 
     def cals_display_points(self):
         p1 = [int(self.x), int(self.y)]
@@ -192,42 +641,201 @@ class Camera:
 
     def start(self):
         self.data_getter.start()
-        self.data_worker_detect.start()
+        if self.detect_route is not None:
+            self.detection_pool.add_route(self.detect_route)
+        else:
+            self.data_worker_detect.start()
         self.status = "ACTIVE"
 
-    def stop(self):
+    # waits up to timeout seconds for each thread to exit, frames already read are detected before the camera leaves
+    # the detection pool, frames still queued after that aren't detected and their slots are released
+    def stop(self, timeout: Optional[float] = 5.0):
         self.data_getter.stop()
-        self.data_worker_detect.stop()
+        self.data_getter.join(timeout)
+        if self.detect_route is not None:
+            self.detection_pool.remove_route(self.detect_route, timeout, drain=True)
+        else:
+            self.data_worker_detect.stop()
+            self.data_worker_detect.join(timeout)
+        try:
+            while True:
+                self.data_from_input[0].get_nowait().release()
+        except Empty:
+            pass
+        self.camera_reader.stop()
         self.status = "INACTIVE"
 
+    def update(self, fps: float, x: int, y: int, angle: float):
+        self.fps = fps
+        if isinstance(self.data_getter, mtl.PeriodicDataGetter):
+            self.data_getter.period = 1/fps
+        self.x = x
+        self.y = y
+        self.angle = angle
+
+    # detectors of thread DataWorkers are rebuilt with the new settings on the next frame, pool processes of a
+    # ProcessDataWorker keep the settings they were started with until the camera is started again
     def set_settings(self, settings: Settings):
         self.settings = settings
+        if self.detect_transform is not None:
+            self.detect_transform.settings = settings
+
+    # frames dropped because detection or the following stage could not keep up
+    def get_dropped_frames(self) -> int:
+        if self.detect_route is not None:
+            return self.data_getter.dropped + self.detect_route.dropped
+        return self.data_getter.dropped + self.data_worker_detect.dropped
 
     def to_dict(self):
         return {
             "fps": self.fps,
             "status": self.status,
             "handle point": (self.x, self.y),
-            "camera angle": self.angle
+            "camera angle": self.angle,
+            "dropped frames": self.get_dropped_frames(),
+            "capture jitter": self.data_getter.task.get_statistics().get("jitter")
+            if isinstance(self.data_getter, mtl.PeriodicDataGetter) else None,
+            "source": self.source
         }
 
     def __str__(self) -> str:
         return " FPS: {}".format(self.fps)
 
 
+class CameraDiscovery:
+    """
+    Finds capture devices with indexes below max_index. Indexes are probed in parallel, each probe opens the device
+    and reads its resolution and fps. Probes taking longer than timeout seconds are reported as unavailable and aren't
+    started again until they finish. Results are cached for ttl seconds or until invalidate(), AllCameras invalidates
+    them when cameras are added or removed. Concurrent requests share one scan
+    """
+    def __init__(self, max_index: int, timeout: float = 2.0, ttl: float = 30.0, workers: int = 8):
+        self.max_index = max_index
+        self.timeout = timeout
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="camera discovery")
+        self.lock = threading.Lock()
+        self.probes: Dict[int, Future] = {}
+        self.devices: Optional[Dict[int, Dict]] = None
+        self.scanned = 0.0
+
+    @staticmethod
+    def probe(index: int) -> Optional[Dict]:
+        """
+        @return: resolution and fps of the device, None if it can't be opened
+        """
+        capture = cv2.VideoCapture(index)
+        try:
+            if not capture.isOpened():
+                return None
+            return {"resolution": (capture.get(cv2.CAP_PROP_FRAME_WIDTH), capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                    "fps": capture.get(cv2.CAP_PROP_FPS)}
+        finally:
+            capture.release()
+
+    def scan(self, exclude: Collection[int]) -> Dict[int, Dict]:
+        for index in range(self.max_index):
+            if index not in exclude and index not in self.probes:
+                self.probes[index] = self.executor.submit(self.probe, index)
+        wait(self.probes.values(), self.timeout)
+        devices = {}
+        for index, probe in list(self.probes.items()):
+            if not probe.done():
+                continue
+            self.probes.pop(index)
+            if index in exclude:
+                continue
+            try:
+                device = probe.result()
+            except Exception as e:
+                print("Probing camera {} failed: {}".format(index, e))
+                continue
+            if device is not None:
+                devices[index] = device
+        return devices
+
+    def get_devices(self, exclude: Collection[int] = ()) -> Dict[int, Dict]:
+        """
+        @param exclude: indexes of devices in use, they aren't opened
+        @return: resolution and fps of available devices by index
+        """
+        with self.lock:
+            if self.devices is None or time.monotonic() - self.scanned > self.ttl:
+                self.devices = self.scan(exclude)
+                self.scanned = time.monotonic()
+            return {index: device for index, device in self.devices.items() if index not in exclude}
+
+    def invalidate(self):
+        with self.lock:
+            self.devices = None
+
+
 class AllCameras:
     def __init__(self):
         self.all_cameras: Dict[int, Camera] = {}
         self.indexes: List[int] = []
         self.data_output: List[Queue] = []
         self.camera_data = {}
+        config = Config()
+        self.coverage = CameraCoverage(self.camera_data, config.get_window_size(),
+                                       config.get_camera_coverage().get("cell_size"))
+        discovery = config.get_camera_discovery()
+        self.discovery = CameraDiscovery(config.get_max_search_index(), discovery.get("timeout"),
+                                         discovery.get("ttl"), discovery.get("workers"))
+        self.lock = threading.Lock()
+        self.settings_store = SettingsStore(config)
+        self.settings_store.add_listener(self.set_settings)
+        # shared by capture and detection of all cameras, scales are kept per camera
+        self.decimation = create_decimation(config)
+        # replayed cameras are one recording, their frames are synchronized by the recorded capture times
+        self.replay_clock = ReplayClock()
+        self.detection_pool: Optional[mtl.PooledDataWorker] = None
+        self.pool_transform: Optional[imageTransforms.DetectObjectsTransform] = None
+        pool = config.get_detection_pool()
+        if pool.get("enabled") and config.get_detection_processes() == 0:
+            self.pool_transform = create_detect_transform(self.settings_store.get(), config, self.decimation)
+            self.detection_pool = mtl.PooledDataWorker(create_detect_chain(self.pool_transform, config),
+                                                       pool.get("threads"),
+                                                       pool.get("batch_size"),
+                                                       overflow_policy=config.get_overflow_policy(),
+                                                       name="detect")
+
+    def add_camera(self, index: int, fps: float, x: int, y: int, angle: float, source: Optional[str] = None,
+                   realtime: bool = True, loop: bool = False):
+        with self.lock:
+            if index in self.all_cameras:
+                raise Exception("camera {} already exists".format(index))
+        output_object: Queue = mtl.DataQueue(Config().get_queue_size())
+        # opening the device is slow, other cameras aren't held up by it
+        camera = Camera(index, fps, x, y, angle, [output_object], source, realtime, loop,
+                        self.settings_store.get(), self.detection_pool, self.decimation, self.replay_clock)
+        with self.lock:
+            if index in self.all_cameras:
+                # added by another thread while this one was opening the device
+                camera.camera_reader.stop()
+                raise Exception("camera {} already exists".format(index))
+            self.data_output.append(output_object)
+            self.all_cameras[index] = camera
+            self.indexes.append(index)
+            self.camera_data[index] = x, y, angle, camera.resolution, camera.cals_display_points()
+            # settings may have changed while the camera was built
+            camera.set_settings(self.settings_store.get())
+        self.coverage.refresh()
+        self.discovery.invalidate()
 
-    def add_camera(self, index: int, fps: float, x: int, y: int, angle: float):
-        output_object: Queue = Queue()
-        self.data_output.append(output_object)
-        self.all_cameras[index] = Camera(index, fps, x, y, angle, [output_object])
-        self.indexes.append(index)
-        self.camera_data[index] = x, y, angle, self.all_cameras.get(index).resolution, self.all_cameras.get(index).cals_display_points()
+    def update_camera(self, index: int, fps: float, x: int, y: int, angle: float):
+        camera = self.all_cameras[index]
+        with self.lock:
+            camera.update(fps, x, y, angle)
+            self.camera_data[index] = x, y, angle, camera.resolution, camera.cals_display_points()
+        self.coverage.refresh()
+
+    def set_settings(self, settings: Settings):
+        with self.lock:
+            if self.pool_transform is not None:
+                self.pool_transform.settings = settings
+            for camera in self.all_cameras.values():
+                camera.set_settings(settings)
 
     def start_camera(self, index: int):
         self.all_cameras[index].start()
@@ -251,4 +859,77 @@ class AllCameras:
 
     def remove_camera(self, index: int):
         self.stop_camera(index)
-        self.all_cameras.pop(index)
+        with self.lock:
+            self.all_cameras.pop(index)
+            self.camera_data.pop(index, None)
+            # queues of data_output follow the order of indexes, stages reading them follow the list
+            position = self.indexes.index(index)
+            self.indexes.pop(position)
+            self.data_output.pop(position)
+        self.coverage.refresh()
+        self.discovery.invalidate()
+
+
+class CameraJobs:
+    """
+    Runs camera lifecycle operations (create, start, stop, update) as background jobs, so HTTP requests only submit
+    them. At most workers jobs run at once. Jobs of one camera run one at a time in order of submission, a slow job
+    of one camera only occupies one worker and never touches frames of other cameras. Statuses are PENDING, RUNNING,
+    DONE and FAILED, the last history jobs are kept
+    """
+    def __init__(self, workers: int = 2, history: int = 100):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="camera jobs")
+        self.history = history
+        self.lock = threading.Lock()
+        self.jobs: OrderedDict[int, Dict] = OrderedDict()
+        self.queued: Dict[int, deque] = {}
+        self.ids = itertools.count(1)
+
+    def submit(self, operation: str, index: int, function: Callable, *args) -> Dict:
+        """
+        @param operation: name of the operation shown in the job status
+        @param index: camera the job operates on
+        @param function: called with args by the job
+        @return: status of the submitted job
+        """
+        with self.lock:
+            job = {"id": next(self.ids), "operation": operation, "camera": index, "status": "PENDING",
+                   "error": None, "submitted": time.time(), "finished": None}
+            self.jobs[job["id"]] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+            if index in self.queued:
+                # the camera's runner takes it after the running job
+                self.queued[index].append((job, function, args))
+            else:
+                self.queued[index] = deque([(job, function, args)])
+                self.executor.submit(self.run_camera_jobs, index)
+            return dict(job)
+
+    def run_camera_jobs(self, index: int):
+        while True:
+            with self.lock:
+                if not self.queued[index]:
+                    self.queued.pop(index)
+                    return
+                job, function, args = self.queued[index].popleft()
+                job["status"] = "RUNNING"
+            try:
+                function(*args)
+                status, error = "DONE", None
+            except Exception as e:
+                print("Job {} of camera {} failed: {}".format(job["operation"], index, e))
+                status, error = "FAILED", str(e)
+            with self.lock:
+                job["status"] = status
+                job["error"] = error
+                job["finished"] = time.time()
+
+    def get_job(self, job_id: int) -> Optional[Dict]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def get_jobs(self) -> List[Dict]:
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
@@ -1,5 +1,12 @@
+import copy
+import functools
+import os
+import threading
+import time
+import weakref
 from datetime import datetime
-from typing import Tuple, List, Dict
+from multiprocessing import shared_memory
+from typing import Tuple, List, Dict, Optional
 
 import numpy as np
 import yaml
@@ -8,6 +15,8 @@ import yaml
 def singleton(cls):
     instances = {}
 
+    # the class stays reachable as __wrapped__, to create instances other than the shared one
+    @functools.wraps(cls, updated=())
     def wrapper(*args, **kwargs):
         if cls not in instances:
             instances[cls] = cls(*args, **kwargs)
@@ -16,11 +25,68 @@ def singleton(cls):
     return wrapper
 
 
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "resources", "config.yml")
+# top level entries read without a default
+REQUIRED_CONFIG_KEYS = ("tag_family", "objects", "max_search_index", "field_of_detection")
+
+
+def check_config(cfg) -> Optional[str]:
+    """
+    @return: what's wrong with the loaded yaml, None if it can be used as config
+    """
+    if not isinstance(cfg, dict):
+        return "not a mapping"
+    missing = [key for key in REQUIRED_CONFIG_KEYS if key not in cfg]
+    if missing:
+        return "missing {}".format(", ".join(missing))
+    objects = cfg.get("objects")
+    if not isinstance(objects, dict) or not all(isinstance(tag, dict) and "tag_id" in tag for tag in objects.values()):
+        return "objects must map object indexes to entries with a tag_id"
+    return None
+
+
+"""
+Config is read from CONFIG_PATH, independent of the working directory. reload() and update() build a new dict and
+swap it in one assignment, so readers never see a half updated config. version grows with every change. A file that
+fails check_config (e.g. empty or half written) is rejected by reload() with a ValueError, the old config is kept
+"""
+
+
 @singleton
 class Config:
-    def __init__(self):
-        with open("src/resources/config.yml", "r") as ymlfile:
-            self.cfg: dict = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    def __init__(self, path: str = CONFIG_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.version = 0
+        self.mtime = 0.0
+        self.reload()
+
+    def reload(self):
+        with self.lock:
+            # a rejected file isn't read again until it changes
+            self.mtime = os.path.getmtime(self.path)
+            with open(self.path, "r") as ymlfile:
+                cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+            error = check_config(cfg)
+            if error is not None:
+                raise ValueError("invalid config {}: {}".format(self.path, error))
+            self.cfg: dict = cfg
+            self.version += 1
+
+    # @return: True if the file changed since it was read and was read again
+    def reload_if_changed(self) -> bool:
+        if os.path.getmtime(self.path) == self.mtime:
+            return False
+        self.reload()
+        return True
+
+    # values replace top level entries until the file changes, they aren't written to it
+    def update(self, values: dict):
+        with self.lock:
+            cfg = copy.deepcopy(self.cfg)
+            cfg.update(values)
+            self.cfg = cfg
+            self.version += 1
 
     def get_camera_indexes(self) -> List[int]:
         return list(self.cfg.get("cameras").keys())
@@ -28,21 +94,273 @@ class Config:
     def get_max_search_index(self) -> int:
         return int(self.cfg.get("max_search_index"))
 
+    def get_camera_discovery(self) -> Dict:
+        discovery = {"timeout": 2.0, "ttl": 30.0, "workers": 8}
+        discovery.update(self.cfg.get("camera_discovery", {}))
+        return discovery
+
+    def get_pose(self) -> Dict:
+        pose = {"enabled": False, "tag_size": 0.1, "refine_corners": True, "intrinsics": {}}
+        pose.update(self.cfg.get("pose", {}))
+        return pose
+
+    def get_capture(self) -> Dict:
+        capture = {"grayscale": True}
+        capture.update(self.cfg.get("capture", {}))
+        decimation = {"enabled": True, "target_tag_size": 24, "min_scale": 0.25, "budget": 0.02}
+        decimation.update(capture.get("decimation", {}))
+        capture["decimation"] = decimation
+        return capture
+
+    def get_detection_pool(self) -> Dict:
+        detection_pool = {"enabled": True, "threads": 0, "batch_size": 8}
+        detection_pool.update(self.cfg.get("detection_pool", {}))
+        return detection_pool
+
+    def get_camera_jobs(self) -> Dict:
+        camera_jobs = {"workers": 2, "history": 100}
+        camera_jobs.update(self.cfg.get("camera_jobs", {}))
+        return camera_jobs
+
     def get_objects(self) -> Dict[int, Dict]:
         return self.cfg.get("objects")
 
     def get_window_size(self) -> Tuple[int, int]:
         return self.cfg.get("field_of_detection").get("x"), self.cfg.get("field_of_detection").get("y")
 
+    def get_config_reload_interval(self) -> float:
+        return float(self.cfg.get("config_reload_interval", 1.0))
+
     def get_tag_family(self) -> str:
         return self.cfg.get("tag_family")
 
+    def get_detection_processes(self) -> int:
+        return int(self.cfg.get("detection_processes", 0))
+
+    def get_frame_buffer_slots(self) -> int:
+        return int(self.cfg.get("frame_buffer_slots", 16))
+
+    def get_scheduler_workers(self) -> int:
+        return int(self.cfg.get("scheduler_workers", 16))
+
+    def get_queue_size(self) -> int:
+        return int(self.cfg.get("queues", {}).get("size", 0))
+
+    def get_overflow_policy(self) -> str:
+        return self.cfg.get("queues", {}).get("overflow_policy", "block")
+
+    def get_metrics_enabled(self) -> bool:
+        return bool(self.cfg.get("metrics", {}).get("enabled", False))
+
+    def get_synchronization(self) -> Dict:
+        synchronization = {"enabled": False, "tolerance": 0.02, "mode": "nearest", "max_delay": 0.5}
+        synchronization.update(self.cfg.get("synchronization", {}))
+        return synchronization
+
+    def get_render(self) -> Dict:
+        render = {"enabled": True, "fps": 15, "windows": True, "stream": True, "stream_quality": 80}
+        render.update(self.cfg.get("render", {}))
+        return render
+
+    def get_camera_coverage(self) -> Dict:
+        camera_coverage = {"cell_size": 20}
+        camera_coverage.update(self.cfg.get("camera_coverage", {}))
+        return camera_coverage
+
+    def get_object_tracking(self) -> Dict:
+        object_tracking = {"enabled": True, "alpha": 0.5, "beta": 0.1, "max_age": 0.5, "rate": 60}
+        object_tracking.update(self.cfg.get("object_tracking", {}))
+        return object_tracking
+
+    def get_pose_feed(self) -> Dict:
+        pose_feed = {"buffer_size": 256}
+        pose_feed.update(self.cfg.get("pose_feed", {}))
+        return pose_feed
+
+    def get_detection_log(self) -> Dict:
+        detection_log = {"enabled": False, "directory": "detections", "segment_records": 4000000,
+                         "segment_seconds": 3600, "fsync_interval": 1.0}
+        detection_log.update(self.cfg.get("detection_log", {}))
+        return detection_log
+
+    def get_tracking(self) -> Dict:
+        tracking = {"enabled": False, "full_scan_interval": 30, "roi_padding": 0.5}
+        tracking.update(self.cfg.get("tracking", {}))
+        return tracking
+
+
+# shared memory blocks attached by this process and FrameRings created by it, by memory name. Both only hold weak
+# references: a block stays attached while slots map it, a ring lives while its owner or a slot holds it
+_attached_memory: "weakref.WeakValueDictionary[str, shared_memory.SharedMemory]" = weakref.WeakValueDictionary()
+_rings: "weakref.WeakValueDictionary[str, FrameRing]" = weakref.WeakValueDictionary()
+
+
+def _attach_memory(name: str) -> shared_memory.SharedMemory:
+    memory = _attached_memory.get(name)
+    if memory is None:
+        memory = shared_memory.SharedMemory(name=name)
+        _attached_memory[name] = memory
+    return memory
+
+
+def _free_memory(memory: shared_memory.SharedMemory):
+    try:
+        memory.close()
+    except BufferError:
+        # arrays still map the block, it's freed when the last of them is gone
+        pass
+    memory.unlink()
+
+
+def _restore_slot(memory_name: str, index: int, shape: Tuple[int, ...], dtype: str) -> "FrameSlot":
+    ring = _rings.get(memory_name)
+    if ring is not None:
+        return ring.get_slot(index)
+    return FrameSlot(memory_name, index, shape, dtype)
+
+
+class FrameSlot:
+    """
+    Handle of a single frame stored in a FrameRing. Only the handle is pickled, a process that unpickles it gets an
+    array mapped onto the same shared memory. References are counted only in the process owning the ring
+    """
+    def __init__(self, memory_name: str, index: int, shape: Tuple[int, ...], dtype: str,
+                 array: Optional[np.ndarray] = None, ring: Optional["FrameRing"] = None):
+        self.memory_name = memory_name
+        self.index = index
+        self.shape = shape
+        self.dtype = dtype
+        self.array = array
+        self.ring = ring
+        self.memory: Optional[shared_memory.SharedMemory] = None
+
+    def get_array(self) -> np.ndarray:
+        if self.array is None:
+            # the slot keeps the attached block alive as long as its array is used
+            self.memory = _attach_memory(self.memory_name)
+            slot_size = int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+            self.array = np.ndarray(self.shape, self.dtype, buffer=self.memory.buf, offset=self.index * slot_size)
+        return self.array
+
+    def retain(self):
+        if self.ring is not None:
+            self.ring.retain(self.index)
+
+    def release(self):
+        if self.ring is not None:
+            self.ring.release(self.index)
+
+    def __reduce__(self):
+        return _restore_slot, (self.memory_name, self.index, self.shape, self.dtype)
+
+
+class FrameRing:
+    """
+    Preallocated ring of equally shaped frame slots kept in one shared memory block. A slot is reused only when no
+    FrameObject references it anymore, acquire() returns None when all slots are in use. The owner retires the ring
+    when it stops, the block is then unlinked as soon as all slots are released. A ring that is dropped without
+    being retired is unlinked when it's garbage collected or at exit
+    """
+    def __init__(self, shape: Tuple[int, ...], dtype: str = "uint8", slots: int = 16):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self.slots = slots
+        slot_size = int(np.prod(self.shape)) * np.dtype(dtype).itemsize
+        self.memory = shared_memory.SharedMemory(create=True, size=slot_size * slots)
+        _attached_memory[self.memory.name] = self.memory
+        _rings[self.memory.name] = self
+        self.array = np.ndarray((slots, *self.shape), self.dtype, buffer=self.memory.buf)
+        self.references: List[int] = [0] * slots
+        self.next_slot = 0
+        self.retired = False
+        self.lock = threading.Lock()
+        self.finalizer = weakref.finalize(self, _free_memory, self.memory)
+
+    def get_slot(self, index: int) -> FrameSlot:
+        return FrameSlot(self.memory.name, index, self.shape, self.dtype, self.array[index], self)
+
+    def acquire(self) -> Optional[FrameSlot]:
+        """
+        Finds the next free slot and gives the caller a reference to it, the caller has to release() it
+        @return: acquired slot or None if all slots are referenced
+        """
+        with self.lock:
+            if self.retired:
+                return None
+            for offset in range(self.slots):
+                index = (self.next_slot + offset) % self.slots
+                if self.references[index] == 0:
+                    self.references[index] = 1
+                    self.next_slot = (index + 1) % self.slots
+                    return self.get_slot(index)
+        return None
+
+    def retain(self, index: int):
+        with self.lock:
+            self.references[index] += 1
+
+    def release(self, index: int):
+        with self.lock:
+            self.references[index] -= 1
+            unused = self.retired and not any(self.references)
+        if unused:
+            self.close()
+
+    def retire(self):
+        """
+        No slots are acquired anymore, the ring is closed once frames in the pipeline released all of them
+        """
+        with self.lock:
+            self.retired = True
+            unused = not any(self.references)
+        if unused:
+            self.close()
+
+    def free_slots(self) -> int:
+        return self.references.count(0)
+
+    def share(self, frame_object: "FrameObject") -> "FrameObject":
+        """
+        Copies the frame of frame_object into a free slot, the frame is then passed to other processes by its slot
+        @param frame_object: FrameObject with a frame of the ring's shape
+        @return: the same FrameObject, with its frame stored in the ring if a slot was free
+        """
+        slot = self.acquire()
+        if slot is None:
+            return frame_object
+        np.copyto(slot.get_array(), frame_object.get_frame())
+        frame_object.release()
+        frame_object.frame = slot.get_array()
+        frame_object.slot = slot
+        frame_object.released = False
+        return frame_object
+
+    def close(self):
+        self.retired = True
+        self.array = None
+        _rings.pop(self.memory.name, None)
+        _attached_memory.pop(self.memory.name, None)
+        self.finalizer()
+
 
 class FrameObject:
-    def __init__(self, frame: np.ndarray, camera_index: int):
+    """
+    A frame captured by a camera. If the frame is kept in a FrameRing, the FrameObject holds a reference to its
+    slot, which is released by release() or when the object is garbage collected. timestamp is the wall clock time of
+    creation, capture_time the monotonic clock time of capture, kept by objects derived from the frame. scale is the
+    factor the frame was downscaled by when it was captured, detections are mapped back to full resolution
+    """
+    def __init__(self, frame: np.ndarray, camera_index: int, slot: Optional[FrameSlot] = None,
+                 capture_time: Optional[float] = None, scale: float = 1.0):
         self.frame: np.ndarray = frame
+        self.scale = scale
         self.timestamp: float = datetime.now().timestamp()
+        self.capture_time: float = time.monotonic() if capture_time is None else capture_time
         self.camera_index: int = camera_index
+        self.slot: Optional[FrameSlot] = slot
+        self.released = False
+        if slot is not None:
+            slot.retain()
 
     def get_frame(self) -> np.ndarray:
         return self.frame
@@ -50,16 +368,210 @@ class FrameObject:
     def get_index(self) -> int:
         return self.camera_index
 
+    def release(self):
+        if self.slot is not None and not self.released:
+            self.released = True
+            self.slot.release()
+
+    # a frame kept in a FrameRing is pickled as its slot handle, not as an array
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        if self.slot is not None:
+            state["frame"] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        if self.slot is not None:
+            self.frame = self.slot.get_array()
+            self.released = False
+            self.slot.retain()
+
+    def __del__(self):
+        self.release()
+
+
+# one detected tag: index of its object, tag id, pixel center and corners, rotation in the frame and world pose
+# (x, y, rot), NaN until the detection is fused. translation (x, y, z) and orientation (quaternion w, x, y, z) are the
+# 6-DoF pose of the tag in the camera frame, NaN unless estimated by EstimatePosesTransform
+DETECTION_DTYPE = np.dtype([("object", "<i4"), ("tag", "<i4"), ("center", "<f4", (2,)), ("corners", "<f4", (4, 2)),
+                            ("rot", "<f4"), ("world", "<f4", (3,)), ("translation", "<f4", (3,)),
+                            ("orientation", "<f4", (4,))])
+
+
+def detections_from_dicts(centers: Dict[int, Tuple[float, float]], rots: Dict) -> np.ndarray:
+    """
+    @return: detections of objects with the given centers and rotations, without tag ids and corners
+    """
+    detections = np.zeros(len(centers), DETECTION_DTYPE)
+    detections["tag"] = -1
+    detections["world"] = np.nan
+    detections["translation"] = np.nan
+    detections["orientation"] = np.nan
+    if centers:
+        detections["object"] = list(centers.keys())
+        detections["center"] = list(centers.values())
+        detections["rot"] = [rots.get(index, np.nan) for index in centers.keys()]
+    return detections
+
+
+class Detections:
+    """
+    Accessors of detections kept in a DETECTION_DTYPE array, centers and rots build dictionaries by object index
+    for code using the former representation
+    """
+    __slots__ = ()
+
+    @property
+    def indexes(self) -> List[int]:
+        return self.detections["object"].tolist()
+
+    @property
+    def centers(self) -> Dict[int, Tuple[float, float]]:
+        return {index: (x, y) for index, (x, y) in zip(self.detections["object"].tolist(),
+                                                       self.detections["center"].tolist())}
+
+    @property
+    def rots(self) -> Dict[int, float]:
+        return dict(zip(self.detections["object"].tolist(), self.detections["rot"].tolist()))
+
+    def find(self, index: int) -> Optional[np.void]:
+        rows = np.flatnonzero(self.detections["object"] == index)
+        return self.detections[rows[-1]] if len(rows) else None
+
+    def get_center(self, index) -> Optional[Tuple[float, float]]:
+        detection = self.find(index)
+        return None if detection is None else tuple(detection["center"].tolist())
+
+    def get_rotation(self, index) -> Optional[float]:
+        detection = self.find(index)
+        return None if detection is None else float(detection["rot"])
+
+
+class DetectionBatch(Detections):
+    """
+    Detections of one frame without the frame, sent downstream when frames are no longer needed, so the frame (and
+    its FrameRing slot) can be reused as soon as detection is finished
+    """
+    __slots__ = ("camera_index", "timestamp", "capture_time", "detections")
+
+    def __init__(self, camera_index: int, detections: np.ndarray, timestamp: float, capture_time: float):
+        self.camera_index = camera_index
+        self.detections = detections
+        self.timestamp = timestamp
+        self.capture_time = capture_time
+
+    def get_index(self) -> int:
+        return self.camera_index
+
+    def with_detections(self, detections: np.ndarray, capture_time: float) -> "DetectionBatch":
+        return DetectionBatch(self.camera_index, detections, self.timestamp, capture_time)
+
+    def release(self):
+        pass
 
-class FrameObjectWithDetectedObjects(FrameObject):
-    def __init__(self, frame: np.ndarray, camera_index: int, centers: Dict[int, Tuple[int, int]], rots: Dict):
-        super(FrameObjectWithDetectedObjects, self).__init__(frame, camera_index)
-        self.centers = centers
+
+class FrameObjectWithDetectedObjects(FrameObject, Detections):
+    """
+    A frame with its detections. They are given either as a DETECTION_DTYPE array or, as before, as dictionaries
+    of centers and rotations by object index
+    """
+    def __init__(self, frame: np.ndarray, camera_index: int, centers: Optional[Dict[int, Tuple[int, int]]] = None,
+                 rots: Optional[Dict] = None, slot: Optional[FrameSlot] = None, capture_time: Optional[float] = None,
+                 detections: Optional[np.ndarray] = None, scale: float = 1.0):
+        super(FrameObjectWithDetectedObjects, self).__init__(frame, camera_index, slot, capture_time, scale)
+        self.detections: np.ndarray = detections if detections is not None else \
+            detections_from_dicts(centers or {}, rots or {})
+
+    def with_detections(self, detections: np.ndarray, capture_time: float) -> "FrameObjectWithDetectedObjects":
+        return FrameObjectWithDetectedObjects(self.get_frame(), self.camera_index, slot=self.slot,
+                                              capture_time=capture_time, detections=detections, scale=self.scale)
+
+    def to_batch(self) -> DetectionBatch:
+        return DetectionBatch(self.camera_index, self.detections, self.timestamp, self.capture_time)
+
+
+def interpolate_detections(before: Detections, after: Detections, capture_time: float) -> Detections:
+    """
+    Linearly interpolates centers, corners and rotations of objects detected in both frames (or DetectionBatches) of
+    one camera, objects detected in only one of them are taken from the one nearer to capture_time, as is the frame
+    """
+    span = after.capture_time - before.capture_time
+    weight = (capture_time - before.capture_time) / span if span > 0 else 1.0
+    nearer = after if weight >= 0.5 else before
+    detections = nearer.detections.copy()
+    common, before_rows, after_rows = np.intersect1d(before.detections["object"], after.detections["object"],
+                                                     return_indices=True)
+    rows = np.intersect1d(detections["object"], common, return_indices=True)[1]
+    first = before.detections[before_rows]
+    last = after.detections[after_rows]
+    detections["center"][rows] = first["center"] + (last["center"] - first["center"]) * weight
+    detections["corners"][rows] = first["corners"] + (last["corners"] - first["corners"]) * weight
+    rot_change = np.mod(last["rot"] - first["rot"] + np.pi, 2 * np.pi) - np.pi
+    detections["rot"][rows] = np.mod(first["rot"] + rot_change * weight, 2 * np.pi)
+    return nearer.with_detections(detections, capture_time)
+
+
+class FusedObjects:
+    """
+    Object poses fused from all cameras. Arrays are indexed by the order of object_indexes and camera_indexes:
+    positions (objects x 2) and rots (objects) are world poses, visible marks objects seen by at least one camera,
+    camera_poses (cameras x objects x 3) hold x, y, rot of each object in world coordinates as seen by each camera
+    and camera_pixels the same in pixel coordinates of the camera, NaN where the camera doesn't see the object.
+    camera_offsets (cameras x 2) and camera_angles (cameras) place cameras in the world. frames are the detected
+    frames (or DetectionBatches) fused in this update, by camera index, capture_time is the capture time of the oldest
+    of them
+    """
+    def __init__(self,
+                 object_indexes: List[int],
+                 camera_indexes: List[int],
+                 positions: np.ndarray,
+                 rots: np.ndarray,
+                 visible: np.ndarray,
+                 camera_poses: np.ndarray,
+                 camera_pixels: np.ndarray,
+                 camera_offsets: np.ndarray,
+                 camera_angles: np.ndarray,
+                 frames: Dict[int, Detections]):
+        self.object_indexes = object_indexes
+        self.camera_indexes = camera_indexes
+        self.positions = positions
         self.rots = rots
-        self.indexes = centers.keys()
+        self.visible = visible
+        self.camera_poses = camera_poses
+        self.camera_pixels = camera_pixels
+        self.camera_offsets = camera_offsets
+        self.camera_angles = camera_angles
+        self.frames = frames
+        self.timestamp: float = datetime.now().timestamp()
+        self.capture_time: Optional[float] = min((frame.capture_time for frame in frames.values()), default=None)
+
+    def to_camera(self) -> np.ndarray:
+        """
+        @return: (cameras x objects x 2) array of fused positions in pixel coordinates of each camera
+        """
+        cosine = np.cos(self.camera_angles)[:, None]
+        sine = np.sin(self.camera_angles)[:, None]
+        x = self.positions[None, :, 0] - self.camera_offsets[:, None, 0]
+        y = self.positions[None, :, 1] - self.camera_offsets[:, None, 1]
+        return np.stack([x * cosine + y * sine, y * cosine - x * sine], axis=-1)
+
+    def get_position(self, index: int) -> Optional[Tuple[float, float]]:
+        column = self.object_indexes.index(index)
+        if not self.visible[column]:
+            return None
+        return float(self.positions[column, 0]), float(self.positions[column, 1])
 
-    def get_center(self, index) -> Tuple[int, int]:
-        return self.centers.get(index)
+    def get_rotation(self, index: int) -> Optional[float]:
+        column = self.object_indexes.index(index)
+        if not self.visible[column]:
+            return None
+        return float(self.rots[column])
 
-    def get_rotation(self, index):
-        return self.rots.get(index)
+    def to_poses(self) -> List[Dict]:
+        """
+        @return: poses of visible objects as dicts of id, x, y, rot and timestamp
+        """
+        return [{"id": int(self.object_indexes[column]), "x": float(self.positions[column, 0]),
+                 "y": float(self.positions[column, 1]), "rot": float(self.rots[column]), "timestamp": self.timestamp}
+                for column in np.nonzero(self.visible)[0]]
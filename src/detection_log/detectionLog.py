@@ -0,0 +1,174 @@
+import glob
+import os
+import time
+from typing import List, Optional, BinaryIO
+
+import numpy as np
+
+import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
+from src.data_model.dataModel import FusedObjects
+
+# one detected pose, x and y are world coordinates
+RECORD_DTYPE = np.dtype([("timestamp", "<f8"), ("camera", "<i4"), ("object", "<i4"),
+                         ("x", "<f4"), ("y", "<f4"), ("rot", "<f4")])
+# camera of records holding fused poses
+FUSED_CAMERA = -1
+SEGMENT_SUFFIX = ".detections"
+
+
+def fused_to_records(fused: FusedObjects) -> np.ndarray:
+    """
+    @return: records of fused poses of visible objects and poses seen by each camera fused in this update, all with
+        the time of the fusion
+    """
+    objects = np.asarray(fused.object_indexes, np.int32)
+    cameras = np.asarray(fused.camera_indexes, np.int32)
+    rows = np.array([row for row, camera_index in enumerate(fused.camera_indexes) if camera_index in fused.frames],
+                    np.intp)
+    poses = fused.camera_poses[rows]
+    camera_rows, object_columns = np.nonzero(~np.isnan(poses[:, :, 0]))
+    visible = np.nonzero(fused.visible)[0]
+    records = np.empty(len(visible) + len(camera_rows), RECORD_DTYPE)
+    records["timestamp"] = fused.timestamp
+    fused_records = records[:len(visible)]
+    fused_records["camera"] = FUSED_CAMERA
+    fused_records["object"] = objects[visible]
+    fused_records["x"] = fused.positions[visible, 0]
+    fused_records["y"] = fused.positions[visible, 1]
+    fused_records["rot"] = fused.rots[visible]
+    camera_records = records[len(visible):]
+    camera_records["camera"] = cameras[rows[camera_rows]]
+    camera_records["object"] = objects[object_columns]
+    camera_records["x"] = poses[camera_rows, object_columns, 0]
+    camera_records["y"] = poses[camera_rows, object_columns, 1]
+    camera_records["rot"] = poses[camera_rows, object_columns, 2]
+    return records
+
+
+def list_segments(directory: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(directory, "*" + SEGMENT_SUFFIX)))
+
+
+class DetectionLogWriter:
+    """
+    Appends records to segment files of a log directory. Segments are raw arrays of RECORD_DTYPE records numbered in
+    order of writing, a new one is started when the current one has segment_records records or is older than
+    segment_seconds, so old segments can be archived or deleted while the log grows. Appended records are flushed
+    and synced to disk by the first append fsync_interval seconds after the last sync, and by close(). Existing
+    segments are never modified
+    """
+    def __init__(self, directory: str, segment_records: int = 4_000_000, segment_seconds: float = 3600,
+                 fsync_interval: float = 1.0):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.segment_seconds = segment_seconds
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        segments = list_segments(directory)
+        self.sequence = int(os.path.basename(segments[-1])[:-len(SEGMENT_SUFFIX)]) if segments else 0
+        self.file: Optional[BinaryIO] = None
+        self.records = 0
+        self.opened = 0.0
+        self.synced = 0.0
+
+    def open_segment(self):
+        self.close()
+        self.sequence += 1
+        path = os.path.join(self.directory, "{:08d}{}".format(self.sequence, SEGMENT_SUFFIX))
+        self.file = open(path, "xb")
+        self.records = 0
+        self.opened = time.monotonic()
+        self.synced = self.opened
+
+    def append(self, records: np.ndarray):
+        now = time.monotonic()
+        if self.file is None or self.records >= self.segment_records or now - self.opened >= self.segment_seconds:
+            self.open_segment()
+        self.file.write(np.ascontiguousarray(records, RECORD_DTYPE).tobytes())
+        self.records += len(records)
+        if now - self.synced >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced = time.monotonic()
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+
+class DetectionLogSink(mtl.SinkParent):
+    """
+    Writes FusedObjects (or lists of them) to a DetectionLogWriter
+    """
+    def __init__(self, writer: DetectionLogWriter):
+        super().__init__()
+        self.writer = writer
+
+    def sink_data(self, input_object: list):
+        records = [fused_to_records(fused) for fused in _flatten(input_object) if isinstance(fused, FusedObjects)]
+        if records:
+            self.writer.append(np.concatenate(records))
+
+    def stop(self):
+        self.writer.close()
+
+
+def _flatten(input_object: list) -> list:
+    flat = []
+    for element in input_object:
+        if isinstance(element, list):
+            flat.extend(_flatten(element))
+        else:
+            flat.append(element)
+    return flat
+
+
+class DetectionLogReader:
+    """
+    Reads records of a log directory through memory maps, so only pages holding the requested records are loaded.
+    Records are written in order of time, time ranges are found by binary search on timestamps. A record cut off by
+    a crash at the end of a segment is ignored
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def get_segment(self, path: str) -> np.ndarray:
+        records = os.path.getsize(path) // RECORD_DTYPE.itemsize
+        if records == 0:
+            return np.zeros(0, RECORD_DTYPE)
+        return np.memmap(path, RECORD_DTYPE, "r", shape=(records,))
+
+    def read(self,
+             start: Optional[float] = None,
+             end: Optional[float] = None,
+             object_index: Optional[int] = None,
+             camera: Optional[int] = None) -> np.ndarray:
+        """
+        @param start: first timestamp to read, inclusive
+        @param end: last timestamp to read, exclusive
+        @param object_index: only records of this object
+        @param camera: only records of this camera, FUSED_CAMERA for fused poses
+        @return: copy of the matching records
+        """
+        selected = []
+        for path in list_segments(self.directory):
+            segment = self.get_segment(path)
+            if len(segment) == 0 or (start is not None and segment[-1]["timestamp"] < start) or \
+                    (end is not None and segment[0]["timestamp"] >= end):
+                continue
+            timestamps = segment["timestamp"]
+            first = np.searchsorted(timestamps, start, "left") if start is not None else 0
+            last = np.searchsorted(timestamps, end, "left") if end is not None else len(segment)
+            records = segment[first:last]
+            if object_index is not None:
+                records = records[records["object"] == object_index]
+            if camera is not None:
+                records = records[records["camera"] == camera]
+            selected.append(np.array(records))
+        return np.concatenate(selected) if selected else np.zeros(0, RECORD_DTYPE)
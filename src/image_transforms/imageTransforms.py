@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from typing import List, Dict
+import threading
+import time
+from typing import List, Dict, Optional, Union, TYPE_CHECKING
 from typing import Tuple
 
 import apriltag
@@ -8,34 +10,255 @@ import cv2
 import numpy as np
 
 import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
-from src.camera_io.cameraIO import Settings
+from src.data_model.dataModel import DETECTION_DTYPE
+from src.data_model.dataModel import DetectionBatch
 from src.data_model.dataModel import FrameObject
 from src.data_model.dataModel import FrameObjectWithDetectedObjects
 
+if TYPE_CHECKING:
+    # cameraIO imports this module
+    from src.camera_io.cameraIO import Settings
+
+
+def to_gray(frame: np.ndarray) -> np.ndarray:
+    if frame.ndim == 2:
+        return np.ascontiguousarray(frame)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+def downscale_gray(frame: np.ndarray, scale: float, gray: Optional[np.ndarray] = None,
+                   out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    @param frame: BGR or grayscale frame
+    @param scale: factor of the downscale, 1 only converts to grayscale
+    @param gray: optional buffer of the full resolution grayscale frame, used when the frame is downscaled
+    @param out: optional buffer of the result, of the downscaled shape
+    @return: grayscale frame downscaled by scale
+    """
+    if scale == 1.0:
+        if frame.ndim == 2:
+            if out is None:
+                return np.ascontiguousarray(frame)
+            np.copyto(out, frame)
+            return out
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=out)
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+    height, width = frame.shape[:2]
+    return cv2.resize(frame, get_scaled_size(width, height, scale), dst=out, interpolation=cv2.INTER_AREA)
+
+
+def image_rotation(corners: np.ndarray) -> np.ndarray:
+    """
+    @param corners: (tags x 4 x 2) corners of tags
+    @return: angles of the tags' left edges (from their first to their last corner) to the vertical axis of the frame
+    """
+    edge = corners[:, 0] - corners[:, 3]
+    rots = np.arccos(edge[:, 1] / np.hypot(edge[:, 0], edge[:, 1]))
+    return np.where(edge[:, 0] > 0, 2 * np.pi - rots, rots)
+
+
+def get_scaled_size(width: int, height: int, scale: float) -> tuple:
+    return max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)
+
+
+class AdaptiveDecimation:
+    """
+    Chooses the scale at which frames of each camera are detected, like quad_decimate of apriltag but from the frames
+    themselves. Scales are 1/n: n is the number of times the smallest tag seen in the last frame (full resolution
+    side in pixels) is larger than target_tag_size, so tags stay detectable, and frames are detected at full
+    resolution when no tag is seen. When detection of a frame takes longer than budget seconds n grows by one more
+    step, until it's fast enough again. Scales never go below min_scale. Capture (CameraReader) and detection share
+    one AdaptiveDecimation, detection reports with update()
+    """
+    def __init__(self, target_tag_size: float = 24, min_scale: float = 0.25, budget: Optional[float] = None):
+        self.target_tag_size = target_tag_size
+        self.max_step = max(int(1 / min_scale), 1)
+        self.budget = budget
+        self.size_steps: Dict[int, int] = {}
+        self.load_steps: Dict[int, int] = {}
+
+    def get_scale(self, camera_index: int) -> float:
+        step = self.size_steps.get(camera_index, 1) + self.load_steps.get(camera_index, 0)
+        return 1.0 / min(step, self.max_step)
+
+    def update(self, camera_index: int, detections: np.ndarray, detection_time: float):
+        """
+        @param detections: detections of a frame, in full resolution coordinates
+        @param detection_time: seconds the detection took
+        """
+        if len(detections):
+            corners = detections["corners"]
+            sides = np.hypot(*(corners - np.roll(corners, 1, axis=1)).transpose(2, 0, 1))
+            self.size_steps[camera_index] = max(int(sides.mean(axis=1).min() / self.target_tag_size), 1)
+        else:
+            self.size_steps[camera_index] = 1
+        if self.budget is None:
+            return
+        load_step = self.load_steps.get(camera_index, 0)
+        if detection_time > self.budget:
+            self.load_steps[camera_index] = min(load_step + 1, self.max_step - 1)
+        elif detection_time < self.budget / 2 and load_step > 0:
+            self.load_steps[camera_index] = load_step - 1
+
+
+class TrackingState:
+    """
+    Last known bounding boxes (x0, y0, x1, y1) of tags seen by one camera and frames since its last full scan
+    """
+    def __init__(self):
+        self.boxes: Dict[int, Tuple[int, int, int, int]] = {}
+        self.frames_since_full_scan = 0
+        self.scale = 1.0
+
 
 class DetectObjectsTransform(mtl.OperationParent):
-    def __init__(self, settings: Settings):
+    """
+    Detects tags of objects from Settings. Building an apriltag.Detector allocates the tag family tables, so each
+    thread running the transform keeps its own detector, created in setup() and rebuilt only when settings change.
+
+    Detections are returned with their frame as FrameObjectWithDetectedObjects, or with keep_frame=False as
+    DetectionBatches, releasing the frame as soon as it's processed.
+
+    In tracking mode only padded regions around tags found in the previous frame of the same camera are searched.
+    The whole frame is scanned every full_scan_interval frames, when no tag is tracked or when a tracked tag is lost,
+    so new tags are found at the latest on the next full scan.
+
+    Frames downscaled at capture are detected as they are. With an AdaptiveDecimation full resolution frames are
+    downscaled to its scale before detection, and detection results are reported back to it. Detections are always
+    in full resolution coordinates
+    """
+    def __init__(self, settings: Settings, tracking: bool = False, full_scan_interval: int = 30,
+                 roi_padding: float = 0.5, min_roi_padding: int = 16, keep_frame: bool = True,
+                 decimation: Optional[AdaptiveDecimation] = None):
         super().__init__()
         self.settings = settings
+        self.decimation = decimation
+        self.keep_frame = keep_frame
+        self.tracking = tracking
+        self.full_scan_interval = full_scan_interval
+        self.roi_padding = roi_padding
+        self.min_roi_padding = min_roi_padding
+        self.tracking_states: Dict[int, TrackingState] = {}
+        self.full_scans = 0
+        self.roi_scans = 0
+        self.lost_tracks = 0
+        self.local = threading.local()
 
-    def run(self, input_object: List[FrameObject]) -> FrameObject:
-        frame = input_object[0]
-        frame_gr = cv2.cvtColor(frame.get_frame(), cv2.COLOR_BGR2GRAY)
-        centers: Dict[int, Tuple[int, int]] = {}
-        rots: Dict = {}
-        detector = apriltag.Detector(self.settings.options)
-        results = detector.detect(frame_gr)
+    def get_detector(self) -> apriltag.Detector:
+        if getattr(self.local, "settings", None) is not self.settings:
+            self.local.detector = apriltag.Detector(self.settings.options)
+            self.local.settings = self.settings
+        return self.local.detector
+
+    def setup(self):
+        self.get_detector()
+
+    def teardown(self):
+        self.local.detector = None
+        self.local.settings = None
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.pop("local")
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    # share of frames handled by searching regions of interest only
+    def get_hit_rate(self) -> float:
+        scans = self.full_scans + self.roi_scans
+        return self.roi_scans / scans if scans else 0.0
+
+    def detect_in_regions(self, frame: np.ndarray, boxes: Dict[int, Tuple[int, int, int, int]]) -> list:
+        detector = self.get_detector()
+        results = {}
+        for x0, y0, x1, y1 in boxes.values():
+            for detected in detector.detect(to_gray(frame[y0:y1, x0:x1])):
+                results[detected.tag_id] = detected._replace(center=detected.center + (x0, y0),
+                                                             corners=detected.corners + (x0, y0))
+        return list(results.values())
+
+    def detect(self, frame: np.ndarray, camera_index: int, scale: float = 1.0) -> list:
+        """
+        @param frame: BGR or grayscale frame
+        @param camera_index: index of the camera the frame comes from, tracked regions are kept per camera
+        @param scale: scale of the frame, tracked regions of another scale are dropped
+        @return: apriltag detections with coordinates in the frame
+        """
+        if not self.tracking:
+            return self.get_detector().detect(to_gray(frame))
+        state = self.tracking_states.setdefault(camera_index, TrackingState())
+        if state.scale != scale:
+            state.boxes = {}
+            state.scale = scale
+        results = None
+        if state.boxes and state.frames_since_full_scan < self.full_scan_interval:
+            # only the regions are converted to grayscale
+            results = self.detect_in_regions(frame, state.boxes)
+            # tags that aren't configured may show up in padded regions, they don't tell if a tracked tag was lost
+            if {detected.tag_id for detected in results if detected.tag_id in self.settings.tags} == state.boxes.keys():
+                self.roi_scans += 1
+                state.frames_since_full_scan += 1
+            else:
+                self.lost_tracks += 1
+                results = None
+        if results is None:
+            results = self.get_detector().detect(to_gray(frame))
+            self.full_scans += 1
+            state.frames_since_full_scan = 0
+        height, width = frame.shape[:2]
+        state.boxes = {}
         for detected in results:
             if detected.tag_id in self.settings.tags:
-                (c_x, c_y) = (int(detected.center[0]), int(detected.center[1]))
-                centers[self.settings.tags_index.get(detected.tag_id)] = c_x, c_y
-                (ptA, ptB, ptC, ptD) = detected.corners
-                pt_length = np.sqrt(((ptA[0] - ptD[0])*(ptA[0] - ptD[0])) + ((ptA[1] - ptD[1])*(ptA[1] - ptD[1])))
-                val = np.arccos(float((ptA[1] - ptD[1]) / pt_length))
-                if ptA[0] - ptD[0] > 0:
-                    val = 2 * np.pi - val
-                rots[self.settings.tags_index.get(detected.tag_id)] = val
-        return FrameObjectWithDetectedObjects(frame.get_frame(), frame.camera_index, centers, rots)
+                (x0, y0), (x1, y1) = detected.corners.min(axis=0), detected.corners.max(axis=0)
+                padding = max(self.roi_padding * max(x1 - x0, y1 - y0), self.min_roi_padding)
+                state.boxes[detected.tag_id] = (max(int(x0 - padding), 0), max(int(y0 - padding), 0),
+                                                min(int(x1 + padding) + 1, width), min(int(y1 + padding) + 1, height))
+        return results
+
+    def to_detections(self, results: list, scale: float = 1.0) -> np.ndarray:
+        """
+        @param scale: scale of the frame the results were detected in
+        @return: detections of tags of objects in full resolution coordinates, rotation is the angle of the tag's
+            left edge (from its first to its last corner) to the vertical axis of the frame
+        """
+        tags_index = self.settings.tags_index
+        results = [detected for detected in results if detected.tag_id in tags_index]
+        detections = np.empty(len(results), DETECTION_DTYPE)
+        if not results:
+            return detections
+        detections["tag"] = [detected.tag_id for detected in results]
+        detections["object"] = [tags_index[detected.tag_id] for detected in results]
+        # apriltag's origin is the corner of the first pixel, detections use OpenCV's, the center of the first pixel
+        detections["center"] = np.array([detected.center for detected in results]) / scale - 0.5
+        corners = (np.array([detected.corners for detected in results]) / scale - 0.5).astype(np.float32)
+        detections["corners"] = corners
+        detections["rot"] = image_rotation(corners)
+        detections["world"] = np.nan
+        detections["translation"] = np.nan
+        detections["orientation"] = np.nan
+        return detections
+
+    def run(self, input_object: List[FrameObject]) -> Union[FrameObjectWithDetectedObjects, DetectionBatch]:
+        frame = input_object[0]
+        image = frame.get_frame()
+        scale = frame.scale
+        start = time.perf_counter()
+        if self.decimation is not None and scale == 1.0:
+            scale = self.decimation.get_scale(frame.camera_index)
+            if scale != 1.0:
+                image = downscale_gray(image, scale)
+        detections = self.to_detections(self.detect(image, frame.camera_index, scale), scale)
+        if self.decimation is not None:
+            self.decimation.update(frame.camera_index, detections, time.perf_counter() - start)
+        if not self.keep_frame:
+            return DetectionBatch(frame.camera_index, detections, frame.timestamp, frame.capture_time)
+        return FrameObjectWithDetectedObjects(frame.get_frame(), frame.camera_index, slot=frame.slot,
+                                              capture_time=frame.capture_time, detections=detections,
+                                              scale=frame.scale)
 
 
 class ShowCentersOfMass(mtl.OperationParent):
@@ -44,8 +267,172 @@ class ShowCentersOfMass(mtl.OperationParent):
 
     def run(self, input_object: FrameObjectWithDetectedObjects) -> FrameObjectWithDetectedObjects:
         frame = input_object.get_frame()
-        for c_x, c_y in input_object.centers.values():
+        for c_x, c_y in input_object.detections["center"].astype(int).tolist():
             frame = cv2.circle(input_object.get_frame(), (c_x, c_y), 5, (0, 0, 255), -1)
-        return FrameObjectWithDetectedObjects(frame, input_object.camera_index, input_object.centers,
-                                              input_object.rots)
+        return FrameObjectWithDetectedObjects(frame, input_object.camera_index, slot=input_object.slot,
+                                              capture_time=input_object.capture_time,
+                                              detections=input_object.detections, scale=input_object.scale)
+
+
+def refine_tag_corners(gray: np.ndarray, corners: np.ndarray, samples: int = 16, search: float = 2.0,
+                       resolution: int = 16) -> np.ndarray:
+    """
+    Refines corners of all tags at once by fitting lines to their edges, which stays accurate on tags detected in a
+    downscaled frame. Each edge is sampled at samples points, at each of them the intensity profile along the edge
+    normal is read at resolution steps (all profiles by one remap) and the edge is located where it crosses halfway
+    between its dark and light side. Lines are fitted to the located points and corners are the intersections of
+    adjacent lines. Profiles reach search pixels to both sides, at most half the width of the tag's border cell, so
+    they don't reach the data cells
+    @param gray: grayscale frame
+    @param corners: (tags x 4 x 2) corners in pixel coordinates of the frame, edges connect consecutive corners
+    @return: refined corners
+    """
+    corners = np.asarray(corners, np.float64)
+    direction = np.roll(corners, -1, axis=1) - corners
+    length = np.linalg.norm(direction, axis=-1, keepdims=True)
+    unit = direction / length
+    normal = np.stack([-unit[..., 1], unit[..., 0]], axis=-1)
+    # a tag is 8 cells wide including its border
+    reach = np.minimum(search, length / 16)
+    # corners themselves are left out, the neighbouring edge blurs them
+    fractions = np.linspace(0.2, 0.8, samples)
+    points = corners[:, :, None] + direction[:, :, None] * fractions[:, None]
+    offsets = np.linspace(-1, 1, resolution + 1)
+    probes = points[:, :, :, None] + (normal * reach)[:, :, None, None] * offsets[:, None]
+    probes = probes.reshape(-1, len(offsets), 2).astype(np.float32)
+    values = cv2.remap(gray.astype(np.float32), probes[..., 0], probes[..., 1], cv2.INTER_LINEAR,
+                       borderMode=cv2.BORDER_REPLICATE)
+    low, high = values.min(axis=1), values.max(axis=1)
+    middle = (low + high) / 2
+    flips = np.diff((values > middle[:, None]).astype(np.int8), axis=1) != 0
+    crossing = np.argmax(flips, axis=1)
+    rows = np.arange(len(values))
+    first, second = values[rows, crossing], values[rows, crossing + 1]
+    fraction = np.clip((middle - first) / np.where(second != first, second - first, 1), 0, 1)
+    located = offsets[crossing] + fraction * (offsets[1] - offsets[0])
+    # profiles without an edge keep the detected position
+    located = np.where(flips.any(axis=1) & (high - low > 10), located, 0)
+    edge_points = points + normal[:, :, None] * (reach[:, :, None] * located.reshape(points.shape[:3])[..., None])
+    # principal direction of the located points of each edge
+    centroids = edge_points.mean(axis=2)
+    centered = edge_points - centroids[:, :, None]
+    directions = np.linalg.eigh(np.einsum("tesi,tesj->teij", centered, centered))[1][..., -1]
+    # corner i lies on edge i - 1 and edge i
+    previous_directions, previous_centroids = np.roll(directions, 1, axis=1), np.roll(centroids, 1, axis=1)
+    system = np.stack([previous_directions, -directions], axis=-1)
+    along = np.linalg.solve(system, (centroids - previous_centroids)[..., None])[..., 0, 0]
+    return previous_centroids + previous_directions * along[..., None]
+
+
+# corners of a tag in its own frame, in units of half its side: x to the right, y down, z into the tag, in the order
+# of apriltag's corners (bottom right, bottom left, top left, top right of an upright tag)
+TAG_CORNERS = np.array([[1, 1], [-1, 1], [-1, -1], [1, -1]], np.float64)
+
+
+def compute_homographies(points: np.ndarray) -> np.ndarray:
+    """
+    Solves the homographies of all tags at once by direct linear transformation of their four corners
+    @param points: (tags x 4 x 2) image points of TAG_CORNERS
+    @return: (tags x 3 x 3) homographies from tag coordinates to the image points
+    """
+    count = len(points)
+    x, y = np.broadcast_to(TAG_CORNERS[:, 0], (count, 4)), np.broadcast_to(TAG_CORNERS[:, 1], (count, 4))
+    u, v = points[:, :, 0], points[:, :, 1]
+    zeros, ones = np.zeros((count, 4)), np.ones((count, 4))
+    rows_u = np.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y, -u], axis=-1)
+    rows_v = np.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y, -v], axis=-1)
+    system = np.concatenate([rows_u, rows_v], axis=1)
+    return np.linalg.svd(system)[2][:, -1].reshape(count, 3, 3)
+
+
+def rotations_to_quaternions(rotations: np.ndarray) -> np.ndarray:
+    """
+    @param rotations: (n x 3 x 3) rotation matrices
+    @return: (n x 4) quaternions w, x, y, z
+    """
+    r = rotations
+    trace = np.stack([1 + r[:, 0, 0] + r[:, 1, 1] + r[:, 2, 2], 1 + r[:, 0, 0] - r[:, 1, 1] - r[:, 2, 2],
+                      1 - r[:, 0, 0] + r[:, 1, 1] - r[:, 2, 2], 1 - r[:, 0, 0] - r[:, 1, 1] + r[:, 2, 2]], axis=-1)
+    quaternions = np.sqrt(np.maximum(trace, 0)) / 2
+    signs = np.stack([r[:, 2, 1] - r[:, 1, 2], r[:, 0, 2] - r[:, 2, 0], r[:, 1, 0] - r[:, 0, 1]], axis=-1)
+    quaternions[:, 1:] = np.copysign(quaternions[:, 1:], signs)
+    return quaternions
+
+
+class EstimatePosesTransform(mtl.OperationParent):
+    """
+    Refines corners of all tags of a frame and estimates their 6-DoF poses, after DetectObjectsTransform (with
+    keep_frame=True when corners are refined). All tags of a frame are processed as arrays: corners are refined to
+    sub-pixel accuracy by refine_tag_corners(), undistorted by one undistortPoints call with the camera's intrinsics,
+    and homographies of all tags are solved and decomposed at once. Centers are moved to the intersection of the
+    refined diagonals, the perspective correct center of a tag, and rotations in the frame are recomputed.
+
+    intrinsics holds the camera matrix and distortion coefficients of each camera index, tags of cameras without them
+    get refined corners but no pose. Translations are in the units of tag_size, the side of a tag's black square.
+    With keep_frame=False detections are passed on as DetectionBatches and frames are released
+    """
+    def __init__(self,
+                 intrinsics: Dict[int, Tuple[np.ndarray, np.ndarray]],
+                 tag_size: float,
+                 refine_corners: bool = True,
+                 edge_samples: int = 16,
+                 search_distance: float = 2.0,
+                 keep_frame: bool = True):
+        super().__init__()
+        self.intrinsics = {index: (np.asarray(matrix, np.float64), np.asarray(distortion, np.float64))
+                           for index, (matrix, distortion) in intrinsics.items()}
+        self.tag_size = tag_size
+        self.refine_corners = refine_corners
+        self.edge_samples = edge_samples
+        self.search_distance = search_distance
+        self.keep_frame = keep_frame
+
+    def refine(self, frame: FrameObjectWithDetectedObjects, corners: np.ndarray) -> np.ndarray:
+        """
+        @param corners: (tags x 4 x 2) corners in full resolution coordinates
+        @return: refined corners in full resolution coordinates
+        """
+        scale = frame.scale
+        refined = refine_tag_corners(to_gray(frame.get_frame()), (corners + 0.5) * scale - 0.5, self.edge_samples,
+                                     self.search_distance)
+        return (refined + 0.5) / scale - 0.5
+
+    def estimate(self, camera_index: int, corners: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        @param corners: (tags x 4 x 2) corners in pixel coordinates
+        @return: (tags x 3) translations and (tags x 4) quaternions of the tags in the camera frame
+        """
+        matrix, distortion = self.intrinsics[camera_index]
+        points = cv2.undistortPoints(corners.reshape(-1, 1, 2).astype(np.float64), matrix, distortion)
+        homographies = compute_homographies(points.reshape(-1, 4, 2))
+        # H = s [r1 r2 t], with t in units of half a tag side
+        scales = 2 / (np.linalg.norm(homographies[:, :, 0], axis=1) + np.linalg.norm(homographies[:, :, 1], axis=1))
+        scales = np.where(homographies[:, 2, 2] < 0, -scales, scales)
+        homographies = homographies * scales[:, None, None]
+        rotations = np.stack([homographies[:, :, 0], homographies[:, :, 1],
+                              np.cross(homographies[:, :, 0], homographies[:, :, 1])], axis=-1)
+        u, _, vt = np.linalg.svd(rotations)
+        rotations = u @ vt
+        return homographies[:, :, 2] * self.tag_size / 2, rotations_to_quaternions(rotations)
 
+    def run(self, input_object: Union[FrameObjectWithDetectedObjects, DetectionBatch]) \
+            -> Union[FrameObjectWithDetectedObjects, DetectionBatch]:
+        detections = input_object.detections.copy()
+        if len(detections):
+            corners = detections["corners"].astype(np.float64)
+            if self.refine_corners and isinstance(input_object, FrameObjectWithDetectedObjects):
+                corners = self.refine(input_object, corners)
+            detections["corners"] = corners
+            # intersection of the diagonals corner 0 - corner 2 and corner 1 - corner 3
+            first, second = corners[:, 2] - corners[:, 0], corners[:, 3] - corners[:, 1]
+            offset = corners[:, 1] - corners[:, 0]
+            cross = first[:, 0] * second[:, 1] - first[:, 1] * second[:, 0]
+            along = (offset[:, 0] * second[:, 1] - offset[:, 1] * second[:, 0]) / cross
+            detections["center"] = corners[:, 0] + first * along[:, None]
+            detections["rot"] = image_rotation(corners)
+            if input_object.camera_index in self.intrinsics:
+                detections["translation"], detections["orientation"] = self.estimate(input_object.camera_index,
+                                                                                     corners)
+        if self.keep_frame or isinstance(input_object, DetectionBatch):
+            return input_object.with_detections(detections, input_object.capture_time)
+        return DetectionBatch(input_object.camera_index, detections, input_object.timestamp, input_object.capture_time)
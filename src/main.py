@@ -1,19 +1,99 @@
-from flask import Flask, jsonify, request
+import time
 
-import cv2
-import threading
+from flask import Flask, Response, jsonify, request
 
-import camera_io.cameraIO as cameraIO
-import multi_thread_data_processing.multiThreadDataProcessing as mtl
-from data_model.dataModel import Config
+import src.camera_io.cameraIO as cameraIO
+import src.detection_log.detectionLog as detectionLog
+import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
+import src.object_fusion.objectFusion as objectFusion
+import src.object_tracking.objectTracking as objectTracking
+import src.pose_feed.poseFeed as poseFeed
+from src.data_model.dataModel import Config
+from src.data_model.dataModel import interpolate_detections
+from src.multi_thread_data_processing.pipelineMetrics import REGISTRY
+from src.view_streaming.viewStreaming import FrameBroadcaster, MJPEG_BOUNDARY
 
 app = Flask(__name__)
+mtl.set_default_scheduler(mtl.PeriodicScheduler(Config().get_scheduler_workers()))
+REGISTRY.enable(Config().get_metrics_enabled())
+REGISTRY.add_gauge("pipeline_tick_jitter_seconds",
+                   lambda: {name: statistics.get("jitter")
+                            for name, statistics in mtl.get_default_scheduler().get_statistics().items()})
 cameras = cameraIO.AllCameras()
+camera_jobs = cameraIO.CameraJobs(Config().get_camera_jobs().get("workers"),
+                                  Config().get_camera_jobs().get("history"))
+broadcaster = FrameBroadcaster(Config().get_render().get("stream_quality"))
+FIELD_VIEW = "Video"
+pose_feed = poseFeed.PoseFeed(Config().get_pose_feed().get("buffer_size"))
+tracker = objectTracking.ObjectTracker(Config().get_objects().keys(),
+                                       Config().get_object_tracking().get("alpha"),
+                                       Config().get_object_tracking().get("beta"),
+                                       Config().get_object_tracking().get("max_age"))
 
 
 def main():
-    data_display = mtl.DataSink(cameras.data_output, cameraIO.CameraDisplay("Video", cameras.camera_data))
-    data_display.start()
+    config = Config()
+    # detectors pick up changes of the config file without a restart
+    mtl.get_default_scheduler().add(mtl.PeriodicTask(cameras.settings_store.reload_if_changed,
+                                                     config.get_config_reload_interval(), "config reload"))
+    # objects added or removed by a reload or PUT /settings are fused and tracked too
+    fuse_transform = objectFusion.FuseObjectsTransform(config.get_objects().keys(), cameras.camera_data)
+    cameras.settings_store.add_listener(lambda settings: fuse_transform.set_objects(settings.indexes))
+    cameras.settings_store.add_listener(lambda settings: tracker.set_objects(settings.indexes))
+    fusion_input = cameras.data_output
+    synchronization = config.get_synchronization()
+    if synchronization.get("enabled"):
+        fusion_input = [mtl.DataQueue(config.get_queue_size())]
+        data_synchronizer = mtl.DataSynchronizer(cameras.data_output,
+                                                 fusion_input,
+                                                 synchronization.get("tolerance"),
+                                                 interpolate_detections
+                                                 if synchronization.get("mode") == "interpolate" else None,
+                                                 synchronization.get("max_delay"),
+                                                 overflow_policy=config.get_overflow_policy(),
+                                                 name="synchronize")
+        data_synchronizer.start()
+    fusion_output = []
+    # render and pose feed get poses predicted by the tracker at its rate, or fused poses as they come
+    pose_output = fusion_output
+    object_tracking = config.get_object_tracking()
+    if object_tracking.get("enabled"):
+        pose_output = []
+        tracker_input = mtl.DataQueue(config.get_queue_size())
+        fusion_output.append(tracker_input)
+        mtl.DataSink([tracker_input], tracker, name="track").start()
+        mtl.PeriodicDataGetter(pose_output,
+                               objectTracking.PredictedObjectsGetter(tracker),
+                               object_tracking.get("rate"),
+                               overflow_policy=config.get_overflow_policy(),
+                               name="predict").start()
+    render = config.get_render()
+    if render.get("enabled"):
+        # the render stage only ever takes the latest fused objects, fusion never waits for it
+        render_input = mtl.LatestValueQueue()
+        pose_output.append(render_input)
+        display = cameraIO.CameraDisplay(FIELD_VIEW, cameras.camera_data, render.get("windows"),
+                                         broadcaster if render.get("stream") else None, cameras.coverage)
+        mtl.PeriodicDataSink([render_input], display, render.get("fps"), name="render").start()
+    detection_log = config.get_detection_log()
+    if detection_log.get("enabled"):
+        log_input = mtl.DataQueue(config.get_queue_size())
+        fusion_output.append(log_input)
+        log_writer = detectionLog.DetectionLogWriter(detection_log.get("directory"),
+                                                     detection_log.get("segment_records"),
+                                                     detection_log.get("segment_seconds"),
+                                                     detection_log.get("fsync_interval"))
+        mtl.DataSink([log_input], detectionLog.DetectionLogSink(log_writer), name="detection log").start()
+    # poses are pushed as soon as they are fused, subscribers only ever drop from their own buffers
+    feed_input = mtl.DataQueue(config.get_queue_size())
+    pose_output.append(feed_input)
+    mtl.DataSink([feed_input], pose_feed, name="pose feed").start()
+    data_fusion = mtl.DataWorker(fusion_input,
+                                 fusion_output,
+                                 mtl.OperationChain().add_operation(fuse_transform),
+                                 overflow_policy=config.get_overflow_policy(),
+                                 name="fuse")
+    data_fusion.start()
     app.run()
 
 
@@ -22,6 +102,67 @@ def get_cameras():
     return jsonify(result)
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics_rest():
+    return Response(REGISTRY.to_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+def stream_view(view: str):
+    render = Config().get_render()
+    if not render.get("enabled") or not render.get("stream"):
+        return "streaming is disabled", 404
+    return Response(broadcaster.stream(view), mimetype="multipart/x-mixed-replace; boundary=" + MJPEG_BOUNDARY)
+
+
+@app.route('/stream/field', methods=['GET'])
+def stream_field_rest():
+    return stream_view(FIELD_VIEW)
+
+
+@app.route('/stream/cameras/<int:index>', methods=['GET'])
+def stream_camera_rest(index: int):
+    if index not in cameras.indexes:
+        return "camera {} doesn't exist".format(index), 404
+    return stream_view("Camera: {}".format(index))
+
+
+def get_object_indexes_arg():
+    ids = request.args.get("ids")
+    if not ids:
+        return None
+    return {int(index) for index in ids.split(",")}
+
+
+@app.route('/objects', methods=['GET'])
+def get_objects_rest():
+    try:
+        object_indexes = get_object_indexes_arg()
+    except ValueError:
+        return "ids must be a comma separated list of object indexes", 400
+    at = request.args.get("at", type=float)
+    if at is None:
+        return jsonify(pose_feed.get_latest(object_indexes))
+    if not Config().get_object_tracking().get("enabled"):
+        return "object tracking is disabled", 404
+    # at is a unix timestamp, the tracker predicts in time.monotonic()
+    predicted = tracker.predict_fused(time.monotonic() + at - time.time())
+    poses = predicted.to_poses() if predicted is not None else []
+    return jsonify([pose for pose in poses if object_indexes is None or pose["id"] in object_indexes])
+
+
+@app.route('/objects/stream', methods=['GET'])
+def stream_objects_rest():
+    try:
+        object_indexes = get_object_indexes_arg()
+    except ValueError:
+        return "ids must be a comma separated list of object indexes", 400
+    rate = request.args.get("rate", type=float)
+    if rate is not None and rate <= 0:
+        return "rate must be positive", 400
+    return Response(pose_feed.events(object_indexes, rate), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
+
+
 @app.route('/cameras/get', methods=['GET'])
 def get_cameras_rest():
     return get_cameras()
@@ -29,14 +170,17 @@ def get_cameras_rest():
 
 @app.route('/cameras/activate', methods=['PUT'])
 def stop_start_cameras_rest():
-    index: str = request.args.get("index")
+    try:
+        index: int = int(request.args.get("index"))
+    except:
+        return "wrong arguments", 400
     active: str = request.args.get("active")
+    if index not in cameras.indexes:
+        return "camera {} does not exist".format(index), 500
     if active.__eq__("true"):
-        cameras.start_camera(int(index))
-        return "camera {} turned on".format(index), 200
+        return jsonify(camera_jobs.submit("start", index, cameras.start_camera, index)), 202
     elif active.__eq__("false"):
-        cameras.stop_camera(int(index))
-        return "camera {} turned off".format(index), 200
+        return jsonify(camera_jobs.submit("stop", index, cameras.stop_camera, index)), 202
     else:
         return 'bad request!', 400
 
@@ -51,12 +195,19 @@ def create_camera_rest():
         angle: float = float(request.args.get("angle"))
     except:
         return "wrong arguments", 400
+    # optional replay of a video file or image sequence instead of the capture device index
+    source: str = request.args.get("source")
+    mode: str = request.args.get("mode", "realtime")
+    loop: str = request.args.get("loop", "false")
+    if mode not in ("realtime", "max"):
+        return "wrong arguments", 400
+    if index in cameras.indexes:
+        return "camera {} already exists".format(index), 400
     print("Creating camera with index {}, fps {}, and starting point {},{}".format(index, fps, x, y))
-    try:
-        cameras.add_camera(index, fps, x, y, angle)
-    except:
-        return "index {} does not exist".format(index), 500
-    return "camera {} created".format(index), 200
+    # the device is opened by the job, its status tells if the index or source can't be used
+    job = camera_jobs.submit("create", index, cameras.add_camera, index, fps, x, y, angle, source,
+                             mode.__eq__("realtime"), loop.__eq__("true"))
+    return jsonify(job), 202
 
 
 @app.route('/cameras/update', methods=['PUT'])
@@ -71,42 +222,76 @@ def update_camera_rest():
         return "wrong arguments", 400
     if index not in cameras.indexes:
         return "camera {} does not exist".format(index), 500
-    lock = threading.Lock()
-    lock.acquire(blocking=True, timeout=-1)
-    camera = cameras.all_cameras.get(index)
-    camera.fps = fps
-    camera.data_getter.period = 1/fps
-    camera.x = x
-    camera.y = y
-    camera.angle = angle
-    cameras.camera_data[index] = x, y, angle, camera.resolution, camera.cals_display_points()
-    lock.release()
-    return "camera {} updated".format(index), 200
+    return jsonify(camera_jobs.submit("update", index, cameras.update_camera, index, fps, x, y, angle)), 202
+
+
+def settings_to_dict():
+    settings = cameras.settings_store.get()
+    return {"version": settings.version,
+            "tag_family": Config().get_tag_family(),
+            "objects": {index: {"tag_id": tag_id} for tag_id, index in settings.tags_index.items()}}
+
+
+@app.route('/settings', methods=['GET'])
+def get_settings_rest():
+    return jsonify(settings_to_dict())
+
+
+@app.route('/settings', methods=['PUT'])
+def update_settings_rest():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return "wrong arguments", 400
+    values = {}
+    try:
+        if "objects" in body:
+            values["objects"] = {int(index): {"tag_id": int(tag.get("tag_id"))}
+                                 for index, tag in body.get("objects").items()}
+        if "tag_family" in body:
+            values["tag_family"] = str(body.get("tag_family"))
+    except:
+        return "wrong arguments", 400
+    if not values:
+        return "wrong arguments", 400
+    cameras.settings_store.update(values)
+    return jsonify(settings_to_dict())
+
+
+@app.route('/jobs', methods=['GET'])
+def get_jobs_rest():
+    return jsonify(camera_jobs.get_jobs())
+
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def get_job_rest(job_id: int):
+    job = camera_jobs.get_job(job_id)
+    if job is None:
+        return "job {} does not exist".format(job_id), 404
+    return jsonify(job)
 
 
 @app.route('/cameras/free', methods=['GET'])
 def get_available_indexes_rest():
-    config = Config()
-    result = []
-    for index in range(config.get_max_search_index()):
-        if index not in cameras.indexes:
-            cap = cv2.VideoCapture(index)
-            if cap.isOpened():
-                result.append(index)
-                cap.release()
+    result = list(cameras.discovery.get_devices(cameras.indexes).keys())
     return "available indexes: {}".format(result), 200
 
 
+@app.route('/cameras/coverage', methods=['GET'])
+def get_camera_coverage_rest():
+    if "x" not in request.args and "y" not in request.args:
+        return jsonify(cameras.coverage.get_report())
+    try:
+        x: float = float(request.args.get("x"))
+        y: float = float(request.args.get("y"))
+    except (TypeError, ValueError):
+        return "x and y must be numbers", 400
+    return jsonify(cameras.coverage.get_cameras(x, y))
+
+
 @app.route('/cameras/resolutions', methods=['GET'])
 def get_available_resolutions_rest():
-    config = Config()
-    result = {}
-    for index in range(config.get_max_search_index()):
-        if index not in cameras.indexes:
-            cap = cv2.VideoCapture(index)
-            if cap.isOpened():
-                result[index] = cap.get(cv2.CAP_PROP_FRAME_WIDTH), cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-                cap.release()
+    result = {index: device.get("resolution")
+              for index, device in cameras.discovery.get_devices(cameras.indexes).items()}
     return "available indexes and resolutions: {}".format(result), 200
 
 
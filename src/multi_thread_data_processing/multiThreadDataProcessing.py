@@ -1,7 +1,216 @@
+import heapq
+import multiprocessing
+import os
 import threading
 import time
-from typing import List, Optional, Any
-from queue import Queue
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from typing import List, Optional, Any, Callable, Tuple, Dict
+from queue import Queue, Empty, Full
+
+from src.multi_thread_data_processing.pipelineMetrics import REGISTRY, StageMetrics
+
+
+"""
+DataQueue is a Queue that notifies its listeners every time an object is put into it. Stages waiting for data on
+several queues at once register a listener instead of polling each queue in a loop
+"""
+
+
+class DataQueue(Queue):
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.listeners: List[threading.Event] = []
+
+    def add_listener(self, listener: threading.Event):
+        with self.mutex:
+            self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener: threading.Event):
+        with self.mutex:
+            self.listeners = [registered for registered in self.listeners if registered is not listener]
+
+    def _put(self, item: Any):
+        super()._put(item)
+        for listener in self.listeners:
+            listener.set()
+
+
+"""
+LatestValueQueue keeps only the latest object put into it: put() never blocks and replaces an object that wasn't
+taken yet, replaced objects are counted in replaced. Use it to feed optional consumers (e.g. rendering) that must
+not slow down the stage putting objects
+"""
+
+
+class LatestValueQueue(DataQueue):
+    def __init__(self):
+        super().__init__(0)
+        self.replaced = 0
+
+    def _put(self, item: Any):
+        if self.queue:
+            self.queue.clear()
+            self.replaced += 1
+        super()._put(item)
+
+
+"""
+Overflow policies of stages putting objects into bounded output queues:
+BLOCK waits until the queue has free space, DROP_OLDEST removes the oldest queued object so the newest one is always
+kept ("latest frame wins"), DROP_NEWEST discards the object being put
+"""
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+def put_to_queues(output_queues: List[Queue], output: Any, overflow_policy: str = BLOCK,
+                  stopped: Optional[Callable[[], bool]] = None) -> int:
+    """
+    Puts the output object into each of the output queues following the overflow policy
+    @param output_queues: queues to put the object into
+    @param output: object to put
+    @param overflow_policy: one of BLOCK, DROP_OLDEST, DROP_NEWEST
+    @param stopped: with BLOCK, a function checked while waiting for free space, the object is dropped when it
+        returns True, so a stage stopped while its output queue is full doesn't wait forever
+    @return: number of objects dropped from or not put into the queues
+    """
+    dropped = 0
+    for output_queue in output_queues:
+        if overflow_policy == BLOCK and stopped is None:
+            output_queue.put(output)
+        elif overflow_policy == BLOCK:
+            while True:
+                try:
+                    output_queue.put(output, timeout=0.1)
+                    break
+                except Full:
+                    if stopped():
+                        dropped += 1
+                        break
+        elif overflow_policy == DROP_NEWEST:
+            try:
+                output_queue.put_nowait(output)
+            except Full:
+                dropped += 1
+        else:
+            while True:
+                try:
+                    output_queue.put_nowait(output)
+                    break
+                except Full:
+                    try:
+                        output_queue.get_nowait()
+                        dropped += 1
+                    except Empty:
+                        pass
+    return dropped
+
+
+"""
+QueueSelector waits until any of the input queues has data. DataQueues wake it up directly, a single plain Queue is
+waited on with a blocking get(), several plain Queues are checked every poll_interval seconds
+"""
+
+
+class QueueSelector:
+    def __init__(self, queues: List[Queue], poll_interval: float = 0.001):
+        self.queues = queues
+        self.poll_interval = poll_interval
+        self.event = threading.Event()
+        self.registered: List[Queue] = []
+        self.lock = threading.Lock()
+
+    # listeners follow queues added to or removed from the list, threads sharing the selector may register at once
+    def register(self):
+        with self.lock:
+            if self.registered == self.queues:
+                return
+            self._unregister()
+            self.registered = list(self.queues)
+            for queue in self.registered:
+                if isinstance(queue, DataQueue):
+                    queue.add_listener(self.event)
+
+    def unregister(self):
+        with self.lock:
+            self._unregister()
+
+    def _unregister(self):
+        for queue in self.registered:
+            if isinstance(queue, DataQueue):
+                queue.remove_listener(self.event)
+        self.registered = []
+
+    def get_available(self) -> list:
+        """
+        Takes at most one object from each of the queues without waiting
+        @return: list of taken objects, empty if all queues are empty
+        """
+        self.event.clear()
+        current_obj = []
+        for input_queue in self.queues:
+            try:
+                current_obj.append(input_queue.get_nowait())
+            except Empty:
+                pass
+        return current_obj
+
+    def get_all_available(self, queues: Optional[List[Queue]] = None) -> List[list]:
+        """
+        Takes all objects from each of the queues without waiting
+        @param queues: a snapshot of the queues to take from, the queues of the selector when None
+        @return: list of objects taken from each queue, in the order of queues
+        """
+        self.event.clear()
+        current_obj = []
+        for input_queue in self.queues if queues is None else queues:
+            queue_obj = []
+            try:
+                while True:
+                    queue_obj.append(input_queue.get_nowait())
+            except Empty:
+                pass
+            current_obj.append(queue_obj)
+        return current_obj
+
+    def wait(self, timeout: float):
+        """
+        Waits up to timeout seconds for an object put into a DataQueue since the last get, plain Queues are checked
+        again after poll_interval
+        """
+        self.register()
+        if all(isinstance(queue, DataQueue) for queue in self.queues):
+            self.event.wait(timeout)
+        else:
+            self.event.wait(min(timeout, self.poll_interval))
+
+    def select(self, timeout: float) -> list:
+        """
+        Takes at most one object from each of the queues, waiting up to timeout seconds if all of them are empty
+        @param timeout: maximal time of waiting in seconds
+        @return: list of taken objects, empty if nothing arrived before timeout or wake() was called
+        """
+        self.register()
+        current_obj = self.get_available()
+        if current_obj:
+            return current_obj
+        if all(isinstance(queue, DataQueue) for queue in self.queues):
+            self.event.wait(timeout)
+        elif len(self.queues) == 1:
+            try:
+                return [self.queues[0].get(timeout=timeout)]
+            except Empty:
+                return []
+        else:
+            self.event.wait(min(timeout, self.poll_interval))
+        return self.get_available()
+
+    def wake(self):
+        self.event.set()
 
 
 class OperationParent:
@@ -22,6 +231,28 @@ class OperationParent:
         """
         return input_object
 
+    def run_batch(self, input_objects: List[Any]) -> List[Any]:
+        """
+        Runs the operation on a micro-batch of input objects, executed by PooledDataWorker. Override it when objects
+        can be processed together faster than one by one
+        @param input_objects: objects that would be passed to run() one at a time
+        @return: outputs of run() in the order of input_objects
+        """
+        return [self.run(input_object) for input_object in input_objects]
+
+    def setup(self):
+        """
+        Called by the DataWorker in the thread (or process) that will execute run(), before the first object is
+        processed. Use it to create resources that are expensive to build and can't be shared between threads
+        """
+        pass
+
+    def teardown(self):
+        """
+        Called by the DataWorker when it stops, releases resources created by setup()
+        """
+        pass
+
     def set_side_input(self, side_input: Any):
         """
         Updates additional input of the OperationParent
@@ -53,46 +284,541 @@ class OperationChain:
         self.operations.append(operation_object)
         return self
 
-    # method used by DataWorker to execute operations, don't use it
-    def run_operations(self, input_object: List[Any]) -> Any:
+    # methods used by DataWorker to prepare and clean up operations in its thread, don't use them
+    def setup_operations(self):
+        for operationObject in self.operations:
+            operationObject.setup()
+
+    def teardown_operations(self):
+        for operationObject in self.operations:
+            operationObject.teardown()
+
+    # method used by DataWorker to execute operations, don't use it. With enabled metrics the time of each operation
+    # is recorded by its class name
+    def run_operations(self, input_object: List[Any], metrics: Optional[StageMetrics] = None) -> Any:
         output_object = input_object
+        if metrics is None or not metrics.enabled:
+            for operationObject in self.operations:
+                output_object = operationObject.run(output_object)
+            return output_object
         for operationObject in self.operations:
+            start = time.perf_counter()
             output_object = operationObject.run(output_object)
+            metrics.record_operation(type(operationObject).__name__, time.perf_counter() - start)
         return output_object
 
+    # method used by PooledDataWorker to execute operations on a micro-batch, don't use it
+    def run_batch(self, input_objects: List[List[Any]], metrics: Optional[StageMetrics] = None) -> List[Any]:
+        output_objects = input_objects
+        if metrics is None or not metrics.enabled:
+            for operationObject in self.operations:
+                output_objects = operationObject.run_batch(output_objects)
+            return output_objects
+        for operationObject in self.operations:
+            start = time.perf_counter()
+            output_objects = operationObject.run_batch(output_objects)
+            # time per object, comparable with run_operations
+            metrics.record_operation(type(operationObject).__name__,
+                                     (time.perf_counter() - start) / len(input_objects))
+        return output_objects
+
 
 """
-A DataWorker object, executes the OperationChain on incoming data objects
+A DataWorker object, executes the OperationChain on incoming data objects. By default it sleeps until data arrives in
+one of the input queues (blocking=True), blocking=False restores polling the queues in a busy loop.
+overflow_policy decides what happens when a bounded output queue is full, dropped objects are counted in dropped.
+name identifies the stage in pipeline metrics
 """
 
 
 class DataWorker:
-    def __init__(self, input_object: List[Queue], output_object: List[Queue], operation_chain: OperationChain):
+    def __init__(self,
+                 input_object: List[Queue],
+                 output_object: List[Queue],
+                 operation_chain: OperationChain,
+                 blocking: bool = True,
+                 timeout: float = 0.1,
+                 overflow_policy: str = BLOCK,
+                 name: Optional[str] = None):
         self.input_object = input_object
         self.output_object = output_object
         self.operation_chain = operation_chain
+        self.blocking = blocking
+        self.timeout = timeout
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self.selector = QueueSelector(self.input_object)
+        self.metrics = REGISTRY.register("worker", name, self, self.input_object)
         self.stop_event = False
+        self.thread: Optional[threading.Thread] = None
 
     def start(self):
         self.stop_event = False
-        threading.Thread(target=self.run, args=()).start()
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.start()
 
     def run(self):
+        self.setup()
         while not self.stop_event:
-            if self.input_object:
-                current_obj = []
-                for input_queue in self.input_object:
-                    if not input_queue.empty():
-                        current_obj.append(input_queue.get())
-                if current_obj:
-                    # timestamp = datetime.now()
-                    for output_queue in self.output_object:
-                        output_queue.put(self.operation_chain.run_operations(current_obj))
-                    # print(datetime.now() - timestamp)
-
-    # Use this method to stop DataWorker, waits until current OperationChain is finished
+            if self.blocking:
+                current_obj = self.selector.select(self.timeout)
+            else:
+                current_obj = self.selector.get_available()
+            if current_obj:
+                self.process(current_obj)
+        self.selector.unregister()
+        self.teardown()
+
+    def setup(self):
+        self.operation_chain.setup_operations()
+
+    def teardown(self):
+        self.operation_chain.teardown_operations()
+
+    def process(self, current_obj: list):
+        if not self.metrics.enabled:
+            output = self.operation_chain.run_operations(current_obj)
+            self.dropped += put_to_queues(self.output_object, output, self.overflow_policy, self.is_stopped)
+            return
+        start = time.perf_counter()
+        output = self.operation_chain.run_operations(current_obj, self.metrics)
+        self.metrics.record(output, time.perf_counter() - start)
+        self.dropped += put_to_queues(self.output_object, output, self.overflow_policy, self.is_stopped)
+
+    # Use this method to stop DataWorker, current OperationChain is finished before the thread exits
     def stop(self):
         self.stop_event = True
+        self.selector.wake()
+
+    def is_stopped(self) -> bool:
+        return self.stop_event
+
+    # Waits until the DataWorker thread exits, use it after stop()
+    def join(self, timeout: Optional[float] = None):
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+
+# OperationChain of a ProcessDataWorker pool process, set once by the pool initializer
+_process_operation_chain: Optional[OperationChain] = None
+
+
+def _init_process(operation_chain: OperationChain):
+    global _process_operation_chain
+    _process_operation_chain = operation_chain
+    _process_operation_chain.setup_operations()
+
+
+def _run_operations_in_process(input_object: List[Any]) -> Any:
+    return _process_operation_chain.run_operations(input_object)
+
+
+"""
+ProcessDataWorker executes the OperationChain in a pool of worker processes, so operations are not limited by the GIL.
+The OperationChain is sent to every process once, when the pool starts, and results are put into output queues in
+the order in which input objects were taken. The optional prepare function is called in this process before an
+object is sent to the pool, it can be used to move large data (e.g. frames) to shared memory so only a small handle
+gets pickled. Objects passed to and returned from the OperationChain have to be picklable. Operations run in other
+processes, so metrics of a ProcessDataWorker cover the whole chain (from submitting an object to emitting its output)
+but not single operations
+"""
+
+
+class ProcessDataWorker(DataWorker):
+    def __init__(self,
+                 input_object: List[Queue],
+                 output_object: List[Queue],
+                 operation_chain: OperationChain,
+                 processes: int = 2,
+                 prepare: Optional[Callable[[List[Any]], List[Any]]] = None,
+                 max_pending: Optional[int] = None,
+                 start_method: str = "spawn",
+                 blocking: bool = True,
+                 timeout: float = 0.1,
+                 overflow_policy: str = BLOCK,
+                 name: Optional[str] = None):
+        super().__init__(input_object, output_object, operation_chain, blocking, timeout, overflow_policy, name)
+        self.processes = processes
+        self.prepare = prepare
+        self.start_method = start_method
+        self.pending: Queue = Queue(max_pending if max_pending is not None else 2 * processes)
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.emit_thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(self.processes,
+                                            mp_context=multiprocessing.get_context(self.start_method),
+                                            initializer=_init_process,
+                                            initargs=(self.operation_chain,))
+        self.emit_thread = threading.Thread(target=self.emit, args=())
+        self.emit_thread.start()
+        super().start()
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.pending.put(None)
+
+    # operations are set up in the pool processes by the pool initializer
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def process(self, current_obj: list):
+        if self.prepare is not None:
+            current_obj = self.prepare(current_obj)
+        # blocks when max_pending objects are already being processed, input objects are kept alive until their
+        # output is emitted so resources they hold (e.g. shared memory slots) are not reused in the meantime
+        submitted = time.perf_counter() if self.metrics.enabled else None
+        self.pending.put((self.executor.submit(_run_operations_in_process, current_obj), current_obj, submitted))
+
+    def emit(self):
+        while True:
+            pending = self.pending.get()
+            if pending is None:
+                break
+            future: Future = pending[0]
+            try:
+                output = future.result()
+            except Exception as exception:
+                print("ProcessDataWorker operation failed: {}".format(exception))
+                continue
+            if pending[2] is not None:
+                self.metrics.record(output, time.perf_counter() - pending[2])
+            self.dropped += put_to_queues(self.output_object, output, self.overflow_policy, self.is_stopped)
+        self.executor.shutdown()
+
+    def join(self, timeout: Optional[float] = None):
+        super().join(timeout)
+        if self.emit_thread is not None and self.emit_thread is not threading.current_thread():
+            self.emit_thread.join(timeout)
+
+
+"""
+PoolRoute connects an input queue of a PooledDataWorker with output queues, objects taken from input_queue are put
+into output_object. dropped counts objects of this route dropped by the overflow policy
+"""
+
+
+class PoolRoute:
+    def __init__(self, input_queue: Queue, output_object: List[Queue]):
+        self.input_queue = input_queue
+        self.output_object = output_object
+        self.dropped = 0
+        self.busy = False
+
+
+"""
+PooledDataWorker executes one OperationChain on objects of many routes (e.g. frames of all cameras) with a fixed
+number of threads, by default one per core, instead of one DataWorker thread per input. Each thread takes a
+micro-batch of at most batch_size objects, one object from each route per pass, starting from a route that moves
+round-robin with every batch, so a busy input can't starve the others. A route is processed by one thread at a time:
+its objects keep their order and operations may keep state per input. Objects are passed to the chain as [object],
+like in a DataWorker with a single input queue, and each output goes to the output queues of its route. Routes can be
+added and removed while the worker runs, threads are started with the first route added while none is running
+"""
+
+
+class PooledDataWorker:
+    def __init__(self,
+                 operation_chain: OperationChain,
+                 threads: Optional[int] = None,
+                 batch_size: int = 8,
+                 timeout: float = 0.1,
+                 overflow_policy: str = BLOCK,
+                 name: Optional[str] = None):
+        self.operation_chain = operation_chain
+        self.threads_count = threads if threads else os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self.routes: List[PoolRoute] = []
+        self.input_object: List[Queue] = []
+        self.cursor = 0
+        self.lock = threading.Lock()
+        # notified when routes stop being busy
+        self.released = threading.Condition(self.lock)
+        self.selector = QueueSelector(self.input_object)
+        self.metrics = REGISTRY.register("worker", name, self, self.input_object)
+        self.stop_event = False
+        self.threads: List[threading.Thread] = []
+
+    def add_route(self, route: PoolRoute):
+        with self.lock:
+            self.routes.append(route)
+            self.input_object.append(route.input_queue)
+        self.selector.register()
+        if self.stop_event or not any(thread.is_alive() for thread in self.threads):
+            self.start()
+        self.selector.wake()
+
+    def remove_route(self, route: PoolRoute, timeout: Optional[float] = 5.0, drain: bool = False):
+        """
+        Removes the route and waits up to timeout seconds until its objects being processed are emitted
+        @param drain: objects queued in the route are processed before it's removed, within the same timeout
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if drain:
+            with self.released:
+                self.released.wait_for(lambda: route.input_queue.empty() and not route.busy, timeout)
+        with self.lock:
+            if route not in self.routes:
+                return
+            self.routes.remove(route)
+            self.input_object.remove(route.input_queue)
+        self.selector.register()
+        with self.released:
+            self.released.wait_for(lambda: not route.busy,
+                                   max(deadline - time.monotonic(), 0) if deadline is not None else None)
+
+    def start(self):
+        if self.stop_event:
+            # threads of the previous start exit before new ones are started, their listeners are registered again
+            self.join()
+        self.stop_event = False
+        self.selector.register()
+        self.threads = [threading.Thread(target=self.run, args=()) for _ in range(self.threads_count)]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        self.operation_chain.setup_operations()
+        while not self.stop_event:
+            batch = self.take_batch()
+            if batch:
+                self.process(batch)
+            else:
+                self.selector.wait(self.timeout)
+        self.selector.unregister()
+        self.operation_chain.teardown_operations()
+
+    def take_batch(self) -> List[Tuple[PoolRoute, Any]]:
+        """
+        Takes objects of routes not processed by other threads and marks their routes busy
+        @return: routes and objects taken from them, empty if nothing is available
+        """
+        self.selector.event.clear()
+        batch = []
+        with self.lock:
+            count = len(self.routes)
+            available = [self.routes[(self.cursor + i) % count] for i in range(count)]
+            available = [route for route in available if not route.busy]
+            self.cursor = (self.cursor + 1) % count if count else 0
+            while available and len(batch) < self.batch_size:
+                taken = []
+                for route in available[:self.batch_size - len(batch)]:
+                    try:
+                        batch.append((route, route.input_queue.get_nowait()))
+                    except Empty:
+                        continue
+                    route.busy = True
+                    taken.append(route)
+                available = taken
+        return batch
+
+    def process(self, batch: List[Tuple[PoolRoute, Any]]):
+        try:
+            start = time.perf_counter() if self.metrics.enabled else None
+            outputs = self.operation_chain.run_batch([[current_obj] for _, current_obj in batch], self.metrics)
+            processing_time = (time.perf_counter() - start) / len(batch) if start is not None else None
+            for (route, _), output in zip(batch, outputs):
+                if start is not None:
+                    self.metrics.record(output, processing_time)
+                dropped = put_to_queues(route.output_object, output, self.overflow_policy, self.is_stopped)
+                route.dropped += dropped
+                self.dropped += dropped
+        finally:
+            with self.released:
+                for route, _ in batch:
+                    route.busy = False
+                self.released.notify_all()
+
+    def stop(self):
+        self.stop_event = True
+        self.selector.wake()
+
+    def is_stopped(self) -> bool:
+        return self.stop_event
+
+    def join(self, timeout: Optional[float] = None):
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+
+
+def _capture_time(input_object: Any) -> float:
+    return input_object.capture_time
+
+
+"""
+DataSynchronizer matches objects from several input queues (e.g. detections of different cameras) by time and puts
+a list with one object per input into the output queues. Objects are buffered per input and matched oldest first:
+the reference time of a match is the time of the latest of the oldest buffered objects, and every input contributes
+its object nearest to it, if it's not further than tolerance seconds. With an interpolate(before, after, time)
+function, objects right before and after the reference time are interpolated instead. Objects that can't be matched
+are discarded. An input that delivered nothing for max_delay seconds (e.g. an idle or stopped camera) isn't waited
+for and is left out of matches until it delivers again. key returns the time of an object, by default its
+capture_time, which should come from a monotonic clock. Metrics of a DataSynchronizer count matched lists, their
+latency is measured from capture of the oldest matched object
+"""
+
+
+class DataSynchronizer:
+    def __init__(self,
+                 input_object: List[Queue],
+                 output_object: List[Queue],
+                 tolerance: float,
+                 interpolate: Optional[Callable[[Any, Any, float], Any]] = None,
+                 max_delay: float = 0.5,
+                 key: Callable[[Any], float] = _capture_time,
+                 buffer_size: int = 32,
+                 timeout: float = 0.1,
+                 overflow_policy: str = BLOCK,
+                 name: Optional[str] = None):
+        self.input_object = input_object
+        self.output_object = output_object
+        self.tolerance = tolerance
+        self.interpolate = interpolate
+        self.max_delay = max_delay
+        self.key = key
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.overflow_policy = overflow_policy
+        self.selector = QueueSelector(self.input_object)
+        self.buffers: List[deque] = []
+        # time of the latest object delivered by each input
+        self.latest: List[float] = []
+        # inputs the buffers belong to, queues can be added to or removed from input_object while running
+        self.buffer_queues: List[Queue] = []
+        self.matched = 0
+        self.discarded = 0
+        self.dropped = 0
+        self.metrics = REGISTRY.register("synchronizer", name, self, self.input_object)
+        self.stop_event = False
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.stop_event = False
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event:
+            queues = list(self.input_object)
+            self.follow_inputs(queues)
+            self.add_objects(self.selector.get_all_available(queues))
+            matched_objects = self.match(time.monotonic())
+            while matched_objects is not None:
+                self.matched += 1
+                if self.metrics.enabled:
+                    self.metrics.record(matched_objects)
+                self.dropped += put_to_queues(self.output_object, matched_objects, self.overflow_policy,
+                                              self.is_stopped)
+                matched_objects = self.match(time.monotonic())
+            self.selector.wait(self.timeout)
+        self.selector.unregister()
+
+    def follow_inputs(self, queues: List[Queue]):
+        """
+        Keeps the buffers of queues still in the list and drops buffers of removed ones
+        """
+        if queues == self.buffer_queues:
+            return
+        buffers = {id(queue): (buffer, latest)
+                   for queue, buffer, latest in zip(self.buffer_queues, self.buffers, self.latest)}
+        kept = [buffers.get(id(queue), (deque(), -float("inf"))) for queue in queues]
+        self.buffers = [buffer for buffer, _ in kept]
+        self.latest = [latest for _, latest in kept]
+        self.buffer_queues = queues
+
+    def add_objects(self, objects_by_input: List[list]):
+        while len(self.buffers) < len(objects_by_input):
+            self.buffers.append(deque())
+            self.latest.append(-float("inf"))
+        for i, (buffer, input_objects) in enumerate(zip(self.buffers, objects_by_input)):
+            for input_object in input_objects:
+                self.latest[i] = max(self.latest[i], self.key(input_object))
+                if len(buffer) == self.buffer_size:
+                    buffer.popleft()
+                    self.discarded += 1
+                buffer.append(input_object)
+
+    def nearest(self, buffer: deque, reference_time: float) -> Tuple[Optional[Any], int]:
+        """
+        @return: object of the buffer matching reference_time (or None) and number of buffered objects it consumes
+        """
+        times = [self.key(buffered) for buffered in buffer]
+        after = next((i for i, object_time in enumerate(times) if object_time >= reference_time), len(times) - 1)
+        if self.interpolate is not None and 0 < after and times[after] > reference_time >= times[after - 1]:
+            return self.interpolate(buffer[after - 1], buffer[after], reference_time), after
+        nearest = after
+        if after > 0 and reference_time - times[after - 1] < times[after] - reference_time:
+            nearest = after - 1
+        if abs(times[nearest] - reference_time) > self.tolerance:
+            return None, 0
+        return buffer[nearest], nearest + 1
+
+    def match(self, now: float) -> Optional[list]:
+        """
+        Finds one matched list of objects in the buffers, discarding objects that can't be matched anymore
+        @param now: current time of the clock used by key
+        @return: matched objects or None when more objects have to arrive first
+        """
+        while True:
+            inputs = [buffer for buffer in self.buffers if buffer]
+            if not inputs:
+                return None
+            # only inputs that delivered within max_delay are waited for, an idle camera doesn't delay matches
+            if any(not buffer and now - latest < self.max_delay for buffer, latest in zip(self.buffers, self.latest)) \
+                    and now - min(self.key(buffer[0]) for buffer in inputs) < self.max_delay:
+                return None
+            reference_time = max(self.key(buffer[0]) for buffer in inputs)
+            matches = []
+            unmatched = False
+            for buffer, latest in zip(self.buffers, self.latest):
+                if not buffer:
+                    continue
+                matched, consumed = self.nearest(buffer, reference_time)
+                if matched is not None:
+                    matches.append((buffer, matched, consumed))
+                elif self.key(buffer[-1]) < reference_time:
+                    if now - latest >= self.max_delay:
+                        # the input went idle, nothing will arrive to match its leftovers
+                        while buffer and self.key(buffer[0]) < reference_time - self.tolerance:
+                            buffer.popleft()
+                            self.discarded += 1
+                    elif now - reference_time < self.max_delay:
+                        # a matching object may still arrive
+                        return None
+                else:
+                    unmatched = True
+            if not unmatched:
+                for buffer, _, consumed in matches:
+                    self.discarded += consumed - 1
+                    for _ in range(consumed):
+                        buffer.popleft()
+                return [matched for _, matched, _ in matches]
+            # the object at the reference time can't be matched, neither can objects older than it
+            for buffer in inputs:
+                while buffer and (self.key(buffer[0]) < reference_time - self.tolerance or
+                                  self.key(buffer[0]) == reference_time):
+                    buffer.popleft()
+                    self.discarded += 1
+
+    def stop(self):
+        self.stop_event = True
+        self.selector.wake()
+
+    def is_stopped(self) -> bool:
+        return self.stop_event
+
+    def join(self, timeout: Optional[float] = None):
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
 
 
 """
@@ -112,60 +838,254 @@ class GetParent:
 
 
 """
-DataGetter is used to catch data input from a GetParent object
+DataGetter is used to catch data input from a GetParent object, overflow_policy and name work like in DataWorker
 """
 
 
 class DataGetter:
-    def __init__(self, output_object: List[Queue], get_parent: GetParent):
+    def __init__(self, output_object: List[Queue], get_parent: GetParent, overflow_policy: str = BLOCK,
+                 name: Optional[str] = None):
         self.output_object = output_object
         self.get_parent = get_parent
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self.metrics = REGISTRY.register("getter", name, self)
         self.stop_event = False
+        self.thread: Optional[threading.Thread] = None
 
     def start(self):
         self.stop_event = False
-        threading.Thread(target=self.run, args=()).start()
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.start()
 
     def run(self):
         while not self.stop_event:
+            start = time.perf_counter() if self.metrics.enabled else None
             current_obj = self.get_parent.get_data()
             if current_obj is not None:
-                for outputQueue in self.output_object:
-                    outputQueue.put(current_obj)
+                if start is not None:
+                    self.metrics.record(current_obj, time.perf_counter() - start)
+                self.dropped += put_to_queues(self.output_object, current_obj, self.overflow_policy, self.is_stopped)
         self.get_parent.stop()
 
     def stop(self):
         self.stop_event = True
 
+    def is_stopped(self) -> bool:
+        return self.stop_event
+
+    def join(self, timeout: Optional[float] = None):
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+
+"""
+PeriodicTask is a function executed every period seconds by a PeriodicScheduler. It keeps statistics of its ticks:
+lateness is the time between the deadline of a tick and the start of its execution
+"""
+
+
+class PeriodicTask:
+    def __init__(self, function: Callable[[], Any], period: float, name: str = ""):
+        self.function = function
+        self.period = period
+        self.name = name
+        self.active = True
+        # bumped when the task is added to or removed from a scheduler, deadlines of older generations are dropped
+        self.generation = 0
+        self.idle = threading.Event()
+        self.idle.set()
+        self.ticks = 0
+        self.skipped = 0
+        self.lateness_sum = 0.0
+        self.lateness_square_sum = 0.0
+        self.lateness_max = 0.0
+
+    def record(self, lateness: float):
+        self.ticks += 1
+        self.lateness_sum += lateness
+        self.lateness_square_sum += lateness * lateness
+        self.lateness_max = max(self.lateness_max, lateness)
+
+    def get_statistics(self) -> dict:
+        """
+        @return: number of executed and skipped ticks, mean and maximal lateness and jitter (standard deviation of
+            lateness) in seconds
+        """
+        mean = self.lateness_sum / self.ticks if self.ticks else 0.0
+        variance = self.lateness_square_sum / self.ticks - mean * mean if self.ticks else 0.0
+        return {
+            "ticks": self.ticks,
+            "skipped": self.skipped,
+            "mean lateness": mean,
+            "max lateness": self.lateness_max,
+            "jitter": max(variance, 0.0) ** 0.5
+        }
+
+
+"""
+PeriodicScheduler drives PeriodicTasks from a single timer thread on absolute deadlines (a tick is due exactly period
+seconds after the previous deadline, so periods don't drift) and executes them in a bounded pool of worker threads.
+A task never runs twice at the same time: a tick that is due while the previous one is still running, or that has
+already been missed, is skipped instead of being stacked
+"""
+
+
+class PeriodicScheduler:
+    def __init__(self, workers: int = 16):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="PeriodicScheduler")
+        self.deadlines: List[Tuple[float, int, int, PeriodicTask]] = []
+        self.condition = threading.Condition()
+        self.sequence = 0
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, task: PeriodicTask):
+        with self.condition:
+            task.active = True
+            task.generation += 1
+            self.push(time.monotonic(), task)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, args=(), daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    # the task's pending deadline is dropped when it comes due
+    def remove(self, task: PeriodicTask):
+        with self.condition:
+            task.active = False
+            task.generation += 1
+
+    def push(self, deadline: float, task: PeriodicTask):
+        self.sequence += 1
+        heapq.heappush(self.deadlines, (deadline, self.sequence, task.generation, task))
+
+    def run(self):
+        with self.condition:
+            while True:
+                if not self.deadlines:
+                    self.condition.wait()
+                    continue
+                deadline, _, generation, task = self.deadlines[0]
+                if not task.active or generation != task.generation:
+                    heapq.heappop(self.deadlines)
+                    continue
+                now = time.monotonic()
+                if deadline > now:
+                    self.condition.wait(deadline - now)
+                    continue
+                heapq.heappop(self.deadlines)
+                if task.idle.is_set():
+                    task.idle.clear()
+                    try:
+                        future = self.executor.submit(self.execute, task, deadline)
+                    except RuntimeError:
+                        # the executor was shut down with the interpreter
+                        task.idle.set()
+                        self.thread = None
+                        return
+                    future.add_done_callback(lambda done, name=task.name: self.report(name, done))
+                else:
+                    task.skipped += 1
+                missed = int((now - deadline) // task.period)
+                task.skipped += missed
+                self.push(deadline + (missed + 1) * task.period, task)
+
+    @staticmethod
+    def report(name: str, future: Future):
+        exception = None if future.cancelled() else future.exception()
+        if exception is not None:
+            print("PeriodicTask {} failed: {}".format(name, exception))
+
+    @staticmethod
+    def execute(task: PeriodicTask, deadline: float):
+        task.record(time.monotonic() - deadline)
+        try:
+            task.function()
+        finally:
+            task.idle.set()
+
+    # statistics of active tasks, by task name
+    def get_statistics(self) -> Dict[str, dict]:
+        with self.condition:
+            return {task.name: task.get_statistics() for _, _, generation, task in self.deadlines
+                    if task.active and generation == task.generation}
+
+
+_default_scheduler: Optional[PeriodicScheduler] = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler() -> PeriodicScheduler:
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = PeriodicScheduler()
+        return _default_scheduler
+
+
+# use it before periodic stages are created to change the number of worker threads
+def set_default_scheduler(scheduler: PeriodicScheduler):
+    global _default_scheduler
+    with _default_scheduler_lock:
+        _default_scheduler = scheduler
+
+
+"""
+PeriodicDataGetter gets data from a GetParent every period seconds, ticks are driven by a PeriodicScheduler
+(the shared default one unless a scheduler is passed). Changing period takes effect from the next tick
+"""
+
 
 class PeriodicDataGetter:
     def __init__(self,
                  output_object: List[Queue],
                  get_parent: GetParent,
-                 frequency: float):
+                 frequency: float,
+                 overflow_policy: str = BLOCK,
+                 scheduler: Optional[PeriodicScheduler] = None,
+                 name: str = "getter"):
         self.output_object = output_object
         self.get_parent = get_parent
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self.metrics = REGISTRY.register("getter", name, self)
         self.stop_event = False
-        self.period = 1/frequency
+        self.scheduler = scheduler
+        self.task = PeriodicTask(self.get_data, 1/frequency, name)
+
+    @property
+    def period(self) -> float:
+        return self.task.period
+
+    @period.setter
+    def period(self, period: float):
+        self.task.period = period
 
     def get_data(self):
+        start = time.perf_counter() if self.metrics.enabled else None
         current_obj = self.get_parent.get_data()
         if current_obj is not None:
-            for outputQueue in self.output_object:
-                outputQueue.put(current_obj)
-
-    def main_loop(self):
-        while not self.stop_event:
-            threading.Thread(target=self.get_data, args=()).start()
-            time.sleep(self.period)
-        self.stop_event = True
+            if start is not None:
+                self.metrics.record(current_obj, time.perf_counter() - start)
+            self.dropped += put_to_queues(self.output_object, current_obj, self.overflow_policy, self.is_stopped)
 
     def start(self):
         self.stop_event = False
-        threading.Thread(target=self.main_loop, args=()).start()
+        if self.scheduler is None:
+            self.scheduler = get_default_scheduler()
+        self.scheduler.add(self.task)
 
     def stop(self):
         self.stop_event = True
+        if self.scheduler is not None:
+            self.scheduler.remove(self.task)
+
+    def is_stopped(self) -> bool:
+        return self.stop_event
+
+    # waits until the tick being executed is finished
+    def join(self, timeout: Optional[float] = None):
+        self.task.idle.wait(timeout)
 
 
 """
@@ -185,61 +1105,107 @@ class SinkParent:
 
 
 """
-DataSink executes the sin_data(input_object: list) function on objects incoming to each of input queues
+DataSink executes the sin_data(input_object: list) function on objects incoming to each of input queues. Like
+DataWorker it waits for data unless blocking=False is passed. Latency measured by its metrics is the time from capture
+of the oldest sunk object to the end of sink_data()
 """
 
 
 class DataSink:
-    def __init__(self, input_object: List[Queue], sink_parent: SinkParent):
+    def __init__(self,
+                 input_object: List[Queue],
+                 sink_parent: SinkParent,
+                 blocking: bool = True,
+                 timeout: float = 0.1,
+                 name: Optional[str] = None):
         self.input_object = input_object
         self.sink_parent = sink_parent
+        self.blocking = blocking
+        self.timeout = timeout
+        self.selector = QueueSelector(self.input_object)
+        self.metrics = REGISTRY.register("sink", name, self, self.input_object)
         self.stop_event = False
+        self.thread: Optional[threading.Thread] = None
 
     def start(self):
         self.stop_event = False
-        threading.Thread(target=self.run, args=()).start()
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.start()
 
     def run(self):
         while not self.stop_event:
-            if self.input_object:
-                current_obj = []
-                for input_queue in self.input_object:
-                    if not input_queue.empty():
-                        current_obj.append(input_queue.get())
-                if current_obj:
-                    self.sink_parent.sink_data(current_obj)
-
+            if self.blocking:
+                current_obj = self.selector.select(self.timeout)
+            else:
+                current_obj = self.selector.get_available()
+            if current_obj:
+                self.sink_data(current_obj)
+        self.selector.unregister()
         self.sink_parent.stop()
 
+    def sink_data(self, current_obj: list):
+        if not self.metrics.enabled:
+            self.sink_parent.sink_data(current_obj)
+            return
+        start = time.perf_counter()
+        self.sink_parent.sink_data(current_obj)
+        self.metrics.record(current_obj, time.perf_counter() - start)
+
     def stop(self):
         self.stop_event = True
+        self.selector.wake()
+
+    def join(self, timeout: Optional[float] = None):
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+
+"""
+PeriodicDataSink executes sink_data(input_object: list) every period seconds on objects available in the input
+queues, ticks are driven by a PeriodicScheduler like in PeriodicDataGetter
+"""
 
 
 class PeriodicDataSink:
-    def __init__(self, input_object: List[Queue], sink_parent: SinkParent, frequency: float):
+    def __init__(self, input_object: List[Queue], sink_parent: SinkParent, frequency: float,
+                 scheduler: Optional[PeriodicScheduler] = None, name: str = "sink"):
         self.input_object = input_object
         self.sink_parent = sink_parent
+        self.selector = QueueSelector(self.input_object)
+        self.metrics = REGISTRY.register("sink", name, self, self.input_object)
         self.stop_event = False
-        self.period = 1/frequency
+        self.scheduler = scheduler
+        self.task = PeriodicTask(self.sink_data, 1/frequency, name)
 
-    def sink_data(self):
-        if self.input_object:
-            current_obj = []
-            for input_queue in self.input_object:
-                if not input_queue.empty():
-                    current_obj.append(input_queue.get())
-            if current_obj:
-                self.sink_parent.sink_data(current_obj)
+    @property
+    def period(self) -> float:
+        return self.task.period
 
-    def main_loop(self):
-        while not self.stop_event:
-            threading.Thread(target=self.sink_data, args=()).start()
-            time.sleep(self.period)
-        self.stop_event = True
+    @period.setter
+    def period(self, period: float):
+        self.task.period = period
+
+    def sink_data(self):
+        current_obj = self.selector.get_available()
+        if not current_obj:
+            return
+        if not self.metrics.enabled:
+            self.sink_parent.sink_data(current_obj)
+            return
+        start = time.perf_counter()
+        self.sink_parent.sink_data(current_obj)
+        self.metrics.record(current_obj, time.perf_counter() - start)
 
     def start(self):
         self.stop_event = False
-        threading.Thread(target=self.main_loop, args=()).start()
+        if self.scheduler is None:
+            self.scheduler = get_default_scheduler()
+        self.scheduler.add(self.task)
 
     def stop(self):
-        self.stop_event = True
\ No newline at end of file
+        self.stop_event = True
+        if self.scheduler is not None:
+            self.scheduler.remove(self.task)
+
+    def join(self, timeout: Optional[float] = None):
+        self.task.idle.wait(timeout)
@@ -0,0 +1,178 @@
+import bisect
+import threading
+import time
+import weakref
+from queue import Queue
+from typing import List, Optional, Any, Callable, Dict, Tuple
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def get_percentile(self, percentile: float) -> float:
+        """
+        @return: upper bound of the bucket holding the given percentile (0-100) of observed values
+        """
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return 0.0
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            cumulative += bucket_count
+            if cumulative >= count * percentile / 100:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def to_prometheus(self, name: str, labels: str) -> List[str]:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        lines = []
+        cumulative = 0
+        for bucket, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = "+Inf" if bucket == float("inf") else repr(bucket)
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, le, cumulative))
+        lines.append("{}_sum{{{}}} {}".format(name, labels, total))
+        lines.append("{}_count{{{}}} {}".format(name, labels, count))
+        return lines
+
+
+def _capture_time(output: Any) -> Optional[float]:
+    if isinstance(output, list):
+        capture_times = [_capture_time(element) for element in output]
+        capture_times = [capture_time for capture_time in capture_times if capture_time is not None]
+        return min(capture_times) if capture_times else None
+    return getattr(output, "capture_time", None)
+
+
+class StageMetrics:
+    """
+    Metrics of one pipeline stage: number of processed objects, processing time, latency since capture of
+    processed objects (for objects with a capture_time), time spent in each operation of an OperationChain, depth of
+    input queues and number of dropped objects. Stages check enabled before measuring anything, so disabled metrics
+    cost one attribute lookup per object
+    """
+    def __init__(self, kind: str, name: str, stage: Any, input_queues: Optional[List[Queue]] = None):
+        self.kind = kind
+        self.name = name
+        self.enabled = False
+        self.stage = weakref.ref(stage)
+        self.input_queues = input_queues if input_queues is not None else []
+        self.processed = 0
+        self.processing_time = Histogram()
+        self.latency = Histogram()
+        self.operation_time: Dict[str, Histogram] = {}
+
+    def record(self, output: Any, processing_time: Optional[float] = None):
+        self.processed += 1
+        if processing_time is not None:
+            self.processing_time.observe(processing_time)
+        capture_time = _capture_time(output)
+        if capture_time is not None:
+            self.latency.observe(time.monotonic() - capture_time)
+
+    def record_operation(self, operation_name: str, operation_time: float):
+        histogram = self.operation_time.get(operation_name)
+        if histogram is None:
+            histogram = self.operation_time.setdefault(operation_name, Histogram())
+        histogram.observe(operation_time)
+
+    def get_queue_depth(self) -> int:
+        return sum(input_queue.qsize() for input_queue in list(self.input_queues))
+
+    def get_dropped(self) -> int:
+        stage = self.stage()
+        return getattr(stage, "dropped", 0) if stage is not None else 0
+
+
+class MetricsRegistry:
+    """
+    Keeps metrics of all stages alive in this process and renders them in the Prometheus text format. Metrics are
+    collected only after enable() is called
+    """
+    def __init__(self):
+        self.enabled = False
+        self.stages: "weakref.WeakValueDictionary[int, StageMetrics]" = weakref.WeakValueDictionary()
+        self.gauges: Dict[str, Callable[[], Dict[str, float]]] = {}
+        self.lock = threading.Lock()
+
+    def register(self, kind: str, name: Optional[str], stage: Any,
+                 input_queues: Optional[List[Queue]] = None) -> StageMetrics:
+        metrics = StageMetrics(kind, name if name is not None else "{}-{}".format(kind, id(stage)), stage,
+                               input_queues)
+        metrics.enabled = self.enabled
+        with self.lock:
+            self.stages[id(metrics)] = metrics
+        return metrics
+
+    def add_gauge(self, name: str, collect: Callable[[], Dict[str, float]]):
+        """
+        Adds a gauge read when metrics are rendered
+        @param name: name of the metric
+        @param collect: function returning values of the gauge by stage name
+        """
+        self.gauges[name] = collect
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+        with self.lock:
+            stages = list(self.stages.values())
+        for metrics in stages:
+            metrics.enabled = enabled
+
+    def get_stages(self) -> List[StageMetrics]:
+        with self.lock:
+            return sorted(self.stages.values(), key=lambda metrics: (metrics.kind, metrics.name))
+
+    def to_prometheus(self) -> str:
+        stages = self.get_stages()
+        lines = ["# TYPE pipeline_objects_total counter"]
+        lines += ['pipeline_objects_total{{{}}} {}'.format(_labels(metrics), metrics.processed) for metrics in stages]
+        lines.append("# TYPE pipeline_dropped_total counter")
+        lines += ['pipeline_dropped_total{{{}}} {}'.format(_labels(metrics), metrics.get_dropped())
+                  for metrics in stages]
+        lines.append("# TYPE pipeline_queue_depth gauge")
+        lines += ['pipeline_queue_depth{{{}}} {}'.format(_labels(metrics), metrics.get_queue_depth())
+                  for metrics in stages]
+        lines.append("# TYPE pipeline_processing_seconds histogram")
+        for metrics in stages:
+            lines += metrics.processing_time.to_prometheus("pipeline_processing_seconds", _labels(metrics))
+        lines.append("# TYPE pipeline_latency_seconds histogram")
+        for metrics in stages:
+            lines += metrics.latency.to_prometheus("pipeline_latency_seconds", _labels(metrics))
+        lines.append("# TYPE pipeline_operation_seconds histogram")
+        for metrics in stages:
+            for operation_name, histogram in list(metrics.operation_time.items()):
+                lines += histogram.to_prometheus("pipeline_operation_seconds",
+                                                 '{},operation="{}"'.format(_labels(metrics), operation_name))
+        for name, collect in list(self.gauges.items()):
+            lines.append("# TYPE {} gauge".format(name))
+            lines += ['{}{{stage="{}"}} {}'.format(name, stage, value) for stage, value in collect().items()]
+        return "\n".join(lines) + "\n"
+
+
+def _labels(metrics: StageMetrics) -> str:
+    return 'kind="{}",stage="{}"'.format(metrics.kind, metrics.name)
+
+
+# registry used by all stages of multiThreadDataProcessing
+REGISTRY = MetricsRegistry()
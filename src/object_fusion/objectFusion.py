@@ -0,0 +1,158 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
+from src.data_model.dataModel import Detections
+from src.data_model.dataModel import FusedObjects
+
+
+class FusionEngine:
+    """
+    Fuses detections of all cameras into world poses of objects. The latest detections of every camera are kept in a
+    (cameras x objects x 3) array of pixel x, y and rotation. When a camera's detections arrive they are transformed
+    to the world with the camera's rotation precomputed from camera_data, so fusing only sums (cameras x objects)
+    arrays: positions are averaged over cameras seeing an object, rotations are averaged as angles (circular mean).
+    Objects set by set_objects() are swapped in by the next update, on the thread that fuses
+    """
+    def __init__(self, object_indexes: List[int], camera_data: Dict[int, Tuple]):
+        self.object_indexes: List[int] = list(object_indexes)
+        self.next_object_indexes: List[int] = self.object_indexes
+        self.object_columns: Dict[int, int] = {index: column for column, index in enumerate(self.object_indexes)}
+        self.camera_data = camera_data
+        self.known_camera_data: Dict[int, Tuple] = {}
+        self.camera_indexes: List[int] = []
+        self.camera_rows: Dict[int, int] = {}
+        self.offsets = np.zeros((0, 2))
+        self.angles = np.zeros(0)
+        self.cosines = np.zeros(0)
+        self.sines = np.zeros(0)
+        objects = len(self.object_indexes)
+        self.pixels = np.full((0, objects, 3), np.nan)
+        self.camera_poses = np.full((0, objects, 3), np.nan)
+        self.seen = np.zeros((0, objects), bool)
+        # x, y, sine and cosine of rotation in the world, zero where the camera doesn't see the object
+        self.terms = np.zeros((0, objects, 4))
+
+    def set_objects(self, object_indexes: List[int]):
+        self.next_object_indexes = list(object_indexes)
+
+    def update_objects(self):
+        """
+        Resizes the arrays to the objects set by set_objects(), detections of objects that are still present are kept
+        """
+        object_indexes = self.next_object_indexes
+        if object_indexes == self.object_indexes:
+            return
+        cameras = len(self.camera_indexes)
+        pixels = np.full((cameras, len(object_indexes), 3), np.nan)
+        for column, object_index in enumerate(object_indexes):
+            if object_index in self.object_columns:
+                pixels[:, column] = self.pixels[:, self.object_columns[object_index]]
+        self.pixels = pixels
+        self.camera_poses = np.full((cameras, len(object_indexes), 3), np.nan)
+        self.seen = np.zeros((cameras, len(object_indexes)), bool)
+        self.terms = np.zeros((cameras, len(object_indexes), 4))
+        self.object_indexes = object_indexes
+        self.object_columns = {index: column for column, index in enumerate(object_indexes)}
+        for row in range(cameras):
+            self.transform_row(row)
+
+    def update_cameras(self):
+        """
+        Rebuilds per-camera transforms when a camera was added or its camera_data entry was replaced, detections of
+        cameras that are still present are kept
+        """
+        if len(self.camera_data) == len(self.known_camera_data) and all(
+                self.known_camera_data.get(index) is data for index, data in self.camera_data.items()):
+            return
+        camera_data = dict(self.camera_data)
+        camera_indexes = list(camera_data.keys())
+        objects = len(self.object_indexes)
+        pixels = np.full((len(camera_indexes), objects, 3), np.nan)
+        for row, camera_index in enumerate(camera_indexes):
+            if camera_index in self.camera_rows:
+                pixels[row] = self.pixels[self.camera_rows[camera_index]]
+        self.offsets = np.array([[data[0], data[1]] for data in camera_data.values()], float).reshape(-1, 2)
+        self.angles = np.array([data[2] for data in camera_data.values()], float)
+        self.cosines = np.cos(self.angles)
+        self.sines = np.sin(self.angles)
+        self.pixels = pixels
+        self.camera_poses = np.full((len(camera_indexes), objects, 3), np.nan)
+        self.seen = np.zeros((len(camera_indexes), objects), bool)
+        self.terms = np.zeros((len(camera_indexes), objects, 4))
+        self.camera_indexes = camera_indexes
+        self.camera_rows = {camera_index: row for row, camera_index in enumerate(camera_indexes)}
+        self.known_camera_data = camera_data
+        for row in range(len(camera_indexes)):
+            self.transform_row(row)
+
+    def transform_row(self, row: int):
+        x, y, rot = self.pixels[row, :, 0], self.pixels[row, :, 1], self.pixels[row, :, 2]
+        poses = self.camera_poses[row]
+        poses[:, 0] = self.offsets[row, 0] + x * self.cosines[row] - y * self.sines[row]
+        poses[:, 1] = self.offsets[row, 1] + x * self.sines[row] + y * self.cosines[row]
+        poses[:, 2] = np.mod(rot + self.angles[row], 2 * np.pi)
+        seen = ~np.isnan(x)
+        self.seen[row] = seen
+        terms = self.terms[row]
+        terms[:] = 0
+        terms[seen, 0] = poses[seen, 0]
+        terms[seen, 1] = poses[seen, 1]
+        terms[seen, 2] = np.sin(poses[seen, 2])
+        terms[seen, 3] = np.cos(poses[seen, 2])
+
+    def update(self, detected_frames: List[Detections]):
+        """
+        Replaces detections of the cameras of detected_frames and fills in world poses of their detections
+        """
+        self.update_objects()
+        self.update_cameras()
+        for detected_frame in detected_frames:
+            row = self.camera_rows.get(detected_frame.camera_index)
+            if row is None:
+                continue
+            detections = detected_frame.detections
+            columns = np.array([self.object_columns.get(object_index, -1)
+                                for object_index in detections["object"].tolist()], np.intp)
+            known = columns >= 0
+            columns = columns[known]
+            camera_pixels = self.pixels[row]
+            camera_pixels[:] = np.nan
+            camera_pixels[columns, :2] = detections["center"][known]
+            camera_pixels[columns, 2] = detections["rot"][known]
+            self.transform_row(row)
+            detections["world"][known] = self.camera_poses[row, columns]
+
+    def fuse(self, frames: Dict[int, Detections]) -> FusedObjects:
+        count = self.seen.sum(axis=0)
+        visible = count > 0
+        sums = self.terms.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            positions = sums[:, :2] / count[:, None]
+        rots = np.where(visible, np.mod(np.arctan2(sums[:, 2], sums[:, 3]), 2 * np.pi), np.nan)
+        return FusedObjects(self.object_indexes, list(self.camera_indexes), positions, rots, visible,
+                            self.camera_poses.copy(), self.pixels.copy(), self.offsets, self.angles, frames)
+
+
+class FuseObjectsTransform(mtl.OperationParent):
+    """
+    Fusion stage, takes detected frames from any number of cameras, or lists of them matched by DataSynchronizer,
+    and returns FusedObjects
+    """
+    def __init__(self, object_indexes: List[int], camera_data: Dict[int, Tuple]):
+        super().__init__()
+        self.engine = FusionEngine(object_indexes, camera_data)
+
+    def set_objects(self, object_indexes: List[int]):
+        self.engine.set_objects(object_indexes)
+
+    def run(self, input_object: list) -> FusedObjects:
+        detected_frames: List[Detections] = []
+        for detected in input_object:
+            if isinstance(detected, list):
+                detected_frames.extend(detected)
+            else:
+                detected_frames.append(detected)
+        self.engine.update(detected_frames)
+        return self.engine.fuse({detected_frame.camera_index: detected_frame for detected_frame in detected_frames})
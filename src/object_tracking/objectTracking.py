@@ -0,0 +1,163 @@
+import copy
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
+from src.data_model.dataModel import FusedObjects
+
+
+def wrap_angles(angles: np.ndarray) -> np.ndarray:
+    """
+    @return: angles wrapped to [-pi, pi)
+    """
+    return np.mod(angles + np.pi, 2 * np.pi) - np.pi
+
+
+class ObjectTracker(mtl.SinkParent):
+    """
+    Alpha-beta filter of fused object poses. The state of all objects is kept in arrays indexed by the order of
+    object_indexes: positions and velocities (objects x 2), angles and angular velocities (objects) and the capture
+    time of the last measurement. Each fused batch updates all measured objects at once, between measurements poses
+    are extrapolated with the estimated velocities, so they can be queried at any time. An object that wasn't measured
+    for max_age seconds is no longer predicted and starts from its next measurement again. set_objects() keeps the
+    state of objects that are still present, added objects start from their first measurement.
+    Run it in a DataSink after fusion, times are time.monotonic() like capture times of frames
+    """
+    def __init__(self, object_indexes: List[int], alpha: float = 0.5, beta: float = 0.1, max_age: float = 0.5):
+        super().__init__()
+        self.object_indexes: List[int] = list(object_indexes)
+        self.object_columns: Dict[int, int] = {index: column for column, index in enumerate(self.object_indexes)}
+        self.alpha = alpha
+        self.beta = beta
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        objects = len(self.object_indexes)
+        self.positions = np.zeros((objects, 2))
+        self.velocities = np.zeros((objects, 2))
+        self.angles = np.zeros(objects)
+        self.angular_velocities = np.zeros(objects)
+        self.updated = np.full(objects, -np.inf)
+        self.last_fused: Optional[FusedObjects] = None
+
+    def update(self, fused: FusedObjects, capture_time: Optional[float] = None):
+        """
+        @param capture_time: time of the measurement, capture_time of fused (or now when it has no frames) when None
+        """
+        if capture_time is None:
+            capture_time = fused.capture_time if fused.capture_time is not None else time.monotonic()
+        with self.lock:
+            columns = np.array([self.object_columns.get(index, -1) for index in fused.object_indexes], np.intp)
+            measured = fused.visible & (columns >= 0)
+            columns = columns[measured]
+            positions = fused.positions[measured]
+            angles = fused.rots[measured]
+            dt = capture_time - self.updated[columns]
+            # older than the state (out of order, or the same capture fused again), nothing to learn from
+            newer = dt > 0
+            columns, positions, angles, dt = columns[newer], positions[newer], angles[newer], dt[newer]
+            lost = dt > self.max_age
+            tracked = ~lost
+            self.positions[columns[lost]] = positions[lost]
+            self.velocities[columns[lost]] = 0
+            self.angles[columns[lost]] = angles[lost]
+            self.angular_velocities[columns[lost]] = 0
+            tracked_columns = columns[tracked]
+            dt = dt[tracked]
+            predicted = self.positions[tracked_columns] + self.velocities[tracked_columns] * dt[:, None]
+            residuals = positions[tracked] - predicted
+            self.positions[tracked_columns] = predicted + self.alpha * residuals
+            self.velocities[tracked_columns] += self.beta / dt[:, None] * residuals
+            predicted_angles = self.angles[tracked_columns] + self.angular_velocities[tracked_columns] * dt
+            angle_residuals = wrap_angles(angles[tracked] - predicted_angles)
+            self.angles[tracked_columns] = np.mod(predicted_angles + self.alpha * angle_residuals, 2 * np.pi)
+            self.angular_velocities[tracked_columns] += self.beta / dt * angle_residuals
+            self.updated[columns] = capture_time
+            self.last_fused = fused
+
+    def set_objects(self, object_indexes: List[int]):
+        object_indexes = list(object_indexes)
+        with self.lock:
+            if object_indexes == self.object_indexes:
+                return
+            kept = [(column, self.object_columns[index]) for column, index in enumerate(object_indexes)
+                    if index in self.object_columns]
+            columns = np.array([column for column, _ in kept], np.intp)
+            old_columns = np.array([old_column for _, old_column in kept], np.intp)
+            objects = len(object_indexes)
+            positions, velocities = np.zeros((objects, 2)), np.zeros((objects, 2))
+            angles, angular_velocities = np.zeros(objects), np.zeros(objects)
+            updated = np.full(objects, -np.inf)
+            positions[columns] = self.positions[old_columns]
+            velocities[columns] = self.velocities[old_columns]
+            angles[columns] = self.angles[old_columns]
+            angular_velocities[columns] = self.angular_velocities[old_columns]
+            updated[columns] = self.updated[old_columns]
+            self.positions, self.velocities = positions, velocities
+            self.angles, self.angular_velocities = angles, angular_velocities
+            self.updated = updated
+            self.object_indexes = object_indexes
+            self.object_columns = {index: column for column, index in enumerate(object_indexes)}
+
+    def predict(self, at: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        @param at: time of the prediction, now when None
+        @return: positions (objects x 2), rotations (objects) and visible (objects) at the time, poses of objects that
+            aren't tracked are NaN
+        """
+        if at is None:
+            at = time.monotonic()
+        with self.lock:
+            return self.extrapolate(at)
+
+    def extrapolate(self, at: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        age = at - self.updated
+        visible = age <= self.max_age
+        # don't extrapolate backwards before the last measurement or beyond max_age
+        dt = np.clip(age, 0, self.max_age)
+        positions = self.positions + self.velocities * dt[:, None]
+        rots = np.mod(self.angles + self.angular_velocities * dt, 2 * np.pi)
+        positions[~visible] = np.nan
+        rots[~visible] = np.nan
+        return positions, rots, visible
+
+    def predict_fused(self, at: Optional[float] = None) -> Optional[FusedObjects]:
+        """
+        @return: the last fused objects with poses predicted at the time, None before anything was fused
+        """
+        if at is None:
+            at = time.monotonic()
+        last_fused = self.last_fused
+        if last_fused is None:
+            return None
+        with self.lock:
+            # poses and objects of the same version when objects were changed meanwhile
+            object_indexes = self.object_indexes
+            positions, rots, visible = self.extrapolate(at)
+        fused = copy.copy(last_fused)
+        fused.object_indexes = object_indexes
+        fused.positions = positions
+        fused.rots = rots
+        fused.visible = visible
+        fused.timestamp = datetime.now().timestamp() + at - time.monotonic()
+        return fused
+
+    def sink_data(self, input_object: list):
+        for fused in input_object:
+            if isinstance(fused, FusedObjects):
+                self.update(fused)
+
+
+class PredictedObjectsGetter(mtl.GetParent):
+    """
+    Returns the poses of the tracker predicted at the time it's called, run it in a PeriodicDataGetter to get smooth
+    output at a higher rate than cameras capture
+    """
+    def __init__(self, tracker: ObjectTracker):
+        super().__init__(tracker)
+
+    def get_data(self) -> Optional[FusedObjects]:
+        return self.side_input.predict_fused()
@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Set
+
+import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
+from src.data_model.dataModel import FusedObjects
+
+
+class PoseSubscriber:
+    """
+    Bounded buffer of poses pushed to one subscriber, only of objects in object_indexes when given. When the
+    subscriber doesn't keep up the oldest poses are dropped, the pipeline never waits for it
+    """
+    def __init__(self, object_indexes: Optional[Set[int]] = None, buffer_size: int = 256):
+        self.object_indexes = object_indexes
+        self.poses = deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+        self.dropped = 0
+
+    def push(self, poses: List[Dict]):
+        if self.object_indexes is not None:
+            poses = [pose for pose in poses if pose["id"] in self.object_indexes]
+        if not poses:
+            return
+        with self.condition:
+            self.dropped += max(0, len(self.poses) + len(poses) - self.poses.maxlen)
+            self.poses.extend(poses)
+            self.condition.notify()
+
+    def take(self, timeout: float) -> List[Dict]:
+        """
+        @return: all buffered poses, empty if none were pushed within timeout seconds
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.poses, timeout)
+            poses = list(self.poses)
+            self.poses.clear()
+            return poses
+
+
+class PoseFeed(mtl.SinkParent):
+    """
+    Keeps a table of the latest pose of each object and pushes fused poses to subscribers as they are produced. Run
+    it in a DataSink after fusion, the table serves polling clients without touching the pipeline
+    """
+    def __init__(self, buffer_size: int = 256):
+        super().__init__()
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.latest: Dict[int, Dict] = {}
+        self.subscribers: List[PoseSubscriber] = []
+
+    def sink_data(self, input_object: list):
+        for fused in input_object:
+            if not isinstance(fused, FusedObjects):
+                continue
+            poses = fused.to_poses()
+            with self.lock:
+                for pose in poses:
+                    self.latest[pose["id"]] = pose
+                subscribers = list(self.subscribers)
+            for subscriber in subscribers:
+                subscriber.push(poses)
+
+    def get_latest(self, object_indexes: Optional[Set[int]] = None) -> List[Dict]:
+        with self.lock:
+            return [pose for index, pose in sorted(self.latest.items())
+                    if object_indexes is None or index in object_indexes]
+
+    def subscribe(self, object_indexes: Optional[Set[int]] = None) -> PoseSubscriber:
+        subscriber = PoseSubscriber(object_indexes, self.buffer_size)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: PoseSubscriber):
+        with self.lock:
+            self.subscribers.remove(subscriber)
+
+    def events(self,
+               object_indexes: Optional[Set[int]] = None,
+               max_rate: Optional[float] = None,
+               keepalive: float = 15.0) -> Iterator[str]:
+        """
+        Generates a text/event-stream (Server-Sent Events) response, each event holds a JSON list of poses. With
+        max_rate at most max_rate events are sent per second and each carries only the newest pose of each object
+        buffered since the previous one
+        @param object_indexes: only poses of these objects
+        @param max_rate: events per second, unlimited when None
+        @param keepalive: seconds without poses after which a comment is sent, so proxies keep the connection open
+        """
+        subscriber = self.subscribe(object_indexes)
+        try:
+            next_event = 0.0
+            while True:
+                if max_rate:
+                    time.sleep(max(0.0, next_event - time.monotonic()))
+                poses = subscriber.take(keepalive)
+                if not poses:
+                    yield ": keepalive\n\n"
+                    continue
+                if max_rate:
+                    poses = list({pose["id"]: pose for pose in poses}.values())
+                    next_event = time.monotonic() + 1 / max_rate
+                yield "data: {}\n\n".format(json.dumps(poses))
+        finally:
+            self.unsubscribe(subscriber)
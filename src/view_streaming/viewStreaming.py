@@ -0,0 +1,86 @@
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+MJPEG_BOUNDARY = "frame"
+
+
+class FrameBroadcaster:
+    """
+    Hands rendered views to any number of streaming clients. Each view is encoded to JPEG once per render and only
+    while some client watches it. Clients always get the newest encoding of their view, frames published while a
+    client was still sending the previous one are skipped, so slow clients add neither latency nor memory
+    """
+    def __init__(self, quality: int = 80):
+        self.quality = quality
+        self.condition = threading.Condition()
+        self.frames: Dict[str, Tuple[int, bytes]] = {}
+        self.clients: Dict[str, int] = {}
+        self.views: List[str] = []
+        self.sequence = 0
+        self.encoded = 0
+
+    def publish(self, views: Dict[str, np.ndarray]):
+        with self.condition:
+            watched = [name for name in views.keys() if self.clients.get(name)]
+        encoded = {}
+        for name in watched:
+            ok, jpeg = cv2.imencode(".jpg", views[name], [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if ok:
+                encoded[name] = jpeg.tobytes()
+        with self.condition:
+            self.sequence += 1
+            self.encoded += len(encoded)
+            self.views = list(views.keys())
+            for name, jpeg in encoded.items():
+                self.frames[name] = (self.sequence, jpeg)
+            self.condition.notify_all()
+
+    def get_views(self) -> List[str]:
+        with self.condition:
+            return list(self.views)
+
+    def wait_frame(self, name: str, last_sequence: int, timeout: float) -> Optional[Tuple[int, bytes]]:
+        """
+        @return: sequence number and JPEG of the newest frame of the view published after last_sequence, None if
+            nothing was published within timeout seconds
+        """
+        def is_new() -> bool:
+            return self.frames.get(name, (0, b""))[0] > last_sequence
+
+        with self.condition:
+            if not self.condition.wait_for(is_new, timeout):
+                return None
+            return self.frames[name]
+
+    def subscribe(self, name: str):
+        with self.condition:
+            self.clients[name] = self.clients.get(name, 0) + 1
+
+    def unsubscribe(self, name: str):
+        with self.condition:
+            self.clients[name] -= 1
+            if not self.clients[name]:
+                self.clients.pop(name)
+                # don't send a stale frame to the next client
+                self.frames.pop(name, None)
+
+    def stream(self, name: str, timeout: float = 1.0) -> Iterator[bytes]:
+        """
+        Generates parts of a multipart/x-mixed-replace (MJPEG) response with frames of the view, until the client
+        disconnects and the generator is closed
+        """
+        self.subscribe(name)
+        try:
+            sequence = 0
+            while True:
+                frame = self.wait_frame(name, sequence, timeout)
+                if frame is None:
+                    continue
+                sequence, jpeg = frame
+                yield b"--" + MJPEG_BOUNDARY.encode() + b"\r\nContent-Type: image/jpeg\r\nContent-Length: " + \
+                    str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n"
+        finally:
+            self.unsubscribe(name)
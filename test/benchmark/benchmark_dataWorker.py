@@ -0,0 +1,70 @@
+"""
+Compares busy polling (blocking=False) with waiting for data (blocking=True) in DataWorker.
+Reports CPU usage of idle workers and end-to-end latency of objects passed through a chain of workers.
+Run from the repository root: PYTHONPATH=. python test/benchmark/benchmark_dataWorker.py
+"""
+import argparse
+import time
+from queue import Queue
+from typing import List
+
+import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
+
+
+def measure_idle_cpu(workers: int, blocking: bool, duration: float) -> float:
+    data_workers = [mtl.DataWorker([mtl.DataQueue() for _ in range(8)], [Queue()], mtl.OperationChain(),
+                                   blocking=blocking)
+                    for _ in range(workers)]
+    for data_worker in data_workers:
+        data_worker.start()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    time.sleep(duration)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    for data_worker in data_workers:
+        data_worker.stop()
+    for data_worker in data_workers:
+        data_worker.join()
+    return 100 * cpu / wall
+
+
+def measure_latency(stages: int, blocking: bool, samples: int, interval: float) -> List[float]:
+    queues = [mtl.DataQueue() for _ in range(stages + 1)]
+    data_workers = [mtl.DataWorker([queues[i]], [queues[i + 1]], mtl.OperationChain(), blocking=blocking)
+                    for i in range(stages)]
+    for data_worker in data_workers:
+        data_worker.start()
+    latencies = []
+    for _ in range(samples):
+        queues[0].put(time.perf_counter())
+        sent = queues[-1].get()
+        while isinstance(sent, list):
+            sent = sent[0]
+        latencies.append(time.perf_counter() - sent)
+        time.sleep(interval)
+    for data_worker in data_workers:
+        data_worker.stop()
+    for data_worker in data_workers:
+        data_worker.join()
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=2.0)
+    parser.add_argument("--stages", type=int, default=3)
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+    for blocking in (False, True):
+        mode = "blocking" if blocking else "busy polling"
+        cpu = measure_idle_cpu(args.workers, blocking, args.duration)
+        latencies = measure_latency(args.stages, blocking, args.samples, 0.005)
+        print("{}: idle CPU of {} workers: {:.1f}%, latency through {} stages: p50 {:.1f} us, p99 {:.1f} us".format(
+            mode, args.workers, cpu, args.stages,
+            latencies[len(latencies) // 2] * 1e6, latencies[int(len(latencies) * 0.99)] * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Measures per-frame time of DetectObjectsTransform on a set of rendered frames, with a detector built for every frame
+(as before detectors were cached) and with the cached detector.
+Run from the repository root: PYTHONPATH=. python test/benchmark/benchmark_detection.py
+"""
+import argparse
+import time
+from typing import List
+
+import numpy as np
+
+from src.camera_io.cameraIO import Settings
+from src.data_model.dataModel import FrameObject
+from src.image_transforms.imageTransforms import DetectObjectsTransform
+from syntheticFrames import render_frames
+
+
+def per_frame_times(transform: DetectObjectsTransform, frames: List[np.ndarray], rebuild: bool) -> List[float]:
+    times = []
+    for camera, frame in enumerate(frames):
+        start = time.perf_counter()
+        if rebuild:
+            # drops the cached detector, as if it was built for every frame
+            transform.teardown()
+        transform.run([FrameObject(frame, camera)])
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    args = parser.parse_args()
+    frames = render_frames((args.width, args.height), [0, 1, 2, 3], args.frames)
+    transform = DetectObjectsTransform(Settings())
+    transform.setup()
+    for name, rebuild in (("detector per frame", True), ("cached detector", False)):
+        times = per_frame_times(transform, frames, rebuild)
+        print("{}: mean {:.2f} ms, p50 {:.2f} ms, p95 {:.2f} ms".format(
+            name, 1e3 * sum(times) / len(times), 1e3 * times[len(times) // 2], 1e3 * times[int(len(times) * 0.95)]))
+
+
+if __name__ == "__main__":
+    main()
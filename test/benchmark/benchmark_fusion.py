@@ -0,0 +1,47 @@
+"""
+Measures the time of fusing detections of many cameras and objects with FuseObjectsTransform.
+Run from the repository root: PYTHONPATH=. python test/benchmark/benchmark_fusion.py
+"""
+import argparse
+import time
+
+import numpy as np
+
+from src.data_model.dataModel import FrameObjectWithDetectedObjects
+from src.object_fusion.objectFusion import FuseObjectsTransform
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cameras", type=int, default=32)
+    parser.add_argument("--objects", type=int, default=300)
+    parser.add_argument("--repeats", type=int, default=100)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    camera_data = {index: (int(rng.integers(0, 900)), int(rng.integers(0, 900)), float(rng.uniform(0, 2 * np.pi)),
+                           (640, 480), None) for index in range(args.cameras)}
+    transform = FuseObjectsTransform(list(range(args.objects)), camera_data)
+    frame = np.zeros((4, 4, 3), np.uint8)
+    frames = []
+    for camera_index in range(args.cameras):
+        seen = rng.choice(args.objects, args.objects // 4, replace=False)
+        frames.append(FrameObjectWithDetectedObjects(
+            frame, camera_index,
+            {int(index): (float(rng.uniform(0, 640)), float(rng.uniform(0, 480))) for index in seen},
+            {int(index): float(rng.uniform(0, 2 * np.pi)) for index in seen}))
+    transform.run(frames)
+    update = 0.0
+    fuse = 0.0
+    for i in range(args.repeats):
+        start = time.perf_counter()
+        transform.engine.update([frames[i % args.cameras]])
+        update += time.perf_counter() - start
+        start = time.perf_counter()
+        transform.engine.fuse({})
+        fuse += time.perf_counter() - start
+    print("{} cameras, {} objects: update with one camera frame {:.3f} ms, fuse {:.3f} ms".format(
+        args.cameras, args.objects, 1e3 * update / args.repeats, 1e3 * fuse / args.repeats))
+
+
+if __name__ == "__main__":
+    main()
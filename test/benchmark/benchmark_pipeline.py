@@ -0,0 +1,255 @@
+"""
+Runs the whole detection pipeline headless: virtual cameras replaying rendered tag36h11 frames (or a recorded video
+or image sequence, looped by ReplayReader), DetectObjectsTransform, synchronization, fusion and a sink that only counts
+fused objects. Reports fused objects per second, end-to-end and per-stage latency percentiles, CPU and memory use for
+each number of cameras. Results can be saved as JSON and compared with results of another commit:
+PYTHONPATH=. python test/benchmark/benchmark_pipeline.py --cameras 1 4 16 --output before.json
+PYTHONPATH=. python test/benchmark/benchmark_pipeline.py --cameras 1 4 16 --compare before.json
+Run from the repository root
+"""
+import argparse
+import gc
+import json
+import resource
+import subprocess
+import threading
+import time
+from typing import List, Optional, Dict, Tuple
+
+import numpy as np
+
+import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
+from src.camera_io.cameraIO import ReplayReader, Settings
+from src.data_model.dataModel import FrameObject, FrameRing, interpolate_detections
+from src.image_transforms.imageTransforms import DetectObjectsTransform
+from src.multi_thread_data_processing.pipelineMetrics import REGISTRY, Histogram
+from src.object_fusion.objectFusion import FuseObjectsTransform
+from syntheticFrames import render_frames
+
+
+class SyntheticReader(mtl.GetParent):
+    """
+    Replays prerendered frames in a loop, copying each of them into a FrameRing slot like CameraReader does
+    """
+    def __init__(self, camera_index: int, frames: List[np.ndarray], ring_slots: int = 16):
+        super().__init__()
+        self.index = camera_index
+        self.frames = frames
+        self.position = 0
+        self.ring = FrameRing(frames[0].shape, frames[0].dtype.str, ring_slots)
+
+    def get_data(self) -> Optional[FrameObject]:
+        frame = self.frames[self.position]
+        self.position = (self.position + 1) % len(self.frames)
+        return self.ring.share(FrameObject(frame, self.index))
+
+
+class NullSink(mtl.SinkParent):
+    """
+    Counts sunk objects and keeps their exact latency since capture
+    """
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.latencies: List[float] = []
+        self.lock = threading.Lock()
+
+    def sink_data(self, input_object: list):
+        now = time.monotonic()
+        with self.lock:
+            for sunk in input_object:
+                self.count += 1
+                if sunk.capture_time is not None:
+                    self.latencies.append(now - sunk.capture_time)
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.latencies = []
+
+
+def merge(histograms: List[Histogram]) -> Histogram:
+    merged = Histogram()
+    for histogram in histograms:
+        merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+        merged.sum += histogram.sum
+        merged.count += histogram.count
+    return merged
+
+
+def summarize(histogram: Histogram) -> Dict[str, float]:
+    # percentiles are upper bounds of histogram buckets
+    return {
+        "count": histogram.count,
+        "mean ms": 1e3 * histogram.sum / histogram.count if histogram.count else 0.0,
+        "p50 ms": 1e3 * histogram.get_percentile(50),
+        "p99 ms": 1e3 * histogram.get_percentile(99)
+    }
+
+
+def percentile(values: List[float], percent: float) -> float:
+    return float(np.percentile(values, percent)) if values else 0.0
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return 0.0
+
+
+def run(cameras: int, args: argparse.Namespace, frames: List[np.ndarray]) -> dict:
+    camera_data: Dict[int, Tuple] = {}
+    readers = []
+    getters = []
+    detectors = []
+    detected = [mtl.DataQueue(args.queue_size) for _ in range(cameras)]
+    for camera_index in range(cameras):
+        if args.video is not None:
+            reader = ReplayReader(camera_index, args.video, args.fps > 0, args.fps or 30.0, loop=True)
+        else:
+            reader = SyntheticReader(camera_index, frames)
+        readers.append(reader)
+        captured = [mtl.DataQueue(args.queue_size)]
+        if args.fps > 0:
+            getters.append(mtl.PeriodicDataGetter(captured, reader, args.fps, args.overflow_policy,
+                                                  name="camera {}".format(camera_index)))
+        else:
+            getters.append(mtl.DataGetter(captured, reader, args.overflow_policy,
+                                          name="camera {}".format(camera_index)))
+        detectors.append(mtl.DataWorker(captured, [detected[camera_index]],
+                                        mtl.OperationChain().add_operation(DetectObjectsTransform(Settings())),
+                                        overflow_policy=args.overflow_policy, name="detect {}".format(camera_index)))
+        camera_data[camera_index] = (100 * camera_index, 0, 0.0, (args.width, args.height), None)
+    stages = []
+    fusion_input = detected
+    if args.synchronize:
+        fusion_input = [mtl.DataQueue(args.queue_size)]
+        stages.append(mtl.DataSynchronizer(detected, fusion_input, 0.02, interpolate_detections,
+                                           overflow_policy=args.overflow_policy, name="synchronize"))
+    fused = mtl.DataQueue(args.queue_size)
+    fusion = mtl.DataWorker(fusion_input, [fused],
+                            mtl.OperationChain().add_operation(FuseObjectsTransform(list(range(4)), camera_data)),
+                            overflow_policy=args.overflow_policy, name="fuse")
+    null_sink = NullSink()
+    sink = mtl.DataSink([fused], null_sink, name="sink")
+    stages += [fusion, sink] + detectors + getters
+    for stage in stages:
+        stage.start()
+
+    time.sleep(args.warmup)
+    null_sink.reset()
+    for stage in stages:
+        stage.metrics.processed = 0
+        stage.metrics.processing_time = Histogram()
+        stage.metrics.latency = Histogram()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    time.sleep(args.duration)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    count = null_sink.count
+    latencies = list(null_sink.latencies)
+    result = {
+        "cameras": cameras,
+        "fused per second": count / wall,
+        "frames per second": sum(getter.metrics.processed for getter in getters) / wall,
+        "detections per second": sum(detector.metrics.processed for detector in detectors) / wall,
+        "latency ms": {"p50": 1e3 * percentile(latencies, 50), "p95": 1e3 * percentile(latencies, 95),
+                       "p99": 1e3 * percentile(latencies, 99)},
+        "stages": {
+            "capture": summarize(merge([getter.metrics.processing_time for getter in getters])),
+            "detect": summarize(merge([detector.metrics.processing_time for detector in detectors])),
+            "fuse": summarize(fusion.metrics.processing_time),
+            "sink latency": summarize(sink.metrics.latency)
+        },
+        "dropped": sum(stage.dropped for stage in getters + detectors),
+        "cpu %": 100 * cpu / wall,
+        "rss MB": rss_mb(),
+        "max rss MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+    for stage in reversed(stages):
+        stage.stop()
+    for stage in reversed(stages):
+        stage.join()
+    for queue in detected + [fused]:
+        while not queue.empty():
+            queue.get()
+    del stages, getters, detectors, detected, fused, fusion_input, fusion, sink, null_sink
+    gc.collect()
+    for reader in readers:
+        reader.stop()
+        if isinstance(reader, ReplayReader) and reader.video_reader is not None:
+            reader = reader.video_reader
+        if reader.ring is not None:
+            reader.ring.close()
+    return result
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(results: dict, baseline: dict):
+    def change(new: float, old: float) -> str:
+        return "{:+.1f}%".format(100 * (new - old) / old) if old else "n/a"
+
+    baseline_runs = {run_result["cameras"]: run_result for run_result in baseline["runs"]}
+    print("compared with {}".format(baseline.get("commit") or "baseline"))
+    for run_result in results["runs"]:
+        old = baseline_runs.get(run_result["cameras"])
+        if old is None:
+            continue
+        print("{} cameras: fused/s {:.1f} -> {:.1f} ({}), p99 latency {:.1f} -> {:.1f} ms ({}), "
+              "detect mean {:.2f} -> {:.2f} ms, cpu {:.0f} -> {:.0f}%".format(
+                run_result["cameras"], old["fused per second"], run_result["fused per second"],
+                change(run_result["fused per second"], old["fused per second"]),
+                old["latency ms"]["p99"], run_result["latency ms"]["p99"],
+                change(run_result["latency ms"]["p99"], old["latency ms"]["p99"]),
+                old["stages"]["detect"]["mean ms"], run_result["stages"]["detect"]["mean ms"],
+                old["cpu %"], run_result["cpu %"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cameras", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--video", help="video file or image sequence replayed by every camera instead of rendered "
+                                        "frames")
+    parser.add_argument("--fps", type=float, default=30, help="frames per second of each camera, 0 for as fast as "
+                                                              "possible")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--queue-size", type=int, default=2)
+    parser.add_argument("--overflow-policy", choices=mtl.OVERFLOW_POLICIES, default=mtl.DROP_OLDEST)
+    parser.add_argument("--no-synchronize", dest="synchronize", action="store_false")
+    parser.add_argument("--output", help="file to save results to, as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+    REGISTRY.enable()
+    frames = render_frames((args.width, args.height), [0, 1, 2, 3], 30, tag_size=60) if args.video is None else []
+    results = {"commit": commit(), "arguments": vars(args), "runs": []}
+    for cameras in args.cameras:
+        result = run(cameras, args, frames)
+        results["runs"].append(result)
+        print("{} cameras: {:.1f} fused/s, {:.1f} detections/s, latency p50 {:.1f} ms p99 {:.1f} ms, "
+              "detect p50 {:.1f} ms, dropped {}, cpu {:.0f}%, rss {:.0f} MB".format(
+                cameras, result["fused per second"], result["detections per second"], result["latency ms"]["p50"],
+                result["latency ms"]["p99"], result["stages"]["detect"]["p50 ms"], result["dropped"], result["cpu %"],
+                result["rss MB"]))
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
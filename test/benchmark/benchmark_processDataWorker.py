@@ -0,0 +1,76 @@
+"""
+Compares detections per second of DetectObjectsTransform run by thread DataWorkers (one per camera) and by
+ProcessDataWorkers with frames passed through FrameRing shared memory slots.
+Run from the repository root: PYTHONPATH=. python test/benchmark/benchmark_processDataWorker.py
+"""
+import argparse
+import threading
+import time
+from queue import Queue
+
+import src.image_transforms.imageTransforms as imageTransforms
+import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
+from src.camera_io.cameraIO import Settings
+from src.data_model.dataModel import FrameObject, FrameRing
+from syntheticFrames import render_frames
+
+
+def measure(cameras: int, processes: int, frames_per_camera: int, resolution) -> float:
+    frames = render_frames(resolution, [0, 1, 2], 10)
+    rings = [FrameRing(frames[0].shape, slots=16) for _ in range(cameras)]
+    output_queue = Queue()
+    input_queues = [mtl.DataQueue() for _ in range(cameras)]
+    workers = []
+    for input_queue in input_queues:
+        operation_chain = mtl.OperationChain().add_operation(imageTransforms.DetectObjectsTransform(Settings()))
+        if processes > 0:
+            workers.append(mtl.ProcessDataWorker([input_queue], [output_queue], operation_chain, processes))
+        else:
+            workers.append(mtl.DataWorker([input_queue], [output_queue], operation_chain))
+    for worker in workers:
+        worker.start()
+
+    def consume(count: int):
+        for _ in range(count):
+            output_queue.get().release()
+
+    # let the pools start before measuring
+    for camera, input_queue in enumerate(input_queues):
+        input_queue.put(rings[camera].share(FrameObject(frames[0], camera)))
+    consume(cameras)
+    consumer = threading.Thread(target=consume, args=(frames_per_camera * cameras,))
+    consumer.start()
+    start = time.perf_counter()
+    for i in range(frames_per_camera):
+        for camera, input_queue in enumerate(input_queues):
+            while rings[camera].free_slots() == 0:
+                time.sleep(0.001)
+            input_queue.put(rings[camera].share(FrameObject(frames[i % len(frames)], camera)))
+    consumer.join()
+    elapsed = time.perf_counter() - start
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        worker.join()
+    for ring in rings:
+        ring.close()
+    return frames_per_camera * cameras / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cameras", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    args = parser.parse_args()
+    for cameras in args.cameras:
+        threads = measure(cameras, 0, args.frames, (args.width, args.height))
+        processes = measure(cameras, args.processes, args.frames, (args.width, args.height))
+        print("{} cameras: threads {:.1f} frames/s, processes ({} per camera) {:.1f} frames/s".format(
+            cameras, threads, args.processes, processes))
+
+
+if __name__ == "__main__":
+    main()
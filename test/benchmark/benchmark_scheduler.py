@@ -0,0 +1,51 @@
+"""
+Drives PeriodicDataGetters of many virtual cameras with the shared PeriodicScheduler and reports the achieved rate,
+lateness and jitter of ticks and the number of threads used.
+Run from the repository root: PYTHONPATH=. python test/benchmark/benchmark_scheduler.py
+"""
+import argparse
+import threading
+import time
+from queue import Queue
+
+import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
+
+
+class SlowGetter(mtl.GetParent):
+    def __init__(self, grab_time: float):
+        super().__init__()
+        self.grab_time = grab_time
+
+    def get_data(self):
+        time.sleep(self.grab_time)
+        return time.monotonic()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cameras", type=int, default=8)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--grab-time", type=float, default=0.005)
+    parser.add_argument("--duration", type=float, default=3)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+    scheduler = mtl.PeriodicScheduler(args.workers)
+    getters = [mtl.PeriodicDataGetter([Queue()], SlowGetter(args.grab_time), args.fps, scheduler=scheduler,
+                                      name="camera {}".format(camera)) for camera in range(args.cameras)]
+    for getter in getters:
+        getter.start()
+    time.sleep(args.duration)
+    threads = threading.active_count()
+    statistics = scheduler.get_statistics()
+    for getter in getters:
+        getter.stop()
+    for name, task_statistics in statistics.items():
+        print("{}: {:.1f} ticks/s, {} skipped, mean lateness {:.2f} ms, max {:.2f} ms, jitter {:.2f} ms".format(
+            name, task_statistics["ticks"] / args.duration, task_statistics["skipped"],
+            1e3 * task_statistics["mean lateness"], 1e3 * task_statistics["max lateness"],
+            1e3 * task_statistics["jitter"]))
+    print("threads alive: {}".format(threads))
+
+
+if __name__ == "__main__":
+    main()
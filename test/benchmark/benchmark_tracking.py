@@ -0,0 +1,41 @@
+"""
+Compares DetectObjectsTransform scanning every frame with the tracking mode searching regions around known tags,
+on rendered frames with slowly moving tags. Reports per-frame time, hit rate of region searches and time saved.
+Run from the repository root: PYTHONPATH=. python test/benchmark/benchmark_tracking.py
+"""
+import argparse
+import time
+
+from src.camera_io.cameraIO import Settings
+from src.data_model.dataModel import FrameObject
+from src.image_transforms.imageTransforms import DetectObjectsTransform
+from syntheticFrames import render_frames
+
+
+def measure(transform: DetectObjectsTransform, frames) -> float:
+    transform.setup()
+    start = time.perf_counter()
+    for frame in frames:
+        transform.run([FrameObject(frame, 0)])
+    return (time.perf_counter() - start) / len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--full-scan-interval", type=int, default=30)
+    args = parser.parse_args()
+    frames = render_frames((args.width, args.height), [0, 1, 2, 3], args.frames)
+    full = measure(DetectObjectsTransform(Settings()), frames)
+    tracking_transform = DetectObjectsTransform(Settings(), tracking=True, full_scan_interval=args.full_scan_interval)
+    tracking = measure(tracking_transform, frames)
+    print("full scan: {:.2f} ms/frame".format(1e3 * full))
+    print("tracking: {:.2f} ms/frame, hit rate {:.0%} ({} full scans, {} lost tracks), time saved {:.0%}".format(
+        1e3 * tracking, tracking_transform.get_hit_rate(), tracking_transform.full_scans,
+        tracking_transform.lost_tracks, 1 - tracking / full))
+
+
+if __name__ == "__main__":
+    main()
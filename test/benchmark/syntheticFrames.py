@@ -0,0 +1,42 @@
+"""
+Renders frames with tag36h11 tags on a plain background, used by benchmarks instead of a live camera
+"""
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+
+def render_tag(tag_id: int, size: int) -> np.ndarray:
+    dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+    return dictionary.generateImageMarker(tag_id, size)
+
+
+def render_frame(resolution: Tuple[int, int], tags: List[Tuple[int, int, int, int]]) -> np.ndarray:
+    """
+    @param resolution: (width, height) of the frame
+    @param tags: list of (tag_id, x, y, size) of tags to draw, x and y being the top left corner of the tag
+    @return: BGR frame
+    """
+    width, height = resolution
+    frame = np.full((height, width), 255, np.uint8)
+    for tag_id, x, y, size in tags:
+        frame[y:y + size, x:x + size] = render_tag(tag_id, size)
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+
+def render_frames(resolution: Tuple[int, int], tag_ids: List[int], count: int, tag_size: int = 80,
+                  step: int = 3) -> List[np.ndarray]:
+    """
+    Renders count frames with tags moving step pixels per frame along the diagonal of the frame
+    """
+    width, height = resolution
+    frames = []
+    for i in range(count):
+        tags = []
+        for position, tag_id in enumerate(tag_ids):
+            x = (40 + position * (tag_size + 40) + i * step) % (width - tag_size)
+            y = (40 + i * step) % (height - tag_size)
+            tags.append((tag_id, x, y, tag_size))
+        frames.append(render_frame(resolution, tags))
+    return frames
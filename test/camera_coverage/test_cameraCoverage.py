@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+import numpy as np
+
+from src.camera_coverage.cameraCoverage import CameraCoverage
+
+
+def camera_entry(x, y, angle, resolution):
+    cos, sin = np.cos(angle), np.sin(angle)
+    res_x, res_y = resolution
+    points = np.array([[x, y], [x + res_x * cos, y + res_x * sin],
+                       [x + res_x * cos - res_y * sin, y + res_x * sin + res_y * cos],
+                       [x - res_y * sin, y + res_y * cos]], np.int32)
+    return x, y, angle, resolution, points.reshape((-1, 1, 2))
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.camera_data = {0: camera_entry(0, 0, 0.0, (400, 300)),
+                            1: camera_entry(300, 200, 0.0, (400, 300)),
+                            2: camera_entry(500, 0, np.pi / 2, (200, 100))}
+        self.coverage = CameraCoverage(self.camera_data, (900, 900), cell_size=50)
+
+    def test_cameras_covering_point(self):
+        self.assertEqual([0], self.coverage.get_cameras(10, 10))
+        self.assertEqual([0, 1], self.coverage.get_cameras(350, 250))
+        # rotated camera spans x 400 to 500, y 0 to 200
+        self.assertEqual([2], self.coverage.get_cameras(450, 100))
+        self.assertEqual([], self.coverage.get_cameras(800, 800))
+        self.assertEqual([], self.coverage.get_cameras(-500, 10))
+        np.testing.assert_array_equal([[True, False], [False, False]],
+                                      self.coverage.covers([[10, 10], [np.nan, np.nan]], [0, 3]))
+
+    def test_index_follows_updated_cameras(self):
+        self.coverage.get_cameras(0, 0)
+        self.camera_data[0] = camera_entry(500, 500, 0.0, (400, 300))
+        self.assertEqual([], self.coverage.get_cameras(10, 10))
+        self.assertEqual([0], self.coverage.get_cameras(850, 750))
+        report = self.coverage.get_report()
+        self.assertEqual(324, report["cells"])
+        self.assertEqual(48, report["cameras"][0])
+        self.assertEqual(sum(report["covered_by"].values()), report["cells"])
@@ -0,0 +1,254 @@
+import os
+import tempfile
+import time
+from queue import Queue
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from src.camera_io.cameraIO import CameraReader, ReplayReader, ViewRenderer, CameraDiscovery, CameraJobs, \
+    SettingsStore, AllCameras, ReplayClock, Camera
+from src.data_model.dataModel import Config, FrameObjectWithDetectedObjects
+from src.image_transforms.imageTransforms import AdaptiveDecimation
+from src.multi_thread_data_processing.multiThreadDataProcessing import OperationChain, PooledDataWorker
+from src.object_fusion.objectFusion import FuseObjectsTransform
+
+
+def write_video(path: str, frames: int, resolution=(160, 120)):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, resolution)
+    for i in range(frames):
+        writer.write(np.full((resolution[1], resolution[0], 3), i * 20, np.uint8))
+    writer.release()
+
+
+CONFIG_HEAD = 'tag_family: "tag36h11"\nmax_search_index: 4\nfield_of_detection:\n  x: 900\n  y: 900\n'
+
+
+class FakeDiscovery(CameraDiscovery):
+    """
+    Devices 1 and 3 exist, probing device 5 hangs
+    """
+    def __init__(self):
+        super().__init__(8, timeout=0.3, ttl=60)
+        self.probed = []
+
+    def probe(self, index: int):
+        self.probed.append(index)
+        time.sleep(1.0 if index == 5 else 0.1)
+        return {"resolution": (640, 480), "fps": 30} if index in (1, 3) else None
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.video_path = os.path.join(self.directory.name, "video.avi")
+        write_video(self.video_path, 8)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_camera_reader_reads_into_ring_slots(self):
+        camera_reader = CameraReader(self.video_path, ring_slots=2)
+        first = camera_reader.get_data()
+        second = camera_reader.get_data()
+        self.assertTrue(np.shares_memory(first.get_frame(), camera_reader.ring.array))
+        self.assertTrue(np.shares_memory(second.get_frame(), camera_reader.ring.array))
+        self.assertEqual(0, camera_reader.ring.free_slots())
+        # all slots referenced, the frame gets its own array
+        third = camera_reader.get_data()
+        self.assertIsNone(third.slot)
+        first.release()
+        fourth = camera_reader.get_data()
+        self.assertEqual(first.slot.index, fourth.slot.index)
+        del second
+        self.assertEqual(1, camera_reader.ring.free_slots())
+
+    def test_camera_reader_captures_downscaled_grayscale(self):
+        decimation = AdaptiveDecimation()
+        camera_reader = CameraReader(self.video_path, ring_slots=2, grayscale=True, decimation=decimation)
+        first = camera_reader.get_data()
+        self.assertEqual(((120, 160), 1.0), (first.get_frame().shape, first.scale))
+        decimation.size_steps[self.video_path] = 2
+        second = camera_reader.get_data()
+        self.assertEqual(((60, 80), 0.5), (second.get_frame().shape, second.scale))
+        self.assertTrue(np.shares_memory(second.get_frame(), camera_reader.rings[(60, 80)].array))
+        self.assertAlmostEqual(20, second.get_frame().mean(), delta=3)
+        rings = list(camera_reader.rings.values())
+        first.release()
+        camera_reader.stop()
+        self.assertEqual({}, camera_reader.rings)
+        # the ring of the first scale is closed, the second one when its frame is released
+        self.assertEqual([False, True], [ring.finalizer.alive for ring in rings])
+        second.release()
+        self.assertFalse(rings[1].finalizer.alive)
+
+    def test_replay_reader_returns_every_frame_in_order(self):
+        replay_reader = ReplayReader(0, self.video_path, realtime=False, prefetch=2, ring_slots=4)
+        self.assertEqual((160, 120), replay_reader.get_resolution())
+        brightness = []
+        frame_object = replay_reader.get_data()
+        while frame_object is not None:
+            brightness.append(int(frame_object.get_frame().mean()))
+            frame_object.release()
+            frame_object = replay_reader.get_data()
+        replay_reader.stop()
+        self.assertEqual(8, len(brightness))
+        self.assertEqual(sorted(brightness), brightness)
+
+    def test_stopped_camera_releases_frames_left_undetected(self):
+        camera = Camera(0, 30, 0, 0, 0.0, [Queue()], self.video_path, realtime=False,
+                        detection_pool=PooledDataWorker(OperationChain(), threads=1))
+        camera_reader = CameraReader(self.video_path, ring_slots=2)
+        for _ in range(2):
+            camera.data_from_input[0].put(camera_reader.get_data())
+        self.assertEqual(0, camera_reader.ring.free_slots())
+        # the pool isn't running, nothing detects the queued frames
+        camera.stop(0.1)
+        self.assertTrue(camera.data_from_input[0].empty())
+        self.assertEqual(2, camera_reader.ring.free_slots())
+
+    def test_cameras_are_added_once_and_removed_with_outputs(self):
+        cameras = AllCameras()
+        cameras.add_camera(5, 30, 0, 0, 0.0, self.video_path, realtime=False)
+        cameras.add_camera(6, 30, 0, 0, 0.0, self.video_path, realtime=False)
+        output_queue = cameras.data_output[1]
+        cameras.remove_camera(5)
+        self.assertEqual([6], cameras.indexes)
+        self.assertEqual([output_queue], cameras.data_output)
+        self.assertEqual([6], list(cameras.camera_data.keys()))
+        cameras.remove_camera(6)
+        # creates of one index run one after another, the second one fails
+        camera_jobs = CameraJobs()
+        jobs = [camera_jobs.submit("create", 7, cameras.add_camera, 7, 30, 0, 0, 0.0, self.video_path, False)
+                for _ in range(2)]
+        camera_jobs.executor.shutdown(wait=True)
+        self.assertEqual(["DONE", "FAILED"], [camera_jobs.get_job(job["id"])["status"] for job in jobs])
+        self.assertEqual([7], cameras.indexes)
+        self.assertEqual(1, len(cameras.data_output))
+        cameras.remove_camera(7)
+        if cameras.detection_pool is not None:
+            cameras.detection_pool.stop()
+            cameras.detection_pool.join(1)
+
+    def test_replay_reader_paces_images_by_capture_log(self):
+        images = os.path.join(self.directory.name, "images")
+        os.mkdir(images)
+        for i in range(4):
+            cv2.imwrite(os.path.join(images, "{:03d}.png".format(i)), np.full((60, 80, 3), i * 50, np.uint8))
+        with open(os.path.join(images, "timestamps.txt"), "w") as log:
+            log.write("10.0\n10.0\n10.2\n10.25\n")
+        replay_reader = ReplayReader(0, images, realtime=True)
+        self.assertEqual((80, 60), replay_reader.get_resolution())
+        replay_reader.start_prefetch()
+        time.sleep(0.1)
+        # frames captured at the same time, the older one is skipped
+        self.assertEqual(50, replay_reader.get_data().get_frame()[0, 0, 0])
+        self.assertIsNone(replay_reader.get_data())
+        time.sleep(0.3)
+        self.assertEqual(150, replay_reader.get_data().get_frame()[0, 0, 0])
+        self.assertEqual(2, replay_reader.skipped)
+        self.assertIsNone(replay_reader.get_data())
+        self.assertTrue(replay_reader.finished)
+        replay_reader.stop()
+
+    def test_replays_keep_recorded_capture_times(self):
+        clock = ReplayClock()
+        replay_readers = []
+        for name, log in (("first", "10.0\n10.1\n"), ("second", "10.05\n10.15\n")):
+            images = os.path.join(self.directory.name, name)
+            os.mkdir(images)
+            for i in range(2):
+                cv2.imwrite(os.path.join(images, "{:03d}.png".format(i)), np.full((60, 80, 3), i * 50, np.uint8))
+            with open(os.path.join(images, "timestamps.txt"), "w") as log_file:
+                log_file.write(log)
+            replay_readers.append(ReplayReader(0, images, realtime=False, clock=clock))
+        first = [replay_readers[0].get_data() for _ in range(2)]
+        time.sleep(0.05)
+        second = [replay_readers[1].get_data() for _ in range(2)]
+        capture_times = [frame_object.capture_time for frame_object in first + second]
+        np.testing.assert_allclose([0.0, 0.1, 0.05, 0.15], np.array(capture_times) - capture_times[0], atol=1e-9)
+        for replay_reader in replay_readers:
+            replay_reader.stop()
+
+    def test_view_renderer_reuses_canvases(self):
+        camera_data = {0: (10, 10, 0.0, (80, 60), np.array([[10, 10], [90, 10], [90, 70], [10, 70]], np.int32))}
+        transform = FuseObjectsTransform([0], camera_data)
+        renderer = ViewRenderer("field", camera_data)
+        gray = np.full((60, 80), 100, np.uint8)
+        views = renderer.render([transform.run([FrameObjectWithDetectedObjects(gray, 0, {0: (20, 30)}, {0: 0.0})])])
+        self.assertEqual({"Camera: 0", "field"}, views.keys())
+        self.assertEqual((60, 80, 3), views["Camera: 0"].shape)
+        self.assertEqual(np.uint8, views["field"].dtype)
+        # fused object drawn in red at world (30, 40)
+        self.assertEqual([0, 0, 255], views["field"][40, 30].tolist())
+        field = views["field"]
+        views = renderer.render([transform.run([FrameObjectWithDetectedObjects(gray, 0, {}, {})])])
+        self.assertIs(field, views["field"])
+        self.assertEqual([0, 0, 0], views["field"][40, 30].tolist())
+
+    def test_camera_discovery_probes_in_parallel_and_caches(self):
+        discovery = FakeDiscovery()
+        start = time.monotonic()
+        self.assertEqual([1, 3], sorted(discovery.get_devices(exclude=[0])))
+        self.assertLess(time.monotonic() - start, 0.6)
+        self.assertNotIn(0, discovery.probed)
+        self.assertEqual([1], list(discovery.get_devices(exclude=[0, 3])))
+        self.assertEqual(7, len(discovery.probed))
+        discovery.invalidate()
+        discovery.get_devices()
+        # the hanging probe isn't started again
+        self.assertEqual(7 + 7, len(discovery.probed))
+        discovery.executor.shutdown()
+
+    def test_camera_jobs_run_in_order_per_camera(self):
+        jobs = CameraJobs(workers=2, history=3)
+        events = []
+
+        def operation(name, seconds):
+            time.sleep(seconds)
+            events.append(name)
+
+        def fail():
+            raise Exception("Couldn't open camera 1")
+
+        jobs.submit("create", 0, operation, "create 0", 0.2)
+        jobs.submit("start", 0, operation, "start 0", 0.0)
+        failed = jobs.submit("create", 1, fail)
+        self.assertEqual("PENDING", failed["status"])
+        jobs.submit("create", 2, operation, "create 2", 0.0)
+        jobs.executor.shutdown(wait=True)
+        # camera 2 didn't wait for the slow job of camera 0
+        self.assertEqual(["create 2", "create 0", "start 0"], events)
+        job = jobs.get_job(failed["id"])
+        self.assertEqual(("FAILED", "Couldn't open camera 1"), (job["status"], job["error"]))
+        self.assertEqual([2, 3, 4], [job["id"] for job in jobs.get_jobs()])
+        self.assertIsNone(jobs.get_job(1))
+
+    def test_settings_store_swaps_snapshot_on_change(self):
+        path = os.path.join(self.directory.name, "config.yml")
+        with open(path, "w") as config_file:
+            config_file.write(CONFIG_HEAD + 'objects:\n  0:\n    tag_id: 5\n')
+        store = SettingsStore(Config.__wrapped__(path))
+        swapped = []
+        store.add_listener(swapped.append)
+        settings = store.get()
+        self.assertEqual(({5: 0}, frozenset({5})), (settings.tags_index, settings.tags))
+        self.assertFalse(store.reload_if_changed())
+        self.assertIs(settings, store.get())
+        store.update({"objects": {0: {"tag_id": 5}, 1: {"tag_id": 6}}})
+        self.assertEqual({5: 0, 6: 1}, store.get().tags_index)
+        with open(path, "w") as config_file:
+            config_file.write(CONFIG_HEAD + 'objects:\n  2:\n    tag_id: 7\n')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertTrue(store.reload_if_changed())
+        self.assertEqual({7: 2}, store.get().tags_index)
+        self.assertEqual([2, 3], [settings.version for settings in swapped])
+        # an empty or half written file is rejected and the last config is kept
+        for content in ("", CONFIG_HEAD + "objects:\n  2:\n"):
+            with open(path, "w") as config_file:
+                config_file.write(content)
+            os.utime(path, (time.time() + 20, time.time() + 20))
+            self.assertFalse(store.reload_if_changed())
+            self.assertEqual({7: 2}, store.get().tags_index)
+            self.assertEqual("tag36h11", store.config.get_tag_family())
@@ -0,0 +1,54 @@
+import gc
+import pickle
+from multiprocessing import shared_memory
+from unittest import TestCase
+
+import numpy as np
+
+from src.data_model.dataModel import FrameObject, FrameObjectWithDetectedObjects, FrameRing, interpolate_detections
+
+
+class Test(TestCase):
+    def test_frame_ring_pickles_slot_handle(self):
+        ring = FrameRing((120, 160, 3), slots=2)
+        frame_object = ring.share(FrameObject(np.full((120, 160, 3), 7, np.uint8), 0))
+        data = pickle.dumps(FrameObjectWithDetectedObjects(frame_object.get_frame(), 0, {1: (2, 3)}, {1: 0.5},
+                                                           frame_object.slot))
+        self.assertLess(len(data), 120 * 160)
+        unpickled = pickle.loads(data)
+        self.assertTrue(np.shares_memory(unpickled.get_frame(), ring.array))
+        self.assertEqual(7, unpickled.get_frame()[0, 0, 0])
+        self.assertEqual((2, 3), unpickled.get_center(1))
+        unpickled = frame_object = None
+        ring.close()
+
+    def test_frame_ring_is_unlinked_when_released(self):
+        ring = FrameRing((4, 4), slots=2)
+        name = ring.memory.name
+        frame_object = ring.share(FrameObject(np.zeros((4, 4), np.uint8), 0))
+        ring.retire()
+        self.assertIsNone(ring.acquire())
+        self.assertTrue(ring.finalizer.alive)
+        frame_object.release()
+        frame_object = None
+        self.assertFalse(ring.finalizer.alive)
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+        # a ring dropped by its owner is unlinked as well
+        ring = FrameRing((4, 4), slots=2)
+        name = ring.memory.name
+        ring = None
+        gc.collect()
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+    def test_interpolate_detections(self):
+        frame = np.zeros((4, 4, 3), np.uint8)
+        before = FrameObjectWithDetectedObjects(frame, 0, {1: (0, 0), 2: (5, 5)}, {1: 6.0, 2: 0.0}, capture_time=1.0)
+        after = FrameObjectWithDetectedObjects(frame, 0, {1: (10, 20)}, {1: 0.4}, capture_time=2.0)
+        interpolated = interpolate_detections(before, after, 1.25)
+        self.assertEqual((2.5, 5.0), interpolated.get_center(1))
+        # rotation goes the short way through 0
+        self.assertAlmostEqual(6.0 + (2 * np.pi + 0.4 - 6.0) * 0.25, interpolated.get_rotation(1), places=6)
+        self.assertEqual((5, 5), interpolated.get_center(2))
+        self.assertEqual(1.25, interpolated.capture_time)
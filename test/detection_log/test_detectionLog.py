@@ -0,0 +1,69 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from src.data_model.dataModel import FrameObjectWithDetectedObjects
+from src.detection_log.detectionLog import DetectionLogWriter, DetectionLogReader, DetectionLogSink, \
+    RECORD_DTYPE, FUSED_CAMERA, list_segments
+from src.object_fusion.objectFusion import FuseObjectsTransform
+
+
+def make_records(timestamps, object_index=0, camera=0):
+    records = np.zeros(len(timestamps), RECORD_DTYPE)
+    records["timestamp"] = timestamps
+    records["object"] = object_index
+    records["camera"] = camera
+    records["x"] = timestamps
+    return records
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_reads_time_range_and_object_across_segments(self):
+        writer = DetectionLogWriter(self.directory.name, segment_records=10)
+        for second in range(5):
+            writer.append(make_records(np.arange(second * 10, second * 10 + 10) / 10, second % 2))
+        writer.close()
+        self.assertEqual(5, len(list_segments(self.directory.name)))
+        reader = DetectionLogReader(self.directory.name)
+        records = reader.read(1.5, 3.2)
+        np.testing.assert_allclose(np.arange(15, 32) / 10, records["timestamp"])
+        records = reader.read(1.5, 3.2, object_index=1)
+        np.testing.assert_allclose([1.5, 1.6, 1.7, 1.8, 1.9, 3.0, 3.1], records["timestamp"])
+        self.assertEqual(50, len(reader.read()))
+
+    def test_new_writer_appends_new_segment_and_cut_record_is_ignored(self):
+        writer = DetectionLogWriter(self.directory.name)
+        writer.append(make_records([1.0, 2.0]))
+        writer.close()
+        writer = DetectionLogWriter(self.directory.name)
+        writer.append(make_records([3.0]))
+        writer.close()
+        segments = list_segments(self.directory.name)
+        self.assertEqual(2, len(segments))
+        with open(segments[-1], "ab") as segment:
+            segment.write(b"\x00" * 7)
+        np.testing.assert_allclose([1.0, 2.0, 3.0], DetectionLogReader(self.directory.name).read()["timestamp"])
+
+    def test_sink_writes_fused_and_camera_poses(self):
+        camera_data = {0: (100, 0, 0.0, (640, 480), None), 1: (0, 0, 0.0, (640, 480), None)}
+        transform = FuseObjectsTransform([0, 1], camera_data)
+        frame = np.zeros((4, 4, 3), np.uint8)
+        transform.run([FrameObjectWithDetectedObjects(frame, 1, {1: (5, 5)}, {1: 0.5})])
+        fused = transform.run([FrameObjectWithDetectedObjects(frame, 0, {0: (10, 20)}, {0: 1.0})])
+        sink = DetectionLogSink(DetectionLogWriter(self.directory.name))
+        sink.sink_data([fused])
+        sink.stop()
+        records = DetectionLogReader(self.directory.name).read()
+        # fused poses of both objects, camera 1 wasn't fused in this update
+        self.assertEqual([FUSED_CAMERA, FUSED_CAMERA, 0], records["camera"].tolist())
+        self.assertEqual([0, 1, 0], records["object"].tolist())
+        np.testing.assert_allclose([110, 20, 1.0], [records[2]["x"], records[2]["y"], records[2]["rot"]])
+        self.assertEqual(3 * RECORD_DTYPE.itemsize, os.path.getsize(list_segments(self.directory.name)[0]))
@@ -0,0 +1,138 @@
+import pickle
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from src.camera_io.cameraIO import Settings
+from src.data_model.dataModel import DETECTION_DTYPE, DetectionBatch, FrameObject
+from src.image_transforms.imageTransforms import DetectObjectsTransform, AdaptiveDecimation, EstimatePosesTransform, \
+    rotations_to_quaternions
+
+
+def render_frame(tags):
+    dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+    frame = np.full((480, 640), 255, np.uint8)
+    for tag_id, x, y, size in tags:
+        frame[y:y + size, x:x + size] = dictionary.generateImageMarker(tag_id, size)
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+
+CAMERA_MATRIX = np.array([[600, 0, 320], [0, 600, 240], [0, 0, 1.0]])
+
+
+def render_tag_pose(rotation, translation, tag_size):
+    """
+    @return: BGR frame of tag 1 with the pose in the camera frame and pixel coordinates of its corners
+    """
+    dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+    marker = np.full((140, 140), 255, np.uint8)
+    marker[20:120, 20:120] = dictionary.generateImageMarker(1, 100)
+    # the black square spans pixels 20 to 119 of the marker image, its edges are half a pixel outside of them
+    to_tag = np.array([[tag_size / 100, 0, -0.695 * tag_size], [0, tag_size / 100, -0.695 * tag_size], [0, 0, 1]])
+    homography = CAMERA_MATRIX @ np.column_stack([rotation[:, 0], rotation[:, 1], translation]) @ to_tag
+    frame = cv2.warpPerspective(marker, homography, (640, 480), borderValue=255)
+    corners = np.array([[1, 1], [-1, 1], [-1, -1], [1, -1]]) * tag_size / 2
+    projected = (CAMERA_MATRIX @ (rotation @ np.column_stack([corners, np.zeros(4)]).T + translation[:, None])).T
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR), projected[:, :2] / projected[:, 2:]
+
+
+class Test(TestCase):
+    def test_detect_objects_reuses_detector(self):
+        transform = DetectObjectsTransform(Settings())
+        transform.setup()
+        detector = transform.get_detector()
+        result = transform.run([FrameObject(render_frame([(1, 100, 100, 80), (3, 300, 200, 80)]), 0)])
+        self.assertEqual({1, 3}, set(result.centers.keys()))
+        self.assertAlmostEqual(140, result.get_center(1)[0], delta=1)
+        self.assertAlmostEqual(240, result.get_center(3)[1], delta=1)
+        transform.run([FrameObject(render_frame([(2, 100, 100, 80)]), 0)])
+        self.assertIs(detector, transform.get_detector())
+        transform.settings = Settings()
+        self.assertIsNot(detector, transform.get_detector())
+
+    def test_detect_objects_pickles_without_detector(self):
+        transform = DetectObjectsTransform(Settings())
+        transform.setup()
+        unpickled = pickle.loads(pickle.dumps(transform))
+        result = unpickled.run([FrameObject(render_frame([(4, 200, 200, 80)]), 0)])
+        self.assertEqual([4], result.indexes)
+
+    def test_detect_objects_without_frame(self):
+        transform = DetectObjectsTransform(Settings(), keep_frame=False)
+        frame_object = FrameObject(render_frame([(2, 100, 100, 80)]), 5)
+        batch = transform.run([frame_object])
+        self.assertIsInstance(batch, DetectionBatch)
+        self.assertEqual(5, batch.camera_index)
+        self.assertEqual(frame_object.capture_time, batch.capture_time)
+        self.assertEqual([2], batch.detections["tag"].tolist())
+        corners = batch.detections["corners"][0]
+        np.testing.assert_allclose([100, 100], corners.min(axis=0), atol=1.5)
+        np.testing.assert_allclose([180, 180], corners.max(axis=0), atol=1.5)
+
+    def test_tracking_searches_regions_and_finds_lost_tags(self):
+        transform = DetectObjectsTransform(Settings(), tracking=True, full_scan_interval=5)
+        for step in range(4):
+            result = transform.run([FrameObject(render_frame([(1, 100 + 3 * step, 100, 80)]), 0)])
+            self.assertAlmostEqual(140 + 3 * step, result.get_center(1)[0], delta=1)
+        self.assertEqual(1, transform.full_scans)
+        self.assertEqual(3, transform.roi_scans)
+        # the tag jumped out of its region, the frame is scanned again
+        result = transform.run([FrameObject(render_frame([(1, 400, 300, 80)]), 0)])
+        self.assertAlmostEqual(440, result.get_center(1)[0], delta=1)
+        self.assertEqual(1, transform.lost_tracks)
+        self.assertEqual(2, transform.full_scans)
+
+    def test_tracking_ignores_unconfigured_tags_near_tracked_ones(self):
+        transform = DetectObjectsTransform(Settings(), tracking=True, full_scan_interval=30)
+        frame = render_frame([(1, 100, 100, 80), (9, 190, 110, 30)])
+        for _ in range(10):
+            result = transform.run([FrameObject(frame, 0)])
+            self.assertEqual([1], result.indexes)
+        self.assertEqual(1, transform.full_scans)
+        self.assertEqual(9, transform.roi_scans)
+        self.assertEqual(0, transform.lost_tracks)
+
+    def test_decimation_follows_tag_size_and_maps_back_to_full_resolution(self):
+        decimation = AdaptiveDecimation(target_tag_size=24, min_scale=0.25)
+        transform = DetectObjectsTransform(Settings(), keep_frame=False, decimation=decimation)
+        frame = render_frame([(2, 100, 100, 80)])
+        transform.run([FrameObject(frame, 0)])
+        # the 80 pixel tag is detected at a third of the resolution
+        self.assertAlmostEqual(1 / 3, decimation.get_scale(0))
+        batch = transform.run([FrameObject(frame, 0)])
+        np.testing.assert_allclose([140, 140], batch.detections["center"][0], atol=1.5)
+        np.testing.assert_allclose([100, 100], batch.detections["corners"][0].min(axis=0), atol=1.5)
+        self.assertEqual(1.0, decimation.get_scale(1))
+        transform.run([FrameObject(render_frame([]), 0)])
+        self.assertEqual(1.0, decimation.get_scale(0))
+
+    def test_decimation_steps_down_while_over_budget(self):
+        decimation = AdaptiveDecimation(min_scale=0.25, budget=0.01)
+        no_detections = np.zeros(0, DETECTION_DTYPE)
+        decimation.update(0, no_detections, 0.02)
+        self.assertEqual(0.5, decimation.get_scale(0))
+        for _ in range(5):
+            decimation.update(0, no_detections, 0.02)
+        self.assertEqual(0.25, decimation.get_scale(0))
+        decimation.update(0, no_detections, 0.001)
+        self.assertAlmostEqual(1 / 3, decimation.get_scale(0))
+
+    def test_estimates_pose_from_refined_corners(self):
+        rotation = cv2.Rodrigues(np.array([0.3, -0.2, 0.1]))[0]
+        translation = np.array([0.05, -0.02, 0.6])
+        frame, corners = render_tag_pose(rotation, translation, 0.1)
+        decimation = AdaptiveDecimation()
+        decimation.size_steps[0] = 3
+        detected = DetectObjectsTransform(Settings(), decimation=decimation).run([FrameObject(frame, 0)])
+        self.assertGreater(np.abs(detected.detections["corners"][0] - corners).max(), 0.3)
+        transform = EstimatePosesTransform({0: (CAMERA_MATRIX, np.zeros(5))}, 0.1, keep_frame=False)
+        batch = transform.run(detected)
+        self.assertIsInstance(batch, DetectionBatch)
+        # corners found in a third of the resolution are refined in the whole frame
+        np.testing.assert_allclose(corners, batch.detections["corners"][0], atol=0.05)
+        np.testing.assert_allclose(translation, batch.detections["translation"][0], atol=1e-3)
+        np.testing.assert_allclose(rotations_to_quaternions(rotation[None])[0], batch.detections["orientation"][0],
+                                   atol=5e-3)
+        unknown_camera = EstimatePosesTransform({}, 0.1).run(detected)
+        self.assertTrue(np.isnan(unknown_camera.detections["translation"]).all())
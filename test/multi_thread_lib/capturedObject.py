@@ -0,0 +1,4 @@
+from collections import namedtuple
+
+# an object with a capture time like frames and detections, name tells matched objects apart in tests
+Captured = namedtuple("Captured", ["capture_time", "name"], defaults=[None])
@@ -1,7 +1,9 @@
+import time
 from unittest import TestCase
 from queue import Queue
 
 import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
+from capturedObject import Captured
 
 
 class Test(TestCase):
@@ -52,3 +54,260 @@ class Test(TestCase):
         # time.sleep(0.001)
         data_sink.stop()
         self.assertTrue(input_queue.empty())
+
+    def test_data_worker_wakes_up_on_data_queue(self):
+        input_queues = [mtl.DataQueue(), mtl.DataQueue()]
+        output_queue = Queue()
+        data_worker = mtl.DataWorker(input_queues, [output_queue], mtl.OperationChain(), timeout=10)
+        data_worker.start()
+        time.sleep(0.01)
+        input_queues[1].put("1")
+        self.assertEqual(["1"], output_queue.get(timeout=1))
+        data_worker.stop()
+        data_worker.join(1)
+        self.assertFalse(data_worker.thread.is_alive())
+        self.assertEqual([], input_queues[0].listeners)
+
+    def test_data_sink_stops_while_waiting(self):
+        data_sink = mtl.DataSink([mtl.DataQueue()], mtl.SinkParent(), timeout=10)
+        data_sink.start()
+        time.sleep(0.01)
+        data_sink.stop()
+        data_sink.join(1)
+        self.assertFalse(data_sink.thread.is_alive())
+
+    def test_data_worker_busy_polling(self):
+        input_queue = Queue()
+        output_queue = Queue()
+        data_worker = mtl.DataWorker([input_queue], [output_queue], mtl.OperationChain(), blocking=False)
+        data_worker.start()
+        input_queue.put("1")
+        self.assertEqual(["1"], output_queue.get(timeout=1))
+        data_worker.stop()
+        data_worker.join(1)
+        self.assertFalse(data_worker.thread.is_alive())
+
+    def test_process_data_worker_keeps_order(self):
+        input_queue = mtl.DataQueue()
+        output_queue = Queue()
+        data_worker = mtl.ProcessDataWorker([input_queue], [output_queue], mtl.OperationChain(), processes=2)
+        data_worker.start()
+        for i in range(10):
+            input_queue.put(i)
+        output_list = [output_queue.get(timeout=30) for _ in range(10)]
+        data_worker.stop()
+        data_worker.join()
+        self.assertEqual([[i] for i in range(10)], output_list)
+
+    def test_put_to_queues_overflow_policies(self):
+        drop_oldest = Queue(2)
+        drop_newest = Queue(2)
+        for i in range(5):
+            mtl.put_to_queues([drop_oldest], i, mtl.DROP_OLDEST)
+            mtl.put_to_queues([drop_newest], i, mtl.DROP_NEWEST)
+        self.assertEqual([3, 4], [drop_oldest.get_nowait(), drop_oldest.get_nowait()])
+        self.assertEqual([0, 1], [drop_newest.get_nowait(), drop_newest.get_nowait()])
+
+    def test_data_getter_counts_dropped(self):
+        class TestGetObject(mtl.GetParent):
+            def __init__(self):
+                super().__init__(None)
+                self.test_data = list(range(10))
+
+            def get_data(self):
+                if self.test_data:
+                    return self.test_data.pop(0)
+                return None
+        output_queue = mtl.DataQueue(1)
+        data_getter = mtl.DataGetter([output_queue], TestGetObject(), mtl.DROP_OLDEST)
+        data_getter.start()
+        while data_getter.dropped < 9:
+            time.sleep(0.001)
+        data_getter.stop()
+        data_getter.join()
+        self.assertEqual(9, output_queue.get_nowait())
+
+    def test_latest_value_queue_keeps_latest_object(self):
+        latest = mtl.LatestValueQueue()
+        for i in range(5):
+            mtl.put_to_queues([latest], i)
+        self.assertEqual(1, latest.qsize())
+        self.assertEqual(4, latest.replaced)
+        self.assertEqual(4, latest.get_nowait())
+
+    def test_blocked_data_getter_stops(self):
+        class TestGetObject(mtl.GetParent):
+            def get_data(self):
+                return "1"
+        output_queue = mtl.DataQueue(1)
+        data_getter = mtl.DataGetter([output_queue], TestGetObject())
+        data_getter.start()
+        output_queue.get(timeout=1)
+        data_getter.stop()
+        data_getter.join(1)
+        self.assertFalse(data_getter.thread.is_alive())
+
+    def test_data_synchronizer_matches_nearest_objects(self):
+        synchronizer = mtl.DataSynchronizer([Queue(), Queue()], [], tolerance=0.01, max_delay=1)
+        synchronizer.add_objects([[Captured(0.0, "a0"), Captured(0.033, "a1"), Captured(0.066, "a2")],
+                                  [Captured(0.004, "b0"), Captured(0.05, "b1")]])
+        self.assertEqual(["a0", "b0"], [matched.name for matched in synchronizer.match(0.1)])
+        # b1 is too far from a1, a1 is discarded and a2 is waiting for the next object of b
+        self.assertIsNone(synchronizer.match(0.1))
+        synchronizer.add_objects([[], [Captured(0.07, "b2")]])
+        self.assertEqual(["a2", "b2"], [matched.name for matched in synchronizer.match(0.1)])
+        # the second input stalled, after max_delay the first one is matched alone
+        synchronizer.add_objects([[Captured(0.1, "a3")], []])
+        self.assertIsNone(synchronizer.match(0.5))
+        self.assertEqual(["a3"], [matched.name for matched in synchronizer.match(1.2)])
+
+    def test_data_synchronizer_does_not_wait_for_idle_inputs(self):
+        synchronizer = mtl.DataSynchronizer([Queue(), Queue(), Queue()], [], tolerance=0.01, max_delay=0.5)
+        synchronizer.add_objects([[Captured(0.0, "a0")], [Captured(0.0, "b0")], [Captured(0.0, "c0")]])
+        synchronizer.match(0.01)
+        # the third input goes idle, once it's silent for max_delay the others are matched as they arrive
+        synchronizer.add_objects([[Captured(1.0, "a1")], [Captured(1.002, "b1")], []])
+        self.assertEqual(["a1", "b1"], [matched.name for matched in synchronizer.match(1.01)])
+
+    def test_data_synchronizer_drops_leftovers_of_idle_inputs(self):
+        synchronizer = mtl.DataSynchronizer([Queue(), Queue(), Queue()], [], tolerance=0.01, max_delay=0.5)
+        # the first input stopped with an object left that nothing will be matched with
+        synchronizer.add_objects([[Captured(0.0, "a0")], [Captured(9.967, "b1"), Captured(10.0, "b2")],
+                                  [Captured(9.967, "c1"), Captured(10.0, "c2")]])
+        self.assertEqual(["b1", "c1"], [matched.name for matched in synchronizer.match(10.02)])
+        self.assertEqual(["b2", "c2"], [matched.name for matched in synchronizer.match(10.02)])
+        self.assertEqual(1, synchronizer.discarded)
+        self.assertIsNone(synchronizer.match(10.02))
+
+    def test_data_synchronizer_follows_removed_inputs(self):
+        input_queues = [Queue(), Queue(), Queue()]
+        synchronizer = mtl.DataSynchronizer(input_queues, [], tolerance=0.01, max_delay=0.5)
+        synchronizer.follow_inputs(list(input_queues))
+        synchronizer.add_objects([[Captured(0.0, "a0")], [Captured(0.0, "b0")], []])
+        input_queues.pop(0)
+        synchronizer.follow_inputs(list(input_queues))
+        synchronizer.add_objects([[], [Captured(0.002, "c0")]])
+        self.assertEqual(["b0", "c0"], [matched.name for matched in synchronizer.match(0.01)])
+
+    def test_data_synchronizer_thread(self):
+        input_queues = [mtl.DataQueue(), mtl.DataQueue()]
+        output_queue = Queue()
+        synchronizer = mtl.DataSynchronizer(input_queues, [output_queue], tolerance=0.01)
+        synchronizer.start()
+        now = time.monotonic()
+        input_queues[0].put(Captured(now))
+        input_queues[1].put(Captured(now + 0.005))
+        matched = output_queue.get(timeout=1)
+        synchronizer.stop()
+        synchronizer.join()
+        self.assertEqual([now, now + 0.005], [captured.capture_time for captured in matched])
+
+    def test_periodic_scheduler_skips_overdue_ticks(self):
+        scheduler = mtl.PeriodicScheduler(2)
+        calls = []
+        fast = mtl.PeriodicTask(lambda: calls.append(time.monotonic()), 0.01, "fast")
+        slow = mtl.PeriodicTask(lambda: time.sleep(0.05), 0.01, "slow")
+        scheduler.add(fast)
+        scheduler.add(slow)
+        time.sleep(0.2)
+        scheduler.remove(fast)
+        scheduler.remove(slow)
+        slow.idle.wait(1)
+        self.assertGreaterEqual(len(calls), 15)
+        self.assertLessEqual(len(calls), 22)
+        # the slow task never overlaps with itself, ticks due while it runs are skipped
+        self.assertLessEqual(slow.ticks, 5)
+        self.assertGreater(slow.skipped, 10)
+        self.assertEqual({"ticks", "skipped", "mean lateness", "max lateness", "jitter"},
+                         set(fast.get_statistics().keys()))
+
+    def test_periodic_task_restarted_within_period_keeps_rate(self):
+        scheduler = mtl.PeriodicScheduler(1)
+        task = mtl.PeriodicTask(lambda: None, 0.05, "restarted")
+        scheduler.add(task)
+        for _ in range(3):
+            scheduler.remove(task)
+            scheduler.add(task)
+        time.sleep(0.22)
+        scheduler.remove(task)
+        # deadlines pushed before the restarts don't come back to life
+        self.assertLessEqual(task.ticks, 6)
+
+    def test_periodic_data_getter(self):
+        class TestGetObject(mtl.GetParent):
+            def get_data(self):
+                return "1"
+        output_queue = Queue()
+        data_getter = mtl.PeriodicDataGetter([output_queue], TestGetObject(), 100, scheduler=mtl.PeriodicScheduler(1))
+        data_getter.start()
+        self.assertEqual("1", output_queue.get(timeout=1))
+        data_getter.period = 0.005
+        self.assertEqual(0.005, data_getter.task.period)
+        data_getter.stop()
+        data_getter.join(1)
+
+    def test_pooled_data_worker_routes_outputs_in_order(self):
+        class Tag(mtl.OperationParent):
+            def __init__(self):
+                super().__init__()
+                self.batch_sizes = []
+
+            def run(self, input_object):
+                time.sleep(0.001)
+                return input_object[0] * 10
+
+            def run_batch(self, input_objects):
+                self.batch_sizes.append(len(input_objects))
+                return super().run_batch(input_objects)
+
+        tag = Tag()
+        worker = mtl.PooledDataWorker(mtl.OperationChain().add_operation(tag), threads=2, batch_size=4)
+        routes = [mtl.PoolRoute(mtl.DataQueue(), [Queue()]) for _ in range(3)]
+        for route in routes:
+            worker.add_route(route)
+        for value in range(30):
+            routes[value % 3].input_queue.put(value)
+        deadline = time.monotonic() + 5
+        while sum(route.output_object[0].qsize() for route in routes) < 30 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        worker.remove_route(routes[0])
+        routes[0].input_queue.put(99)
+        time.sleep(0.05)
+        worker.stop()
+        worker.join()
+        self.assertEqual(2, len(worker.threads))
+        for index, route in enumerate(routes):
+            self.assertEqual([value * 10 for value in range(index, 30, 3)], list(route.output_object[0].queue))
+        self.assertLessEqual(max(tag.batch_sizes), 4)
+        self.assertEqual([99], list(routes[0].input_queue.queue))
+
+    def test_pooled_data_worker_restarts_after_stop(self):
+        worker = mtl.PooledDataWorker(mtl.OperationChain(), threads=2)
+        route = mtl.PoolRoute(mtl.DataQueue(), [Queue()])
+        worker.add_route(route)
+        worker.stop()
+        worker.join(1)
+        worker.remove_route(route)
+        worker.add_route(route)
+        route.input_queue.put(1)
+        self.assertEqual([1], route.output_object[0].get(timeout=1))
+        self.assertEqual(2, sum(thread.is_alive() for thread in worker.threads))
+        worker.stop()
+        worker.join(1)
+
+    def test_pooled_data_worker_drains_removed_route(self):
+        class Slow(mtl.OperationParent):
+            def run(self, input_object):
+                time.sleep(0.01)
+                return input_object[0]
+
+        worker = mtl.PooledDataWorker(mtl.OperationChain().add_operation(Slow()), threads=1, batch_size=1)
+        route = mtl.PoolRoute(mtl.DataQueue(), [Queue()])
+        for value in range(5):
+            route.input_queue.put(value)
+        worker.add_route(route)
+        worker.remove_route(route, drain=True)
+        worker.stop()
+        worker.join(1)
+        self.assertEqual(list(range(5)), list(route.output_object[0].queue))
+        self.assertTrue(route.input_queue.empty())
@@ -0,0 +1,60 @@
+import time
+from unittest import TestCase
+
+import src.multi_thread_data_processing.multiThreadDataProcessing as mtl
+from src.multi_thread_data_processing.pipelineMetrics import REGISTRY, Histogram
+from capturedObject import Captured
+
+
+class Double(mtl.OperationParent):
+    def run(self, input_object):
+        return [Captured(captured.capture_time) for captured in input_object * 2]
+
+
+class Test(TestCase):
+    def test_histogram(self):
+        histogram = Histogram((0.001, 0.01, 0.1))
+        for value in (0.0005, 0.005, 0.005, 0.05):
+            histogram.observe(value)
+        self.assertEqual(histogram.get_percentile(50), 0.01)
+        self.assertEqual(histogram.get_percentile(100), 0.1)
+        lines = histogram.to_prometheus("test_seconds", 'stage="a"')
+        self.assertIn('test_seconds_bucket{stage="a",le="0.01"} 3', lines)
+        self.assertIn('test_seconds_bucket{stage="a",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{stage="a"} 4', lines)
+
+    def test_disabled_metrics_record_nothing(self):
+        input_queue = mtl.DataQueue()
+        data_worker = mtl.DataWorker([input_queue], [mtl.DataQueue()], mtl.OperationChain().add_operation(Double()),
+                                     name="disabled worker")
+        data_worker.process([Captured(time.monotonic())])
+        self.assertEqual(data_worker.metrics.processed, 0)
+        self.assertEqual(data_worker.metrics.operation_time, {})
+
+    def test_worker_and_sink_metrics(self):
+        REGISTRY.enable()
+        self.addCleanup(REGISTRY.enable, False)
+        input_queue = mtl.DataQueue()
+        output_queue = mtl.DataQueue(1)
+        data_worker = mtl.DataWorker([input_queue], [output_queue], mtl.OperationChain().add_operation(Double()),
+                                     overflow_policy=mtl.DROP_OLDEST, name="test worker")
+        data_sink = mtl.DataSink([output_queue], mtl.SinkParent(), name="test sink")
+        for _ in range(3):
+            data_worker.process([Captured(time.monotonic() - 0.2)])
+        input_queue.put(Captured(time.monotonic()))
+        data_sink.sink_data([output_queue.get()])
+        self.assertEqual(data_worker.metrics.processed, 3)
+        self.assertEqual(data_worker.metrics.latency.get_percentile(50), 0.25)
+        self.assertEqual(data_sink.metrics.processed, 1)
+        text = REGISTRY.to_prometheus()
+        self.assertIn('pipeline_objects_total{kind="worker",stage="test worker"} 3', text)
+        self.assertIn('pipeline_dropped_total{kind="worker",stage="test worker"} 2', text)
+        self.assertIn('pipeline_queue_depth{kind="worker",stage="test worker"} 1', text)
+        self.assertIn('pipeline_objects_total{kind="sink",stage="test sink"} 1', text)
+        self.assertIn('pipeline_operation_seconds_count{kind="worker",stage="test worker",operation="Double"} 3', text)
+
+    def test_removed_stages_are_not_reported(self):
+        data_getter = mtl.DataGetter([mtl.DataQueue()], mtl.GetParent(), name="removed getter")
+        self.assertIn('stage="removed getter"', REGISTRY.to_prometheus())
+        del data_getter
+        self.assertNotIn('stage="removed getter"', REGISTRY.to_prometheus())
@@ -0,0 +1,59 @@
+from unittest import TestCase
+
+import numpy as np
+
+from src.data_model.dataModel import FrameObjectWithDetectedObjects
+from src.object_fusion.objectFusion import FuseObjectsTransform
+
+
+def detected_frame(camera_index, centers, rots):
+    return FrameObjectWithDetectedObjects(np.zeros((4, 4, 3), np.uint8), camera_index, centers, rots)
+
+
+class Test(TestCase):
+    def test_fuses_cameras_in_world_coordinates(self):
+        camera_data = {0: (100, 50, 0.0, (640, 480), None), 1: (300, 50, np.pi / 2, (640, 480), None)}
+        transform = FuseObjectsTransform([0, 1, 2], camera_data)
+        fused = transform.run([detected_frame(0, {0: (200, 100), 1: (10, 10)}, {0: 2 * np.pi - 0.1, 1: 1.0}),
+                               detected_frame(1, {0: (100, 100)}, {0: 0.1 - np.pi / 2})])
+        # camera 1 is rotated by 90 degrees, its pixel (100, 100) is world (200, 150)
+        np.testing.assert_allclose((300, 150), fused.camera_poses[0, 0, :2])
+        np.testing.assert_allclose((200, 150), fused.camera_poses[1, 0, :2])
+        self.assertEqual((250, 150), fused.get_position(0))
+        self.assertAlmostEqual(0, np.sin(fused.get_rotation(0)), places=6)
+        self.assertEqual((110, 60), fused.get_position(1))
+        self.assertIsNone(fused.get_position(2))
+        np.testing.assert_allclose((100, 50), fused.to_camera()[1, 0])
+
+    def test_keeps_detections_of_cameras_between_updates(self):
+        camera_data = {0: (0, 0, 0.0, (640, 480), None)}
+        transform = FuseObjectsTransform([0], camera_data)
+        transform.run([detected_frame(0, {0: (10, 20)}, {0: 0.0})])
+        camera_data[1] = (100, 0, 0.0, (640, 480), None)
+        fused = transform.run([detected_frame(1, {0: (0, 20)}, {0: 0.0})])
+        self.assertEqual((55, 20), fused.get_position(0))
+        fused = transform.run([detected_frame(0, {}, {})])
+        self.assertEqual((100, 20), fused.get_position(0))
+
+    def test_fuses_detection_batches_and_fills_world_poses(self):
+        camera_data = {0: (100, 50, np.pi / 2, (640, 480), None)}
+        transform = FuseObjectsTransform([0, 1], camera_data)
+        batch = detected_frame(0, {1: (100, 100), 7: (1, 1)}, {1: 0.0, 7: 0.0}).to_batch()
+        fused = transform.run([batch])
+        self.assertEqual((0, 150), fused.get_position(1))
+        np.testing.assert_allclose([0, 150, np.pi / 2], batch.detections["world"][0], atol=1e-6)
+        # object 7 isn't fused
+        self.assertTrue(np.isnan(batch.detections["world"][1]).all())
+
+    def test_follows_changed_objects(self):
+        transform = FuseObjectsTransform([0, 1], {0: (0, 0, 0.0, (640, 480), None)})
+        transform.run([detected_frame(0, {0: (10, 20), 1: (30, 40), 5: (50, 60)}, {0: 0.0, 1: 0.0, 5: 0.0})])
+        transform.set_objects([5, 0])
+        fused = transform.run([])
+        self.assertEqual([5, 0], fused.object_indexes)
+        # the last detections of the camera are kept for objects still present, added ones show from the next frame
+        self.assertEqual((10, 20), fused.get_position(0))
+        self.assertIsNone(fused.get_position(5))
+        fused = transform.run([detected_frame(0, {1: (30, 40), 5: (50, 60)}, {1: 0.0, 5: 0.0})])
+        self.assertEqual((50, 60), fused.get_position(5))
+        self.assertEqual(1, len(fused.to_poses()))
@@ -0,0 +1,63 @@
+from unittest import TestCase
+
+import numpy as np
+
+from src.data_model.dataModel import FrameObjectWithDetectedObjects
+from src.object_fusion.objectFusion import FuseObjectsTransform
+from src.object_tracking.objectTracking import ObjectTracker
+
+
+def fuse(transform, centers, rot=0.5):
+    frame = np.zeros((4, 4, 3), np.uint8)
+    return transform.run([FrameObjectWithDetectedObjects(frame, 0, centers, {index: rot for index in centers})])
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.transform = FuseObjectsTransform([0, 1], {0: (0, 0, 0.0, (640, 480), None)})
+
+    def test_predicts_constant_velocity_between_measurements(self):
+        tracker = ObjectTracker([0, 1], alpha=0.5, beta=0.2, max_age=1.0)
+        for step in range(40):
+            tracker.update(fuse(self.transform, {0: (10 * step, 5), 1: (3, 4)}, np.mod(0.1 * step, 2 * np.pi)),
+                           step * 0.1)
+        positions, rots, visible = tracker.predict(3.95)
+        np.testing.assert_allclose([[395, 5], [3, 4]], positions, atol=0.5)
+        self.assertAlmostEqual(3.95, rots[0], delta=0.01)
+        np.testing.assert_array_equal([True, True], visible)
+
+    def test_rotation_wraps_around(self):
+        tracker = ObjectTracker([0, 1], alpha=0.5, beta=0.2, max_age=1.0)
+        for step in range(40):
+            tracker.update(fuse(self.transform, {0: (0, 0)}, np.mod(6.0 + 0.1 * step, 2 * np.pi)), step * 0.1)
+        _, rots, _ = tracker.predict(4.0)
+        self.assertAlmostEqual(np.mod(10.0, 2 * np.pi), rots[0], delta=0.01)
+
+    def test_missed_objects_are_predicted_until_max_age(self):
+        tracker = ObjectTracker([0, 1], max_age=0.5)
+        self.assertIsNone(tracker.predict_fused(0.0))
+        tracker.update(fuse(self.transform, {0: (1, 2), 1: (3, 4)}), 0.0)
+        tracker.update(fuse(self.transform, {0: (1, 2)}), 0.3)
+        fused = tracker.predict_fused(0.6)
+        self.assertEqual([0], [pose["id"] for pose in fused.to_poses()])
+        self.assertEqual((1, 2), fused.get_position(0))
+        self.assertIsNone(fused.get_position(1))
+        # after max_age the object starts again from its next measurement
+        tracker.update(fuse(self.transform, {1: (30, 40)}), 1.0)
+        positions, _, visible = tracker.predict(1.0)
+        np.testing.assert_array_equal([30, 40], positions[1])
+        np.testing.assert_array_equal([False, True], visible)
+
+    def test_follows_changed_objects(self):
+        tracker = ObjectTracker([0, 1], max_age=0.5)
+        tracker.update(fuse(self.transform, {0: (1, 2), 1: (3, 4)}), 0.0)
+        tracker.set_objects([1, 2])
+        self.transform.set_objects([1, 2])
+        fused = tracker.predict_fused(0.1)
+        self.assertEqual([1, 2], fused.object_indexes)
+        self.assertEqual((3, 4), fused.get_position(1))
+        self.assertIsNone(fused.get_position(2))
+        tracker.update(fuse(self.transform, {2: (5, 6)}), 0.2)
+        positions, _, visible = tracker.predict(0.2)
+        np.testing.assert_array_equal([5, 6], positions[1])
+        np.testing.assert_array_equal([True, True], visible)
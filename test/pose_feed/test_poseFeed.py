@@ -0,0 +1,51 @@
+import json
+from unittest import TestCase
+
+import numpy as np
+
+from src.data_model.dataModel import FrameObjectWithDetectedObjects
+from src.object_fusion.objectFusion import FuseObjectsTransform
+from src.pose_feed.poseFeed import PoseFeed
+
+
+def fuse(transform, centers):
+    frame = np.zeros((4, 4, 3), np.uint8)
+    return transform.run([FrameObjectWithDetectedObjects(frame, 0, centers, {index: 0.5 for index in centers})])
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.transform = FuseObjectsTransform([0, 1, 2], {0: (100, 0, 0.0, (640, 480), None)})
+
+    def test_latest_table_keeps_last_pose_of_each_object(self):
+        feed = PoseFeed()
+        feed.sink_data([fuse(self.transform, {0: (1, 2), 1: (3, 4)})])
+        feed.sink_data([fuse(self.transform, {0: (5, 6)}), "not fused"])
+        latest = feed.get_latest()
+        self.assertEqual([0, 1], [pose["id"] for pose in latest])
+        self.assertEqual((105, 6, 0.5), (latest[0]["x"], latest[0]["y"], latest[0]["rot"]))
+        self.assertEqual([1], [pose["id"] for pose in feed.get_latest({1})])
+
+    def test_subscriber_filters_and_drops_oldest(self):
+        feed = PoseFeed(buffer_size=2)
+        subscriber = feed.subscribe({0, 1})
+        for x in range(3):
+            feed.sink_data([fuse(self.transform, {0: (x, 0), 1: (x, 0), 2: (x, 0)})])
+        poses = subscriber.take(0.01)
+        self.assertEqual([(0, 102), (1, 102)], [(pose["id"], pose["x"]) for pose in poses])
+        self.assertEqual(4, subscriber.dropped)
+        self.assertEqual([], subscriber.take(0.01))
+        feed.unsubscribe(subscriber)
+        self.assertEqual([], feed.subscribers)
+
+    def test_rate_limited_events_carry_newest_pose_of_each_object(self):
+        feed = PoseFeed()
+        events = feed.events({0}, max_rate=1000, keepalive=0.01)
+        self.assertEqual(": keepalive\n\n", next(events))
+        feed.sink_data([fuse(self.transform, {0: (1, 0)})])
+        feed.sink_data([fuse(self.transform, {0: (2, 0), 1: (2, 0)})])
+        event = next(events)
+        self.assertTrue(event.startswith("data: "))
+        self.assertEqual([(0, 102)], [(pose["id"], pose["x"]) for pose in json.loads(event[6:])])
+        events.close()
+        self.assertEqual([], feed.subscribers)
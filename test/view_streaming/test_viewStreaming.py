@@ -0,0 +1,41 @@
+import threading
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from src.view_streaming.viewStreaming import FrameBroadcaster
+
+
+def make_views(value):
+    return {"Video": np.full((8, 8, 3), value, np.uint8), "Camera: 0": np.full((8, 8, 3), value, np.uint8)}
+
+
+class Test(TestCase):
+    def test_only_watched_views_are_encoded(self):
+        broadcaster = FrameBroadcaster()
+        broadcaster.publish(make_views(0))
+        self.assertEqual(0, broadcaster.encoded)
+        self.assertEqual(["Video", "Camera: 0"], broadcaster.get_views())
+        broadcaster.subscribe("Video")
+        broadcaster.subscribe("Video")
+        broadcaster.publish(make_views(0))
+        self.assertEqual(1, broadcaster.encoded)
+
+    def test_client_skips_to_newest_frame(self):
+        broadcaster = FrameBroadcaster()
+        stream = broadcaster.stream("Video", 0.05)
+        threading.Timer(0.1, broadcaster.publish, [make_views(10)]).start()
+        part = next(stream)
+        self.assertTrue(part.startswith(b"--frame\r\nContent-Type: image/jpeg\r\n"))
+        # published while the client was busy, only the last one is sent
+        broadcaster.publish(make_views(100))
+        broadcaster.publish(make_views(200))
+        part = next(stream)
+        jpeg = part[part.index(b"\r\n\r\n") + 4:-2]
+        image = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+        self.assertAlmostEqual(200, image.mean(), delta=2)
+        self.assertEqual(1, broadcaster.clients["Video"])
+        stream.close()
+        self.assertNotIn("Video", broadcaster.clients)
+        self.assertIsNone(broadcaster.wait_frame("Video", 0, 0.01))